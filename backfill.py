@@ -0,0 +1,160 @@
+import os
+import sys
+import logging
+import argparse
+import datetime
+import extract_data
+from fetch_engine import run_jobs, DEFAULT_WORKERS, DEFAULT_LIMIT_PER_HOST
+from instrumentation import metrics, METRICS_FOLDER_PATH
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(SCRIPT_FOLDER, "src"))
+import cowin_data_extractor
+
+
+def date_range(start_date, end_date):
+    """
+        Generates all the dates between start and end date (inclusive).
+
+        Parameters:
+            start_date: Start date in YYYY-MM-DD format
+            end_date: End date in YYYY-MM-DD format
+        Returns:
+            Generator of dates in YYYY-MM-DD format
+    """
+    current = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    while current <= end:
+        yield current.isoformat()
+        current += datetime.timedelta(days=1)
+
+
+def parse_ids(value):
+    """
+        Parses comma separated IDs into a set of integers.
+    """
+    return set(int(id) for id in value.split(",") if id.strip())
+
+
+def build_backfill_jobs(dates, output_format, test_mode,
+                        state_ids=None, district_ids=None, consolidated=False,
+                        archived=False):
+    """
+        Builds fetch jobs of all the locations for all the dates.
+
+        Parameters:
+            dates: Dates for which the data needs to be retrieved
+            output_format: csv for CSV folders (extract_data.py) or
+                json for raw JSON files (src/cowin_data_extractor.py)
+            test_mode: Extract only whitelisted entries
+            state_ids: Optional set of state IDs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            consolidated: Write consolidated CSV files per date
+                (csv format only)
+            archived: Write a compressed raw archive per date
+                (json format only)
+        Returns:
+            Tuple of fetch jobs, checkpoint manifests and consolidated
+            or archive writers of the dates
+    """
+    jobs = []
+    manifests = []
+    writers = []
+    if output_format == "csv":
+        state_district_data = extract_data.get_state_districts_data()
+    for date in dates:
+        logging.info("Scheduling data for '{}'".format(date))
+        if output_format == "csv":
+            manifest = extract_data.get_manifest(date, consolidated)
+            writer = None
+            if consolidated:
+                writer = extract_data.get_consolidated_writer(date, manifest)
+                writers.append(writer)
+            jobs += extract_data.extract_date_jobs(
+                state_district_data, date, test_mode, manifest,
+                state_ids, district_ids, writer)
+        else:
+            manifest = cowin_data_extractor.get_manifest(date, archived)
+            archive = None
+            if archived:
+                archive = cowin_data_extractor.get_archive_writer(
+                    date, manifest)
+                writers.append(archive)
+            jobs += cowin_data_extractor.extract_date_jobs(
+                date, test_mode, manifest, state_ids, district_ids, archive)
+        manifests.append(manifest)
+    return jobs, manifests, writers
+
+
+def backfill(start_date, end_date, output_format="csv", test_mode=False,
+             state_ids=None, district_ids=None, workers=DEFAULT_WORKERS,
+             limit_per_host=DEFAULT_LIMIT_PER_HOST, consolidated=False,
+             archived=False):
+    """
+        Extracts data for a date range. Jobs of all the dates share a
+        single work queue so that the concurrency limits apply to the
+        whole backfill.
+
+        Parameters:
+            start_date: Start date in YYYY-MM-DD format
+            end_date: End date in YYYY-MM-DD format (inclusive)
+            output_format: csv or json
+            test_mode: Extract only whitelisted entries
+            state_ids: Optional set of state IDs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            workers: Number of concurrent fetch workers
+            limit_per_host: Maximum open connections to COWIN API
+            consolidated: Write consolidated CSV files per date
+            archived: Write a compressed raw archive per date
+        Returns:
+            Fetch statistics returned by run_jobs
+    """
+    dates = list(date_range(start_date, end_date))
+    logging.info("Backfilling {} dates from '{}' to '{}'".format(
+        len(dates), start_date, end_date))
+    jobs, manifests, writers = build_backfill_jobs(
+        dates, output_format, test_mode, state_ids, district_ids,
+        consolidated, archived)
+    try:
+        return run_jobs(jobs, workers, limit_per_host)
+    finally:
+        for writer in writers:
+            writer.close()
+        for manifest in manifests:
+            manifest.close()
+        metrics.write_reports("backfill", os.path.join(
+            SCRIPT_FOLDER, METRICS_FOLDER_PATH))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Extract COWIN data for a range of dates")
+    parser.add_argument("start_date", help="Start date (YYYY-MM-DD)")
+    parser.add_argument("end_date", help="End date (YYYY-MM-DD), inclusive")
+    parser.add_argument("--format", dest="output_format", default="csv",
+                        choices=["csv", "json"],
+                        help="csv folders or raw json files")
+    parser.add_argument("--states", type=parse_ids,
+                        help="Comma separated state IDs")
+    parser.add_argument("--districts", type=parse_ids,
+                        help="Comma separated district IDs")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--limit-per-host", type=int,
+                        default=DEFAULT_LIMIT_PER_HOST)
+    parser.add_argument("--consolidated", action="store_true",
+                        help="Write a single CSV file per data type and date")
+    parser.add_argument("--archive", dest="archived", action="store_true",
+                        help="Write a compressed raw archive per date")
+    parser.add_argument("--test-mode", action="store_true",
+                        help="Extract only the whitelisted test locations")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_args(sys.argv[1:])
+    backfill(options.start_date, options.end_date, options.output_format,
+             options.test_mode, options.states, options.districts,
+             options.workers, options.limit_per_host, options.consolidated,
+             options.archived)
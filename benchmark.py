@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import datetime
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from data_converter import convert_data
+from checkpoint import CheckpointManifest, location_key
+from load_cowin_data_sqlite import load_cowin_data, TABLE_FILE_MAPPING, \
+    DB_FILE_NAME, load_state_district_meta_data
+from fingerprint_store import FingerprintStore
+from pipeline import PayloadWriter, convert_payload, update_derived_tables, \
+    DEFAULT_QUEUE_SIZE
+from sqlite_utils import Database
+from cowin_payload_generator import SCALES, iter_payloads, \
+    get_missing_paths, get_result_path
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+RESULTS_FILE_PATH = os.path.join("data", "benchmarks", "results.jsonl")
+
+DEFAULT_DATES = ["2021-05-08", "2021-05-09"]
+
+# Throughput drop from the previous run which is reported as a regression
+DEFAULT_TOLERANCE = 0.1
+
+
+def count_csv_output(folder):
+    """
+        Counts the CSV files and data rows written under a folder.
+
+        Returns:
+            Tuple of file count and row count
+    """
+    files = 0
+    rows = 0
+    for root, dirs, file_names in os.walk(folder):
+        for file_name in file_names:
+            if file_name.endswith(".csv"):
+                files += 1
+                with open(os.path.join(root, file_name), "rb") as file:
+                    rows += sum(1 for _ in file) - 1
+    return files, rows
+
+
+def count_loaded_rows(root_folder):
+    db = Database(os.path.join(root_folder, DB_FILE_NAME))
+    tables = set(info["table"] for info in TABLE_FILE_MAPPING.values())
+    rows = sum(db[table].count for table in tables if db[table].exists())
+    db.conn.close()
+    return rows
+
+
+def generate_payloads(scale, dates):
+    payloads = list(iter_payloads(dates, **SCALES[scale]))
+    for location, date, payload in payloads:
+        missing = get_missing_paths(location["location_type"], payload)
+        if missing:
+            raise Exception("Generated payload has no {}".format(
+                ", ".join(missing)))
+    return payloads
+
+
+def write_csv_data(root_folder, payloads):
+    for location, date, payload in payloads:
+        folder = get_result_path(root_folder, location, date)
+        os.makedirs(folder)
+        convert_data(location["location_type"], folder,
+                     dict(payload, date=date))
+
+
+def bench_convert_data(root_folder, scale, dates):
+    """
+        Times convert_data on generated payloads held in memory.
+    """
+    payloads = generate_payloads(scale, dates)
+    started_at = time.perf_counter()
+    write_csv_data(root_folder, payloads)
+    seconds = time.perf_counter() - started_at
+    files, rows = count_csv_output(root_folder)
+    return seconds, rows, files
+
+
+def bench_load_cowin_data(root_folder, scale, dates):
+    """
+        Times a bulk load_cowin_data of generated CSV files.
+    """
+    write_csv_data(root_folder, generate_payloads(scale, dates))
+    files, _ = count_csv_output(root_folder)
+    started_at = time.perf_counter()
+    load_cowin_data(root_folder, bulk=True, workers=1)
+    seconds = time.perf_counter() - started_at
+    return seconds, count_loaded_rows(root_folder), files
+
+
+def bench_pipeline(root_folder, scale, dates):
+    """
+        Times pipeline.run_pipeline without the network: generated
+        response bodies are converted by convert_payload, as done by the
+        fetch workers, and loaded by a PayloadWriter, followed by the
+        update of the derived tables. Files are the payloads loaded.
+    """
+    bodies = [(location, date, json.dumps(payload).encode("utf-8"))
+              for location, date, payload in generate_payloads(scale, dates)]
+    db_path = os.path.join(root_folder, DB_FILE_NAME)
+    db = Database(db_path)
+    load_state_district_meta_data(db)
+    store = FingerprintStore(db)
+    db.conn.close()
+    manifest = CheckpointManifest(
+        os.path.join(root_folder, "checkpoints.jsonl"))
+    started_at = time.perf_counter()
+    payload_queue = queue.Queue(DEFAULT_QUEUE_SIZE)
+    writer = PayloadWriter(db_path, payload_queue, store)
+    writer.start()
+    try:
+        for location, date, body in bodies:
+            location_type = location["location_type"]
+            location_id = location["location_id"]
+            convert_payload(date, location_type, location_id, manifest,
+                            location_key(location_type, location_id), store,
+                            payload_queue, body)
+    finally:
+        writer.join_writer()
+        manifest.close()
+    update_derived_tables(db_path, writer.loaded_dates).conn.close()
+    seconds = time.perf_counter() - started_at
+    return seconds, count_loaded_rows(root_folder), writer.loaded
+
+
+BENCHMARKS = {
+    "convert_data": bench_convert_data,
+    "load_cowin_data": bench_load_cowin_data,
+    "pipeline": bench_pipeline
+}
+
+
+def run_benchmark(name, scale, dates):
+    """
+        Runs a benchmark in a temporary root folder. Runs in a fresh
+        process, so that the peak memory is the peak of the benchmark,
+        including its generated input.
+
+        Returns:
+            Result dictionary
+    """
+    os.chdir(SCRIPT_FOLDER)
+    logging.getLogger().setLevel(logging.WARNING)
+    root_folder = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        seconds, rows, files = BENCHMARKS[name](root_folder, scale, dates)
+    finally:
+        shutil.rmtree(root_folder, ignore_errors=True)
+    return {
+        "benchmark": name,
+        "scale": scale,
+        "dates": len(dates),
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "files": files,
+        "rows_per_second": round(rows / seconds, 1),
+        "files_per_second": round(files / seconds, 1),
+        # Kilobytes on Linux
+        "peak_memory_mb": round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_FOLDER,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def find_regressions(results, previous_results, tolerance):
+    """
+        Compares the throughput of the results with the latest previous
+        result of the same benchmark and scale.
+
+        Returns:
+            List of regression messages
+    """
+    previous = {}
+    for result in previous_results:
+        previous[(result["benchmark"], result["scale"],
+                  result["dates"])] = result
+    regressions = []
+    for result in results:
+        baseline = previous.get(
+            (result["benchmark"], result["scale"], result["dates"]))
+        if not baseline:
+            continue
+        change = result["rows_per_second"] / baseline["rows_per_second"] - 1
+        if change < -tolerance:
+            regressions.append(
+                "{benchmark} ({scale}): {rows_per_second:.0f} rows/s".format(
+                    **result) + " is {:.0%} slower than {} at {}".format(
+                    -change, baseline["rows_per_second"],
+                    baseline["revision"]))
+    return regressions
+
+
+def run_benchmarks(names, scales, dates, results_path, tolerance):
+    """
+        Runs the benchmarks at the scales, appends the results to the
+        results file and reports the regressions since the previous run.
+
+        Parameters:
+            names: Names of the BENCHMARKS to run
+            scales: Names of the cowin_payload_generator SCALES
+            dates: Dates of the generated data
+            results_path: JSON lines file of the benchmark results
+            tolerance: Throughput drop reported as a regression
+        Returns:
+            List of regression messages
+    """
+    previous_results = read_results(results_path)
+    run = {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+           "revision": get_revision(), "python": platform.python_version()}
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for scale in scales:
+        for name in names:
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(
+                    run_benchmark, name, scale, dates).result()
+            result.update(run)
+            results.append(result)
+            print("{benchmark:<16} {scale:<7} {seconds:>9.2f}s {rows:>9} rows "
+                  "{rows_per_second:>10.0f} rows/s {files_per_second:>8.1f} "
+                  "files/s {peak_memory_mb:>8.1f} MB".format(**result))
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, "a") as file:
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+    regressions = find_regressions(results, previous_results, tolerance)
+    for regression in regressions:
+        logging.warning("Regression: {}".format(regression))
+    return regressions
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the conversion and load of generated COWIN data")
+    parser.add_argument("--benchmark", dest="names", action="append",
+                        choices=sorted(BENCHMARKS),
+                        help="Benchmark to run, defaults to all")
+    parser.add_argument("--scale", dest="scales", action="append",
+                        choices=list(SCALES),
+                        help="Data scale, defaults to small and medium")
+    parser.add_argument("--dates", type=int, default=len(DEFAULT_DATES),
+                        help="Number of dates of generated data")
+    parser.add_argument("--results", dest="results_path",
+                        default=os.path.join(SCRIPT_FOLDER, RESULTS_FILE_PATH))
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Throughput drop reported as a regression")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with an error on regressions")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_args(sys.argv[1:])
+    start = datetime.date.fromisoformat(DEFAULT_DATES[0])
+    dates = [(start + datetime.timedelta(days=index)).isoformat()
+             for index in range(options.dates)]
+    regressions = run_benchmarks(
+        options.names or list(BENCHMARKS), options.scales or ["small", "medium"],
+        dates, options.results_path, options.tolerance)
+    if options.check and regressions:
+        sys.exit(1)
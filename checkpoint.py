@@ -0,0 +1,160 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+import contextlib
+from datetime import datetime
+
+PENDING = "pending"
+FETCHED = "fetched"
+CONVERTED = "converted"
+FAILED = "failed"
+
+STAGING_PREFIX = ".staging-"
+
+# mkdtemp and mkstemp create owner only folders and files. They are
+# given the permissions os.makedirs and open would have given them
+# before they are renamed into place. The umask can only be read by
+# setting it, so it is read once at import.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def location_key(location_type, location_id):
+    return "{}-{}".format(location_type, location_id)
+
+
+@contextlib.contextmanager
+def atomic_folder(folder):
+    """
+        Creates a staging folder next to the target folder and renames
+        it into place once the block completes. The staging folder is
+        removed if the block fails, so the target folder is either
+        missing or complete.
+
+        Parameters:
+            folder: Final path of the folder
+        Returns:
+            Path of the staging folder where the files need to be written
+    """
+    parent = os.path.dirname(folder)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=parent)
+    try:
+        yield staging
+        os.chmod(staging, 0o777 & ~UMASK)
+        os.rename(staging, folder)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_file(file_path, mode="w"):
+    """
+        Opens a temporary file next to the target file and replaces
+        the target file with it once the block completes.
+
+        Parameters:
+            file_path: Final path of the file
+            mode: File open mode
+        Returns:
+            File object of the temporary file
+    """
+    folder = os.path.dirname(file_path)
+    fd, temp_path = tempfile.mkstemp(prefix=STAGING_PREFIX, dir=folder)
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class CheckpointManifest:
+    """
+        Tracks the extraction status of every location of a date.
+        Status updates are appended to a JSON lines journal so that
+        a crash loses at most the update being written. The journal is
+        compacted into one record per location when it is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.records = self.read_records(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.journal = open(path, "a")
+        if self.journal.tell() > 0 and not self.ends_with_newline(path):
+            self.journal.write("\n")
+
+    @staticmethod
+    def read_records(path):
+        records = {}
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written last line of a crashed run
+                    continue
+                records[record["key"]] = record
+        return records
+
+    @staticmethod
+    def ends_with_newline(path):
+        with open(path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    def get_status(self, key):
+        record = self.records.get(key)
+        return record["status"] if record else None
+
+    def update(self, key, status, **details):
+        """
+            Records the status of a location.
+
+            Parameters:
+                key: Location key built using location_key
+                status: pending, fetched, converted or failed
+                details: Additional values stored with the record
+        """
+        record = {"key": key, "status": status,
+                  "updated_at": datetime.now().isoformat(timespec="seconds")}
+        record.update(details)
+        with self.lock:
+            self.records[key] = record
+            self.journal.write(json.dumps(record) + "\n")
+            self.journal.flush()
+
+    def record_failure(self, key, error):
+        self.update(key, FAILED, error=repr(error))
+
+    def summary(self):
+        counts = {PENDING: 0, FETCHED: 0, CONVERTED: 0, FAILED: 0}
+        for record in self.records.values():
+            counts[record["status"]] += 1
+        return counts
+
+    def close(self):
+        """
+            Compacts the journal and logs the status summary.
+        """
+        with self.lock:
+            self.journal.close()
+            with atomic_file(self.path) as file:
+                for record in self.records.values():
+                    file.write(json.dumps(record) + "\n")
+        logging.info(
+            "Checkpoint {}: {converted} converted, {failed} failed, "
+            "{pending} pending, {fetched} fetched".format(
+                self.path, **self.summary()))
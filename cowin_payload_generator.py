@@ -0,0 +1,236 @@
+import os
+import random
+import datetime
+from data_converter import get_location_mappings, get_nested_object
+from extract_data import COWIN_DATA_FOLDER_PATH, normalize_name
+from load_cowin_data_sqlite import get_json_from_file
+
+# Scales of the generated data. Site counts are the number of rows of
+# the site level payload of each district.
+SCALES = {
+    "small": {"states": 2, "districts_per_state": 2, "sites_per_district": 50},
+    "medium": {"states": 6, "districts_per_state": 5, "sites_per_district": 500},
+    "large": {"states": 12, "districts_per_state": 10, "sites_per_district": 2000}
+}
+
+HOURS = ["{:02d}:00".format(hour) for hour in range(7, 22)]
+
+AGE_GROUPS = ["vac_18_30", "vac_30_45", "vac_45_60", "above_60"]
+
+
+def get_generator_locations(states, districts_per_state):
+    """
+        Gets the locations of the generated data, with the states and
+        districts of states.json and districts.json.
+
+        Parameters:
+            states: Number of states
+            districts_per_state: Number of districts of every state
+        Returns:
+            List of location dictionaries with location_type,
+            location_id, name, folder and children
+    """
+    state_rows = get_json_from_file("states.json")[:states]
+    districts = {}
+    for district in get_json_from_file("districts.json"):
+        districts.setdefault(district["state_id"], []).append(district)
+    national = {"location_type": "national", "location_id": 0,
+                "name": "India", "folder": "", "children": []}
+    locations = [national]
+    for state in state_rows:
+        folder = "{}-{}".format(state["id"], normalize_name(state["name"]))
+        state_location = {"location_type": "state", "location_id": state["id"],
+                          "name": state["name"], "folder": folder,
+                          "children": []}
+        national["children"].append(state_location)
+        locations.append(state_location)
+        for district in districts.get(state["id"], [])[:districts_per_state]:
+            district_location = {
+                "location_type": "district",
+                "location_id": district["district_id"],
+                "name": district["district_name"],
+                "state_id": state["id"],
+                "folder": os.path.join(folder, "{}-{}".format(
+                    district["district_id"],
+                    normalize_name(district["district_name"]))),
+                "children": []}
+            state_location["children"].append(district_location)
+            locations.append(district_location)
+    return locations
+
+
+def split_count(rng, total, parts):
+    """
+        Splits a count into random parts which add up to the count.
+    """
+    weights = [rng.random() + 0.1 for _ in range(parts)]
+    total_weight = sum(weights)
+    counts = [int(total * weight / total_weight) for weight in weights]
+    counts[0] += total - sum(counts)
+    return counts
+
+
+def get_group_rows(rng, location, date, sites_per_district, day):
+    """
+        Gets the getBeneficiariesGroupBy rows of a location, which are
+        the states of the nation, the districts of a state or the sites
+        of a district.
+    """
+    rows = []
+    if location["location_type"] == "district":
+        children = [{"location_id": location["location_id"] * 100000 + index,
+                     "name": "{} Site {}".format(location["name"], index)}
+                    for index in range(sites_per_district)]
+    else:
+        children = location["children"]
+    for child in children:
+        total = rng.randint(1000, 100000) * day
+        partial = int(total * rng.uniform(0.6, 0.9))
+        row = {"title": child["name"], "total": total,
+               "partial_vaccinated": partial,
+               "totally_vaccinated": total - partial,
+               "today": rng.randint(0, 5000)}
+        if location["location_type"] == "national":
+            row.update({"state_id": child["location_id"],
+                        "state_name": child["name"]})
+        elif location["location_type"] == "state":
+            row.update({"state_id": location["location_id"],
+                        "district_id": child["location_id"],
+                        "district_name": child["name"]})
+        else:
+            row.update({"session_site_id": child["location_id"],
+                        "session_site_name": child["name"]})
+        rows.append(row)
+    return rows
+
+
+def generate_payload(location, date, sites_per_district, seed=0):
+    """
+        Generates a COWIN Dashboard payload of a location and date,
+        with values for every DATA_MAPPING path of the location type.
+        Payloads are the same for the same seed, and cumulative counts
+        grow with the date.
+
+        Parameters:
+            location: Location dictionary of get_generator_locations
+            date: Date in YYYY-MM-DD format
+            sites_per_district: Number of sites of a district payload
+            seed: Random seed
+        Returns:
+            Payload dictionary
+    """
+    rng = random.Random("{}-{}-{}-{}".format(
+        seed, location["location_type"], location["location_id"], date))
+    current = datetime.date.fromisoformat(date)
+    day = current.toordinal() - datetime.date(2021, 1, 15).toordinal() + 1
+    today = rng.randint(1000, 50000)
+    total = today * day
+    dose_1 = int(total * 0.8)
+    male = int(total * 0.52)
+    covaxin = int(total * 0.12)
+    registration = total * 2
+    by_age = split_count(rng, total, len(AGE_GROUPS))
+    by_hour = split_count(rng, today, len(HOURS))
+
+    def previous_dates(count):
+        return [(current - datetime.timedelta(days=index)).isoformat()
+                for index in range(count, 0, -1)]
+
+    return {
+        "topBlock": {
+            "sites": {"total": rng.randint(100, 5000), "govt": 0, "pvt": 0,
+                      "today": rng.randint(10, 500)},
+            "registration": {
+                "total": registration, "male": registration // 2,
+                "female": registration - registration // 2, "others": 0,
+                "online": registration // 3,
+                "onspot": registration - registration // 3,
+                "today": today * 2, "flwAndHcw": registration // 10},
+            "sessions": {"total": rng.randint(1000, 50000), "govt": 0,
+                         "pvt": 0, "today": rng.randint(10, 500)},
+            "vaccination": {
+                "total": total, "male": male, "female": total - male,
+                "others": 0, "covishield": total - covaxin,
+                "covaxin": covaxin, "today": today, "tot_dose_1": dose_1,
+                "tot_dose_2": total - dose_1, "total_doses": total,
+                "aefi": total // 10000}
+        },
+        "vaccinationByAge": {"total": total,
+                             **dict(zip(AGE_GROUPS, by_age))},
+        "vaccinationDoneByTime": [
+            {"ts": hour, "timestamps": "{} {}".format(date, hour),
+             "label": hour, "count": count, "dose_one": count * 4 // 5,
+             "dose_two": count - count * 4 // 5}
+            for hour, count in zip(HOURS, by_hour)],
+        "last7DaysRegistration": [
+            {"reg_date": reg_date, "total": rng.randint(1000, 50000),
+             "male": rng.randint(500, 25000), "female": rng.randint(500, 25000),
+             "others": rng.randint(0, 10)}
+            for reg_date in previous_dates(7)],
+        "last7DaysVaccination": [
+            {"vaccine_date": vaccine_date, "count": rng.randint(1000, 50000),
+             "dose_one": rng.randint(500, 40000),
+             "dose_two": rng.randint(500, 10000),
+             "covishield": rng.randint(500, 40000),
+             "covaxin": rng.randint(100, 5000), "aefi": rng.randint(0, 10)}
+            for vaccine_date in previous_dates(7)],
+        "last5daySessionStatus": [
+            {"session_date": session_date, "total": rng.randint(100, 5000),
+             "planned": rng.randint(0, 100), "ongoing": rng.randint(0, 100),
+             "completed": rng.randint(100, 5000)}
+            for session_date in previous_dates(5)],
+        "last30DaysAefi": [
+            {"vaccine_date": vaccine_date, "aefi": rng.randint(0, 50)}
+            for vaccine_date in previous_dates(30)],
+        "timestamp": "{} 21:00:00".format(date),
+        "aefiPercentage": "{:.3f}".format(rng.uniform(0, 0.1)),
+        "timeWiseTodayRegReport": [
+            {"ts": hour, "label": hour, "total": count * 2}
+            for hour, count in zip(HOURS, by_hour)],
+        "vaccinationDoneByTimeAgeWise": [
+            {"ts": hour, "label": hour,
+             **dict(zip(AGE_GROUPS, split_count(rng, count, len(AGE_GROUPS))))}
+            for hour, count in zip(HOURS, by_hour)],
+        "getBeneficiariesGroupBy": get_group_rows(
+            rng, location, date, sites_per_district, day)
+    }
+
+
+def get_missing_paths(location_type, payload):
+    """
+        Gets the DATA_MAPPING paths of a location type which have no
+        value in the payload.
+    """
+    return [config["path"]
+            for _, config in get_location_mappings(location_type)
+            if not get_nested_object(payload, config["path"])]
+
+
+def iter_payloads(dates, states, districts_per_state, sites_per_district,
+                  seed=0):
+    """
+        Generates the payloads of all the locations for the dates.
+
+        Parameters:
+            dates: List of dates in YYYY-MM-DD format
+            states: Number of states
+            districts_per_state: Number of districts of every state
+            sites_per_district: Number of sites of a district payload
+            seed: Random seed
+        Returns:
+            Generator of location dictionary, date and payload
+    """
+    locations = get_generator_locations(states, districts_per_state)
+    for date in dates:
+        for location in locations:
+            yield location, date, generate_payload(
+                location, date, sites_per_district, seed)
+
+
+def get_result_path(root_folder, location, date):
+    """
+        Gets the CSV folder of a location and date, in the layout used
+        by extract_data.py.
+    """
+    return os.path.join(root_folder, COWIN_DATA_FOLDER_PATH,
+                        location["folder"], date)
@@ -0,0 +1,432 @@
+import os
+import re
+import sys
+import json
+import logging
+import threading
+from datetime import datetime
+from checkpoint import atomic_file
+
+COWIN_DATA_FOLDER_PATH = os.path.join("data", "cowin")
+
+CATALOG_FOLDER_PATH = os.path.join("data", "catalog")
+
+DATE_FOLDER_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# State and district folders, e.g. 16-Karnataka
+LOCATION_FOLDER_PATTERN = re.compile(r"^(\d+)-[A-Za-z]")
+
+# Modification times, child location folders and cataloged date folders
+# of data/cowin and its state and district folders, as of the last time
+# they were listed. The root folder is recorded as "".
+LOCATIONS_FILE_NAME = "locations.jsonl"
+
+
+def get_folder_location(relative_folder):
+    """
+        Gets the location and date of a data folder from its path
+        relative to data/cowin, which follows the extract_data.py
+        folder layout.
+
+        Parameters:
+            relative_folder: Path of the folder, separated by /
+        Returns:
+            Tuple of location type, location ID and date, or None if
+            the path is not a location data folder
+    """
+    parts = relative_folder.strip("/").split("/")
+    if not DATE_FOLDER_PATTERN.match(parts[-1]):
+        return None
+    location_ids = [match.group(1) for match in
+                    map(LOCATION_FOLDER_PATTERN.match, parts[:-1]) if match]
+    if len(location_ids) != len(parts) - 1:
+        return None
+    if len(location_ids) == 0:
+        return "national", 0, parts[-1]
+    if len(location_ids) == 1:
+        return "state", int(location_ids[0]), parts[-1]
+    if len(location_ids) == 2:
+        return "district", int(location_ids[1]), parts[-1]
+    return None
+
+
+class DataCatalog:
+    """
+        Index of the CSV folders of data/cowin, with one entry per
+        location and date folder that has the location, the date and
+        the size and modification time of every CSV file.
+
+        Entries are appended to a JSON lines file per date as the
+        extractors write the folders, and the latest entry of a folder
+        wins. Readers load only the files of the dates they query.
+    """
+
+    def __init__(self, data_folder=COWIN_DATA_FOLDER_PATH,
+                 catalog_folder=CATALOG_FOLDER_PATH):
+        """
+            Parameters:
+                data_folder: data/cowin folder
+                catalog_folder: Folder of the catalog files
+        """
+        self.data_folder = data_folder
+        self.catalog_folder = catalog_folder
+        self.lock = threading.Lock()
+        self.dates = {}
+        self.locations = None
+
+    def exists(self):
+        return os.path.exists(self.catalog_folder)
+
+    def get_locations_path(self):
+        return os.path.join(self.catalog_folder, LOCATIONS_FILE_NAME)
+
+    def read_locations(self):
+        """
+            Reads the location folder records. Runs with the lock held.
+            The latest listing of a folder wins, and the dates cataloged
+            by add_folder since then are added to it.
+
+            Returns:
+                Dictionary of records by folder
+        """
+        if self.locations is not None:
+            return self.locations
+        locations = {}
+        path = self.get_locations_path()
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "locations" in record:
+                        record["dates"] = set(record["dates"])
+                        locations[record["folder"]] = record
+                    else:
+                        locations.setdefault(record["folder"], {
+                            "dates": set()})["dates"].add(record["date"])
+        self.locations = locations
+        return locations
+
+    def get_catalog_path(self, date):
+        return os.path.join(self.catalog_folder, "{}.jsonl".format(date))
+
+    def read_date(self, date):
+        """
+            Reads the entries of a date. Runs with the lock held.
+
+            Returns:
+                Dictionary of entries by folder
+        """
+        entries = self.dates.get(date)
+        if entries is not None:
+            return entries
+        entries = {}
+        path = self.get_catalog_path(date)
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partially written last line of a crashed run
+                        continue
+                    entries[entry["folder"]] = entry
+        self.dates[date] = entries
+        return entries
+
+    def get_entry(self, relative_folder):
+        """
+            Builds the entry of a folder from the files on disk.
+
+            Parameters:
+                relative_folder: Path of the folder relative to
+                    data/cowin, separated by /
+            Returns:
+                Entry dictionary, or None if the path is not a location
+                data folder
+        """
+        location = get_folder_location(relative_folder)
+        if not location:
+            return None
+        location_type, location_id, date = location
+        folder = os.path.join(self.data_folder, *relative_folder.split("/"))
+        files = []
+        with os.scandir(folder) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_file() and dir_entry.name.endswith(".csv"):
+                    stat = dir_entry.stat()
+                    files.append({"name": dir_entry.name,
+                                  "size": stat.st_size,
+                                  "modified": stat.st_mtime_ns})
+        return {"folder": relative_folder, "date": date,
+                "location_type": location_type, "location_id": location_id,
+                "files": sorted(files, key=lambda file: file["name"]),
+                "cataloged_at": datetime.now().isoformat(timespec="seconds")}
+
+    def get_relative_folder(self, folder):
+        """
+            Gets the path of a folder relative to data/cowin, separated
+            by /, or None if the folder is outside data/cowin.
+        """
+        relative_folder = os.path.relpath(
+            os.path.abspath(folder), os.path.abspath(self.data_folder))
+        if relative_folder == os.pardir or \
+                relative_folder.startswith(os.pardir + os.path.sep):
+            return None
+        return relative_folder.replace(os.path.sep, "/")
+
+    def has_folder(self, folder):
+        relative_folder = self.get_relative_folder(folder)
+        location = relative_folder and get_folder_location(relative_folder)
+        if not location:
+            return False
+        with self.lock:
+            return relative_folder in self.read_date(location[2])
+
+    def add_folder(self, folder):
+        """
+            Records a folder written by an extractor.
+
+            Parameters:
+                folder: Path of the location data folder in data/cowin
+        """
+        relative_folder = self.get_relative_folder(folder)
+        if relative_folder is None:
+            # Written for another data folder, e.g. by the benchmarks
+            return
+        entry = self.get_entry(relative_folder)
+        if not entry:
+            logging.warning("Not a location data folder: {}".format(folder))
+            return
+        parent = relative_folder.rpartition("/")[0]
+        with self.lock:
+            self.record_entry(entry)
+            self.read_locations().setdefault(parent, {"dates": set()})[
+                "dates"].add(entry["date"])
+            with open(self.get_locations_path(), "a") as file:
+                file.write(json.dumps(
+                    {"folder": parent, "date": entry["date"]}) + "\n")
+
+    def record_entry(self, entry):
+        """
+            Appends the entry of a folder to the catalog of its date.
+            Runs with the lock held.
+        """
+        self.read_date(entry["date"])[entry["folder"]] = entry
+        os.makedirs(self.catalog_folder, exist_ok=True)
+        with open(self.get_catalog_path(entry["date"]), "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    def refresh_entries(self, entries):
+        """
+            Signs the files of cataloged folders again and records the
+            entries of the folders whose files changed, e.g. CSV files
+            rewritten outside the extractors, which do not change the
+            location folders that update lists.
+
+            Parameters:
+                entries: Entries returned by get_entries
+            Returns:
+                List of the current entries of the folders which still
+                exist
+        """
+        current = []
+        changed = 0
+        for entry in entries:
+            try:
+                new_entry = self.get_entry(entry["folder"])
+            except FileNotFoundError:
+                logging.warning("Cataloged folder {} no longer exists".format(
+                    entry["folder"]))
+                continue
+            if new_entry["files"] == entry["files"]:
+                current.append(entry)
+                continue
+            with self.lock:
+                self.record_entry(new_entry)
+            current.append(new_entry)
+            changed += 1
+        if changed:
+            logging.info("Cataloged {} folders changed since they were "
+                         "cataloged".format(changed))
+        return current
+
+    def get_catalog_dates(self):
+        if not self.exists():
+            return []
+        return sorted(file_name[:-len(".jsonl")]
+                      for file_name in os.listdir(self.catalog_folder)
+                      if file_name.endswith(".jsonl") and
+                      DATE_FOLDER_PATTERN.match(file_name[:-len(".jsonl")]))
+
+    def get_entries(self, start_date=None, end_date=None, location_type=None,
+                    location_ids=None):
+        """
+            Gets the entries of the folders for a date range and
+            location.
+
+            Parameters:
+                start_date: Optional first date, inclusive
+                end_date: Optional last date, inclusive
+                location_type: Optional location type
+                location_ids: Optional set of location IDs
+            Returns:
+                List of entries, ordered by date and folder
+        """
+        entries = []
+        for date in self.get_catalog_dates():
+            if (start_date and date < start_date) or \
+                    (end_date and date > end_date):
+                continue
+            with self.lock:
+                date_entries = list(self.read_date(date).values())
+            for entry in sorted(date_entries, key=lambda entry: entry["folder"]):
+                if location_type and entry["location_type"] != location_type:
+                    continue
+                if location_ids and entry["location_id"] not in location_ids:
+                    continue
+                entries.append(entry)
+        return entries
+
+    def iter_data_folders(self, relative_folder=""):
+        """
+            Finds the location data folders on disk, descending only
+            into state, district and date folders.
+
+            Returns:
+                Generator of folder paths relative to data/cowin
+        """
+        folder = os.path.join(self.data_folder, *relative_folder.split("/")) \
+            if relative_folder else self.data_folder
+        with os.scandir(folder) as dir_entries:
+            names = sorted(dir_entry.name for dir_entry in dir_entries
+                           if dir_entry.is_dir())
+        for name in names:
+            child = "{}/{}".format(relative_folder, name) \
+                if relative_folder else name
+            if DATE_FOLDER_PATTERN.match(name):
+                yield child
+            elif LOCATION_FOLDER_PATTERN.match(name):
+                yield from self.iter_data_folders(child)
+
+    def update(self):
+        """
+            Catalogs the date folders which are not in the catalog, e.g.
+            copied into data/cowin or written by other scripts. Only the
+            location folders modified since they were last listed are
+            listed again, and their date folders are compared with the
+            dates cataloged for them.
+
+            Returns:
+                Number of folders cataloged
+        """
+        if not os.path.exists(self.data_folder):
+            return 0
+        with self.lock:
+            locations = dict(self.read_locations())
+        added = 0
+        listed = []
+        pending = [""]
+        while pending:
+            relative_folder = pending.pop()
+            folder = os.path.join(self.data_folder, *relative_folder.split("/")) \
+                if relative_folder else self.data_folder
+            try:
+                # Read before listing, so that a folder modified while it
+                # is listed is listed again by the next update
+                modified = os.stat(folder).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            record = locations.get(relative_folder, {})
+            children = record.get("locations")
+            if children is None or record["modified"] != modified:
+                with os.scandir(folder) as dir_entries:
+                    names = sorted(dir_entry.name for dir_entry in dir_entries
+                                   if dir_entry.is_dir())
+                children = [name for name in names
+                            if LOCATION_FOLDER_PATTERN.match(name)]
+                dates = set(name for name in names
+                            if DATE_FOLDER_PATTERN.match(name))
+                for date in sorted(dates - record.get("dates", set())):
+                    child = "{}/{}".format(relative_folder, date) \
+                        if relative_folder else date
+                    # Folders listed for the first time may be cataloged
+                    with self.lock:
+                        cataloged = child in self.read_date(date)
+                    if not cataloged:
+                        self.add_folder(os.path.join(folder, date))
+                        added += 1
+                listed.append({"folder": relative_folder, "modified": modified,
+                               "locations": children, "dates": dates})
+            pending += ["{}/{}".format(relative_folder, name)
+                        if relative_folder else name for name in children]
+        if listed:
+            with self.lock:
+                locations = self.read_locations()
+                for record in listed:
+                    # Keeps the dates cataloged while the folder was listed
+                    record["dates"] |= locations.get(
+                        record["folder"], {}).get("dates", set())
+                    locations[record["folder"]] = record
+                os.makedirs(self.catalog_folder, exist_ok=True)
+                with atomic_file(self.get_locations_path()) as file:
+                    for record in locations.values():
+                        file.write(json.dumps(
+                            dict(record, dates=sorted(record["dates"]))) + "\n")
+        if added:
+            logging.info("Cataloged {} folders missing from the catalog".format(
+                added))
+        return added
+
+    def rebuild(self):
+        """
+            Rebuilds the catalog from the folders on disk, for the
+            folders written before the catalog or by other means.
+
+            Returns:
+                Number of folders cataloged
+        """
+        dates = {}
+        if os.path.exists(self.data_folder):
+            for relative_folder in self.iter_data_folders():
+                entry = self.get_entry(relative_folder)
+                if entry:
+                    dates.setdefault(entry["date"], []).append(entry)
+        with self.lock:
+            os.makedirs(self.catalog_folder, exist_ok=True)
+            for date in self.get_catalog_dates():
+                if date not in dates:
+                    os.remove(self.get_catalog_path(date))
+            for date, entries in dates.items():
+                with atomic_file(self.get_catalog_path(date)) as file:
+                    for entry in entries:
+                        file.write(json.dumps(entry) + "\n")
+            self.dates = {date: {entry["folder"]: entry for entry in entries}
+                          for date, entries in dates.items()}
+            if os.path.exists(self.get_locations_path()):
+                os.remove(self.get_locations_path())
+            self.locations = None
+        count = sum(len(entries) for entries in dates.values())
+        logging.info("Cataloged {} folders of {} dates".format(
+            count, len(dates)))
+        # Records the location folders, which are all cataloged
+        self.update()
+        return count
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    args = sys.argv
+    catalog = DataCatalog()
+    if len(args) >= 2 and args[1] == "rebuild":
+        catalog.rebuild()
+    elif len(args) >= 2 and args[1] == "update":
+        catalog.update()
+    else:
+        start_date = args[1] if len(args) >= 2 else None
+        end_date = args[2] if len(args) >= 3 else start_date
+        for entry in catalog.get_entries(start_date, end_date):
+            print("{date} {location_type} {location_id} {folder} "
+                  "{}".format(len(entry["files"]), **entry))
@@ -1,5 +1,13 @@
 import os
 import csv
+import json
+import logging
+import time
+import threading
+import ijson
+from ijson.common import ObjectBuilder
+from checkpoint import atomic_file, CONVERTED
+from instrumentation import metrics
 
 DATA_MAPPING = {
     "vaccination_site_count": {
@@ -84,19 +92,22 @@ DATA_MAPPING = {
         "type": "object_list",
         # "columns": ["state_id", "state_name", "total", "partial_vaccinated", "totally_vaccinated", "today"],
         "exclude_columns": ["title"],
-        "path": "getBeneficiariesGroupBy"
+        "path": "getBeneficiariesGroupBy",
+        "stream": True
     },
     "district_level_vaccination_count": {
         "location_type": "state",
         "type": "object_list",
         # "columns": ["state_id", "district_id", "district_name", "total", "partial_vaccinated", "totally_vaccinated", "today"],
-        "path": "getBeneficiariesGroupBy"
+        "path": "getBeneficiariesGroupBy",
+        "stream": True
     },
     "site_level_vaccination_count": {
         "location_type": "district",
         "type": "object_list",
         # "columns": ["session_site_id", "session_site_name", "total", "partial_vaccinated", "totally_vaccinated", "today"],
-        "path": "getBeneficiariesGroupBy"
+        "path": "getBeneficiariesGroupBy",
+        "stream": True
     }
 }
 
@@ -126,6 +137,48 @@ def get_nested_object(obj, path_key):
     return value
 
 
+def get_columns(config, obj):
+    """
+        Gets the columns that needs to be extracted for a mapping.
+
+        Parameters:
+            config: Mapping configuration from DATA_MAPPING
+            obj: JSON object used to infer the columns
+                when they are not configured
+        Returns:
+            List of column names
+    """
+    columns = config.get("columns")
+    exclude_columns = config.get("exclude_columns")
+    if not columns:
+        columns = list(obj.keys())
+    if exclude_columns:
+        columns = [column for column in columns
+                   if column not in exclude_columns]
+    return columns
+
+
+def get_rows(obj, mapping_type, config):
+    """
+        Extracts the rows of a mapping from the JSON object.
+
+        Parameters:
+            obj: JSON object or array of objects of the mapping path
+            mapping_type: object or object_list
+            config: Mapping configuration from DATA_MAPPING
+        Returns:
+            Tuple of columns and list of rows
+    """
+    if mapping_type == "object":
+        obj_list = [obj]
+    else:
+        obj_list = obj
+    sample = obj_list[0] if len(obj_list) > 0 else {}
+    columns = get_columns(config, sample)
+    rows = [[obj.get(column) for column in columns] for obj in obj_list]
+    return columns, rows
+
+
 def convert_object_to_csv(obj, date, config, file_path):
     """
         Converts JSON object into a single row CSV file.
@@ -136,19 +189,8 @@ def convert_object_to_csv(obj, date, config, file_path):
             configuration: List of fields that needs to be extracted.
             file_path: Location where the CSV file needs to be saved.
     """
-    columns = config.get("columns")
-    exclude_columns = config.get("exclude_columns")
-    if not columns:
-        columns = list(obj.keys())
-    if exclude_columns:
-        for column in exclude_columns:
-            if column in columns:
-                columns.remove(column)
-    with open(file_path, 'w', newline='') as csvfile:
-        csv_writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        csv_writer.writerow(["date", *columns])
-        data = map(lambda column: obj.get(column), columns)
-        csv_writer.writerow([date, *data])
+    columns, rows = get_rows(obj, "object", config)
+    write_csv(file_path, date, columns, rows)
 
 
 def convert_object_array_to_csv(obj_list, date, config, file_path):
@@ -161,24 +203,42 @@ def convert_object_array_to_csv(obj_list, date, config, file_path):
             columns: List of fields that needs to be extracted.
             file_path: Location where the CSV file needs to be saved.
     """
-    columns = config.get("config")
-    exclude_columns = config.get("exclude_columns")
-    if not columns:
-        obj = obj_list[0] if len(obj_list) > 0 else {}
-        columns = list(obj.keys())
-    if exclude_columns:
-        for column in exclude_columns:
-            if column in columns:
-                columns.remove(column)
-    with open(file_path, 'w', newline='') as csvfile:
-        csv_writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        csv_writer.writerow(["date", *columns])
-        for obj in obj_list:
-            data = map(lambda column: obj.get(column), columns)
-            csv_writer.writerow([date, *data])
+    columns, rows = get_rows(obj_list, "object_list", config)
+    write_csv(file_path, date, columns, rows)
+
+
+def get_data_type(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def write_csv(file_path, date, columns, rows):
+    data_type = get_data_type(file_path)
+    with metrics.stage("csv_write", data_type=data_type):
+        with open(file_path, 'w', newline='') as csvfile:
+            csv_writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+            csv_writer.writerow(["date", *columns])
+            for row in rows:
+                csv_writer.writerow([date, *row])
+    metrics.increment("csv_rows_written", len(rows), data_type=data_type)
+
+
+def get_location_mappings(location_type):
+    """
+        Gets the DATA_MAPPING entries applicable for a location type.
+
+        Parameters:
+            location_type: E.g. national, state, district
+        Returns:
+            Generator of data type and mapping configuration
+    """
+    for data_type, config in DATA_MAPPING.items():
+        c_location_type = config.get("location_type")
+        if c_location_type and c_location_type != location_type:
+            continue
+        yield data_type, config
 
 
-def convert_data(location_type, folder, data):
+def convert_data(location_type, folder, data, skip_data_types=()):
     """
         Converts JSON data fetched from COWIN Dashboard website
         into multiple csv files based on data. Uses mapping
@@ -189,17 +249,320 @@ def convert_data(location_type, folder, data):
             location_type: Location Type for which the data is retreived.
             folder: Output folder path for CSV files.
             data: JSON data retreived from COWIN website
+            skip_data_types: DATA_MAPPING entries that are already converted
     """
-    for data_type, config in DATA_MAPPING.items():
-        c_location_type = config.get("location_type")
-        if c_location_type and c_location_type != location_type:
-            continue
-        mapping_type = config["type"]
-        obj = get_nested_object(data, config["path"])
-        file_path = os.path.join(folder, "{}.csv".format(data_type))
-        if mapping_type == "object":
-            convert_object_to_csv(
-                obj, data["date"], config, file_path)
-        elif mapping_type == "object_list":
-            convert_object_array_to_csv(
-                obj, data["date"], config, file_path)
+    with metrics.stage("convert", location_type=location_type):
+        for data_type, config in get_location_mappings(location_type):
+            if data_type in skip_data_types:
+                continue
+            mapping_type = config["type"]
+            obj = get_nested_object(data, config["path"])
+            file_path = os.path.join(folder, "{}.csv".format(data_type))
+            if mapping_type == "object":
+                convert_object_to_csv(
+                    obj, data["date"], config, file_path)
+            elif mapping_type == "object_list":
+                convert_object_array_to_csv(
+                    obj, data["date"], config, file_path)
+
+
+def iter_payload_stream(stream, streamed_keys):
+    """
+        Parses COWIN JSON payload incrementally. Arrays of the streamed
+        keys are returned one item at a time, so only a single item is
+        held in memory. Values of the other top level keys are returned
+        as a whole.
+
+        Parameters:
+            stream: Binary file like object of the JSON payload
+            streamed_keys: Top level keys whose array items are streamed
+        Returns:
+            Generator of (kind, key, value) tuples where kind is "item"
+            for an item of a streamed array or "value" for a top level value
+    """
+    key = None
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if depth == 0:
+            if prefix == "" and event == "map_key":
+                key = value
+                continue
+            if prefix == "" or (key in streamed_keys and prefix == key):
+                # Start/end of the payload or of a streamed array
+                continue
+            builder = ObjectBuilder()
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            kind = "item" if key in streamed_keys and prefix != key else "value"
+            yield kind, key, builder.value
+            builder = None
+
+
+class CsvRowWriter:
+    """
+        Writes rows of a DATA_MAPPING object list into a CSV file as the
+        objects arrive. Columns are inferred from the first object.
+    """
+
+    def __init__(self, file_path, date, config):
+        self.file_path = file_path
+        self.date = date
+        self.config = config
+        self.file = None
+        self.csv_writer = None
+        self.columns = None
+        self.rows = 0
+        self.write_seconds = 0.0
+
+    def write(self, obj):
+        started_at = time.perf_counter()
+        if self.file is None:
+            self.columns = get_columns(self.config, obj)
+            self.file = open(self.file_path, 'w', newline='')
+            self.csv_writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL)
+            self.csv_writer.writerow(["date", *self.columns])
+        self.csv_writer.writerow(
+            [self.date, *[obj.get(column) for column in self.columns]])
+        self.rows += 1
+        self.write_seconds += time.perf_counter() - started_at
+
+    def close(self):
+        if self.file is None:
+            write_csv(self.file_path, self.date,
+                      get_columns(self.config, {}), [])
+            return
+        self.file.close()
+        data_type = get_data_type(self.file_path)
+        # Rows are timed together, as a stage per row would cost more
+        # than writing the row
+        metrics.observe("stage_seconds", self.write_seconds,
+                        stage="csv_write", data_type=data_type)
+        metrics.increment("csv_rows_written", self.rows, data_type=data_type)
+
+
+def convert_data_stream(location_type, folder, date, stream):
+    """
+        Converts JSON data fetched from COWIN Dashboard website into
+        csv files while the payload is being read. Rows of the mappings
+        marked with stream in DATA_MAPPING are written as they are
+        parsed, so peak memory does not depend on the number of sites.
+        The output is the same as convert_data.
+
+        Parameters:
+            location_type: Location Type for which the data is retreived.
+            folder: Output folder path for CSV files.
+            date: Date for which the data is retreived
+            stream: Binary file like object of the JSON payload
+    """
+    row_writers = {}
+    for data_type, config in get_location_mappings(location_type):
+        if config.get("stream"):
+            file_path = os.path.join(folder, "{}.csv".format(data_type))
+            row_writers[config["path"]] = (
+                data_type, CsvRowWriter(file_path, date, config))
+    data = {}
+    with metrics.stage("convert_stream", location_type=location_type):
+        try:
+            for kind, key, value in iter_payload_stream(stream, row_writers):
+                if kind == "item":
+                    row_writers[key][1].write(value)
+                else:
+                    data[key] = value
+        finally:
+            for data_type, row_writer in row_writers.values():
+                row_writer.close()
+    data["date"] = date
+    convert_data(location_type, folder, data,
+                 [data_type for data_type, _ in row_writers.values()])
+    return data
+
+
+def read_header(file_path):
+    with open(file_path, newline='') as csvfile:
+        return next(csv.reader(csvfile))
+
+
+class ConsolidatedWriter:
+    """
+        Writes the rows of all the locations of a date into a single
+        CSV file per DATA_MAPPING entry, with location_type and
+        location_id columns added in front of the date column.
+
+        Rows are buffered and flushed at every checkpoint, along with
+        the file sizes and the locations written so far. When a date is
+        resumed after a crash, the files are truncated back to the last
+        checkpoint so that uncommitted locations are not duplicated.
+
+        The header of a file has the columns of the first location
+        written. Columns which a later location adds are appended to the
+        header, and the file is rewritten with empty values for them.
+    """
+    STATE_FILE_NAME = ".state.json"
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, folder, manifest=None, checkpoint_every=50):
+        """
+            Parameters:
+                folder: Output folder of the date
+                manifest: Optional checkpoint manifest which is updated
+                    with the locations committed by the writer
+                checkpoint_every: Number of locations written between
+                    checkpoints
+        """
+        self.folder = folder
+        self.manifest = manifest
+        self.checkpoint_every = checkpoint_every
+        self.lock = threading.Lock()
+        self.files = {}
+        self.pending = []
+        os.makedirs(folder, exist_ok=True)
+        self.state_path = os.path.join(folder, self.STATE_FILE_NAME)
+        state = {"sizes": {}, "locations": []}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as file:
+                state = json.load(file)
+        self.sizes = state["sizes"]
+        self.columns = state.get("columns", {})
+        self.locations = set(state["locations"])
+        self.restore()
+
+    def restore(self):
+        for file_name in os.listdir(self.folder):
+            if not file_name.endswith(".csv"):
+                continue
+            size = self.sizes.get(file_name, 0)
+            file_path = os.path.join(self.folder, file_name)
+            if size and file_name in self.columns and \
+                    read_header(file_path)[3:] != self.columns[file_name]:
+                # Widened after the last checkpoint, which was taken
+                # right before, so the file has only checkpointed rows
+                self.sizes[file_name] = os.path.getsize(file_path)
+                continue
+            if os.path.getsize(file_path) != size:
+                logging.warning("Truncating '{}' to last checkpoint".format(
+                    file_path))
+                os.truncate(file_path, size)
+        if self.manifest:
+            for key in self.locations:
+                if self.manifest.get_status(key) != CONVERTED:
+                    self.manifest.update(key, CONVERTED)
+
+    def has_location(self, key):
+        return key in self.locations
+
+    def open_file(self, data_type, columns):
+        file_name = "{}.csv".format(data_type)
+        file_path = os.path.join(self.folder, file_name)
+        if self.sizes.get(file_name):
+            columns = read_header(file_path)[3:]
+            file = open(file_path, "a", newline='', buffering=self.BUFFER_SIZE)
+            csv_writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+        else:
+            file = open(file_path, "w", newline='', buffering=self.BUFFER_SIZE)
+            csv_writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+            csv_writer.writerow(
+                ["location_type", "location_id", "date", *columns])
+        entry = {"file_name": file_name, "file": file,
+                 "writer": csv_writer, "columns": columns}
+        self.files[data_type] = entry
+        return entry
+
+    def widen(self, entry, columns):
+        """
+            Rewrites the file of a data type with the columns it does
+            not have yet appended to its header. The rows already
+            written have empty values for them.
+        """
+        added = [column for column in columns
+                 if column not in entry["columns"]]
+        logging.info("Adding columns {} to '{}'".format(
+            ", ".join(added), entry["file_name"]))
+        file_path = os.path.join(self.folder, entry["file_name"])
+        entry["file"].close()
+        with open(file_path, newline='') as csvfile, \
+                atomic_file(file_path) as file:
+            reader = csv.reader(csvfile)
+            csv_writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+            csv_writer.writerow(next(reader) + added)
+            padding = [None] * len(added)
+            csv_writer.writerows(row + padding for row in reader)
+        entry["columns"] = entry["columns"] + added
+        entry["file"] = open(file_path, "a", newline='',
+                             buffering=self.BUFFER_SIZE)
+        entry["writer"] = csv.writer(entry["file"], quoting=csv.QUOTE_MINIMAL)
+
+    def write(self, key, location_type, location_id, data):
+        """
+            Writes the rows of a location.
+
+            Parameters:
+                key: Checkpoint key of the location
+                location_type: E.g. national, state, district
+                location_id: ID of the location. ID for national will be 0.
+                data: JSON data retreived from COWIN website
+        """
+        prefix = [location_type, location_id, data["date"]]
+        location_rows = []
+        with metrics.stage("convert", location_type=location_type):
+            for data_type, config in get_location_mappings(location_type):
+                obj = get_nested_object(data, config["path"])
+                if not obj:
+                    continue
+                columns, rows = get_rows(obj, config["type"], config)
+                if rows and columns:
+                    location_rows.append((data_type, columns, rows))
+        with self.lock:
+            widened = []
+            for data_type, columns, rows in location_rows:
+                entry = self.files.get(data_type)
+                if not entry:
+                    entry = self.open_file(data_type, columns)
+                if not set(columns).issubset(entry["columns"]):
+                    widened.append((entry, columns))
+            if widened:
+                # The files are rewritten right after a checkpoint, so
+                # that they have only checkpointed rows
+                self.checkpoint()
+                for entry, columns in widened:
+                    self.widen(entry, columns)
+                self.checkpoint()
+            for data_type, columns, rows in location_rows:
+                entry = self.files[data_type]
+                if columns != entry["columns"]:
+                    indexes = [columns.index(column) if column in columns else None
+                               for column in entry["columns"]]
+                    rows = [[row[index] if index is not None else None
+                             for index in indexes] for row in rows]
+                entry["writer"].writerows([prefix + row for row in rows])
+                metrics.increment("csv_rows_written", len(rows),
+                                  data_type=data_type)
+            self.pending.append(key)
+            if len(self.pending) >= self.checkpoint_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        for entry in self.files.values():
+            entry["file"].flush()
+            self.sizes[entry["file_name"]] = os.fstat(
+                entry["file"].fileno()).st_size
+            self.columns[entry["file_name"]] = entry["columns"]
+        self.locations.update(self.pending)
+        with atomic_file(self.state_path) as file:
+            json.dump({"sizes": self.sizes, "columns": self.columns,
+                       "locations": sorted(self.locations)}, file)
+        if self.manifest:
+            for key in self.pending:
+                self.manifest.update(key, CONVERTED)
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.checkpoint()
+            for entry in self.files.values():
+                entry["file"].close()
+            self.files = {}
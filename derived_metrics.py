@@ -0,0 +1,264 @@
+import os
+import time
+import logging
+import numpy
+from sqlite_utils import Database
+from table_schema import INTEGER, REAL, TEXT, DATE
+
+DB_FILE_NAME = "covid-ds.db"
+
+VACCINATION_TABLE = "raw_vaccination_count"
+AGE_TABLE = "raw_vaccination_by_age"
+
+DAILY_METRICS_TABLE = "metrics_daily_vaccination"
+AGE_METRICS_TABLE = "metrics_age_band_share"
+
+KEY_COLUMNS = {"location_type": TEXT, "location_id": INTEGER, "date": DATE}
+
+# Cumulative counts of raw_vaccination_count and the suffix of their
+# metric columns
+SERIES_COLUMNS = {"total": "total", "tot_dose_1": "dose_1",
+                  "tot_dose_2": "dose_2"}
+
+AGE_BAND_COLUMNS = ["vac_18_30", "vac_30_45", "vac_45_60", "above_60"]
+
+ROLLING_WINDOW_DAYS = 7
+
+# Like the rollup tables, the metrics tables are written only by this
+# module and have no type constraints. Rows are written in key order,
+# so they are appended to the clustered key.
+CREATE_METRICS_SQL = """CREATE TABLE [{table}] (
+   {columns},
+   PRIMARY KEY ([location_type], [location_id], [date])
+) WITHOUT ROWID"""
+
+
+def read_series(db, table, columns):
+    """
+        Reads the time series of all the locations of a table in a
+        single query.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Table with location_type, location_id and date columns
+            columns: Value columns to be read
+        Returns:
+            Dictionary of arrays by column, ordered by location and date,
+            or None if the table has no rows. Missing values are NaN.
+    """
+    rows = db.execute(
+        "SELECT location_type, location_id, date, {} FROM [{}] "
+        "ORDER BY location_type, location_id, date".format(
+            ", ".join("[{}]".format(column) for column in columns),
+            table)).fetchall()
+    if not rows:
+        return None
+    location_types, location_ids, dates, *values = zip(*rows)
+    series = {
+        "location_type": numpy.array(location_types, dtype=object),
+        "location_id": numpy.array(location_ids, dtype=numpy.int64),
+        "date": numpy.array(dates, dtype="datetime64[D]")
+    }
+    for column, column_values in zip(columns, values):
+        series[column] = numpy.array(column_values, dtype=numpy.float64)
+    return series
+
+
+def get_location_starts(series):
+    """
+        Gets the rows which start the time series of a location.
+
+        Returns:
+            Boolean array
+    """
+    starts = numpy.ones(len(series["date"]), dtype=bool)
+    starts[1:] = (series["location_type"][1:] != series["location_type"][:-1]) | \
+        (series["location_id"][1:] != series["location_id"][:-1])
+    return starts
+
+
+def get_daily_deltas(values, starts):
+    """
+        Gets the change of cumulative counts since the previous date of
+        the location. The first date of a location has no delta.
+    """
+    deltas = numpy.empty_like(values)
+    deltas[1:] = values[1:] - values[:-1]
+    deltas[starts] = numpy.nan
+    return deltas
+
+
+def get_rolling_averages(values, starts, days, window=ROLLING_WINDOW_DAYS):
+    """
+        Gets the average daily change of cumulative counts over the
+        window ending at every date. The counts of the locations are
+        laid out on a grid of locations and calendar days and carried
+        forward over the days without data, so a gap in the data spreads
+        its change over the days of the gap.
+
+        Parameters:
+            values: Cumulative counts, ordered by location and date
+            starts: Rows which start the time series of a location
+            days: Day number of every row
+            window: Number of days
+        Returns:
+            Array of averages, NaN for the dates less than a window
+            after the first count of the location
+    """
+    locations = numpy.cumsum(starts) - 1
+    grid = numpy.full((locations[-1] + 1, days.max() + 1), numpy.nan)
+    grid[locations, days] = values
+    # Day of the latest count at or before every day of the grid
+    known_days = numpy.where(
+        numpy.isnan(grid), -1, numpy.arange(grid.shape[1]))
+    known_days = numpy.maximum.accumulate(known_days, axis=1)
+
+    previous_days = days - window
+    averages = numpy.full(len(values), numpy.nan)
+    valid = previous_days >= 0
+    base_days = numpy.full(len(values), -1)
+    base_days[valid] = known_days[locations[valid], previous_days[valid]]
+    valid &= base_days >= 0
+    averages[valid] = (values[valid] - grid[locations[valid],
+                                            base_days[valid]]) / \
+        (days[valid] - base_days[valid])
+    return averages
+
+
+def get_daily_metrics(series):
+    """
+        Computes the daily metrics of all the locations of
+        raw_vaccination_count.
+
+        Returns:
+            Dictionary of metric arrays by column
+    """
+    starts = get_location_starts(series)
+    days = (series["date"] - series["date"].min()).astype(numpy.int64)
+    metrics = {}
+    for column, suffix in SERIES_COLUMNS.items():
+        metrics["daily_" + suffix] = get_daily_deltas(series[column], starts)
+    for column, suffix in SERIES_COLUMNS.items():
+        metrics["avg{}_{}".format(ROLLING_WINDOW_DAYS, suffix)] = \
+            get_rolling_averages(series[column], starts, days)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        metrics["dose_2_coverage"] = numpy.where(
+            series["tot_dose_1"] > 0,
+            series["tot_dose_2"] / series["tot_dose_1"], numpy.nan)
+    return metrics
+
+
+def get_age_metrics(series, bands):
+    """
+        Computes the share of every age band in the vaccinations of all
+        the locations of raw_vaccination_by_age.
+
+        Returns:
+            Dictionary of metric arrays by column
+    """
+    band_totals = numpy.nansum(
+        numpy.stack([series[band] for band in bands]), axis=0)
+    metrics = {}
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        for band in bands:
+            metrics["share_" + band] = numpy.where(
+                band_totals > 0, series[band] / band_totals, numpy.nan)
+    return metrics
+
+
+def to_column_values(values, column_type):
+    """
+        Converts an array into a list of Python values of a column
+        type, with None for NaN.
+    """
+    missing = numpy.isnan(values)
+    if column_type == INTEGER:
+        values = numpy.where(missing, 0, numpy.round(values)).astype(
+            numpy.int64)
+    column_values = values.astype(object)
+    column_values[missing] = None
+    return column_values.tolist()
+
+
+def write_metrics(db, table, series, metrics, column_types):
+    """
+        Replaces a metrics table with the metrics of all the locations
+        in a single transaction.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Name of the metrics table
+            series: Series dictionary returned by read_series
+            metrics: Dictionary of metric arrays by column
+            column_types: Dictionary of column types by metric column
+        Returns:
+            Number of rows written
+    """
+    column_types = {**KEY_COLUMNS, **column_types}
+    columns = [series["location_type"].tolist(),
+               series["location_id"].tolist(),
+               numpy.datetime_as_string(series["date"]).tolist()]
+    columns += [to_column_values(metrics[column], column_type)
+                for column, column_type in column_types.items()
+                if column not in KEY_COLUMNS]
+    with db.conn:
+        # The sqlite3 module begins transactions only before DML, so the
+        # table would be dropped and created outside of it
+        db.execute("BEGIN")
+        db.execute("DROP TABLE IF EXISTS [{}]".format(table))
+        db.execute(CREATE_METRICS_SQL.format(table=table, columns=",\n   ".join(
+            "[{}] {}".format(column, column_type)
+            for column, column_type in column_types.items())))
+        db.conn.executemany("INSERT INTO [{}] VALUES ({})".format(
+            table, ", ".join("?" * len(column_types))), zip(*columns))
+    return len(series["date"])
+
+
+def update_derived_metrics(db):
+    """
+        Recomputes the derived metrics of all the locations and dates
+        from the raw time series.
+
+        metrics_daily_vaccination has the daily new doses, the 7 day
+        rolling averages of the daily new doses and the share of the
+        first dose recipients who got the second dose.
+        metrics_age_band_share has the share of every age band in the
+        vaccinations.
+
+        Parameters:
+            db: Sqlite database connection
+    """
+    started_at = time.monotonic()
+    rows = 0
+    vaccination_columns = db[VACCINATION_TABLE].columns_dict \
+        if db[VACCINATION_TABLE].exists() else {}
+    if set(SERIES_COLUMNS).issubset(vaccination_columns):
+        series = read_series(db, VACCINATION_TABLE, list(SERIES_COLUMNS))
+        if series:
+            column_types = {"daily_" + suffix: INTEGER
+                            for suffix in SERIES_COLUMNS.values()}
+            column_types.update({
+                "avg{}_{}".format(ROLLING_WINDOW_DAYS, suffix): REAL
+                for suffix in SERIES_COLUMNS.values()})
+            column_types["dose_2_coverage"] = REAL
+            rows += write_metrics(db, DAILY_METRICS_TABLE, series,
+                                  get_daily_metrics(series), column_types)
+
+    age_columns = db[AGE_TABLE].columns_dict if db[AGE_TABLE].exists() else {}
+    bands = [band for band in AGE_BAND_COLUMNS if band in age_columns]
+    if bands:
+        series = read_series(db, AGE_TABLE, bands)
+        if series:
+            rows += write_metrics(
+                db, AGE_METRICS_TABLE, series, get_age_metrics(series, bands),
+                {"share_" + band: REAL for band in bands})
+    logging.info("Computed {} rows of derived metrics in {:.1f}s".format(
+        rows, time.monotonic() - started_at))
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    db = Database(os.path.join(folder, DB_FILE_NAME))
+    update_derived_metrics(db)
+    db.conn.close()
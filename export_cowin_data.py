@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import datetime
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from sqlite_utils import Database
+from checkpoint import atomic_folder
+from table_schema import TableSchema, INTEGER, REAL, TEXT, DATE
+from load_cowin_data_sqlite import TABLE_FILE_MAPPING, DB_FILE_NAME
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+EXPORT_FOLDER_PATH = os.path.join("data", "export")
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+COMPRESSION = "zstd"
+
+BATCH_SIZE = 100000
+
+ARROW_TYPES = {
+    INTEGER: pyarrow.int64(),
+    REAL: pyarrow.float64(),
+    TEXT: pyarrow.string(),
+    DATE: pyarrow.date32()
+}
+
+FILE_EXTENSIONS = {
+    "parquet": "parquet",
+    "arrow": "arrow"
+}
+
+
+def get_arrow_schema(column_types, exclude_columns=()):
+    return pyarrow.schema([
+        (column, ARROW_TYPES[column_type])
+        for column, column_type in column_types.items()
+        if column not in exclude_columns])
+
+
+def get_partitions(db, table, partition_columns):
+    """
+        Gets the month and location type partitions of a table.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Table name
+            partition_columns: Partition columns of the table
+        Returns:
+            List of partition values dictionaries
+    """
+    select = ["substr(date, 1, 7) AS month"]
+    if "location_type" in partition_columns:
+        select.append("location_type")
+    cursor = db.execute("SELECT DISTINCT {} FROM [{}] ORDER BY {}".format(
+        ", ".join(select), table,
+        ", ".join(str(index + 1) for index in range(len(select)))))
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def get_partition_path(partition):
+    return os.path.join(*["{}={}".format(column, value)
+                          for column, value in partition.items()])
+
+
+def iter_partition_batches(db, table, columns, column_types, partition):
+    """
+        Reads the rows of a partition as Arrow record batches.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Table name
+            columns: Columns written to the files
+            column_types: Column types of the table
+            partition: Partition values
+        Returns:
+            Generator of record batches
+    """
+    month = partition["month"]
+    year, month_number = map(int, month.split("-"))
+    next_month = "{:04d}-{:02d}".format(
+        year + month_number // 12, month_number % 12 + 1)
+    sql = "SELECT {} FROM [{}] WHERE date >= ? AND date < ?".format(
+        ", ".join("[{}]".format(column) for column in columns), table)
+    params = ["{}-01".format(month), "{}-01".format(next_month)]
+    if "location_type" in partition:
+        sql += " AND location_type = ?"
+        params.append(partition["location_type"])
+    schema = get_arrow_schema(
+        {column: column_types[column] for column in columns})
+    date_columns = [index for index, column in enumerate(columns)
+                    if column_types[column] == DATE]
+    cursor = db.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        values = [list(column) for column in zip(*rows)]
+        for index in date_columns:
+            values[index] = [
+                datetime.date.fromisoformat(value) if value else None
+                for value in values[index]]
+        yield pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(column, type=field.type)
+             for column, field in zip(values, schema)], schema=schema)
+
+
+def write_partition(file_path, schema, batches, output_format):
+    """
+        Writes the record batches of a partition into a compressed
+        Parquet or Arrow IPC file.
+
+        Returns:
+            Number of rows written
+    """
+    rows = 0
+    if output_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(
+            file_path, schema, compression=COMPRESSION)
+    else:
+        writer = pyarrow.ipc.new_file(
+            file_path, schema,
+            options=pyarrow.ipc.IpcWriteOptions(compression=COMPRESSION))
+    with writer:
+        for batch in batches:
+            if output_format == "parquet":
+                writer.write_batch(batch)
+            else:
+                writer.write(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def export_table(db, table_load_info, folder, output_format):
+    """
+        Exports a table into files partitioned by month and, for the
+        tables with location columns, by location type.
+
+        Parameters:
+            db: Sqlite database connection
+            table_load_info: Table load information from TABLE_FILE_MAPPING
+            folder: Export folder of the table
+            output_format: parquet or arrow
+        Returns:
+            Manifest entry of the table
+    """
+    table = table_load_info["table"]
+    column_types = TableSchema.from_table(db, table).column_types
+    partition_columns = ["month"]
+    if table_load_info.get("load_location_columns"):
+        partition_columns.append("location_type")
+    # Partition values are part of the path instead of the files
+    columns = [column for column in column_types
+               if column not in partition_columns]
+    schema = get_arrow_schema(column_types, partition_columns)
+    partitions = []
+    for partition in get_partitions(db, table, partition_columns):
+        path = os.path.join(get_partition_path(partition),
+                            "part-0.{}".format(FILE_EXTENSIONS[output_format]))
+        file_path = os.path.join(folder, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        rows = write_partition(file_path, schema, iter_partition_batches(
+            db, table, columns, column_types, partition), output_format)
+        partitions.append({**partition, "path": path, "rows": rows,
+                           "bytes": os.path.getsize(file_path)})
+    logging.info("Exported {} partitions of {}".format(len(partitions), table))
+    return {
+        "format": output_format,
+        "compression": COMPRESSION,
+        "partitioning": partition_columns,
+        "columns": [{"name": column, "type": str(field.type)}
+                    for column, field in zip(columns, schema)],
+        "partitions": partitions
+    }
+
+
+def export_cowin_data(root_folder, output_format="parquet", output_folder=None):
+    """
+        Exports the tables of TABLE_FILE_MAPPING into partitioned
+        Parquet or Arrow IPC files, with a manifest describing the
+        columns and partitions of every table. The export replaces the
+        previous export of the format once it is complete.
+
+        Parameters:
+            root_folder: Root folder of the project
+            output_format: parquet or arrow
+            output_folder: Export folder. Defaults to
+                data/export/<format>
+    """
+    db = Database(os.path.join(root_folder, DB_FILE_NAME))
+    output_folder = output_folder or os.path.join(
+        root_folder, EXPORT_FOLDER_PATH, output_format)
+    manifest = {"exported_at": datetime.datetime.now().isoformat(
+        timespec="seconds"), "tables": {}}
+    # Leftover of an interrupted export
+    shutil.rmtree(output_folder + ".new", ignore_errors=True)
+    with atomic_folder(output_folder + ".new") as staging:
+        for table_load_info in TABLE_FILE_MAPPING.values():
+            table = table_load_info["table"]
+            if not db[table].exists() or table in manifest["tables"]:
+                continue
+            manifest["tables"][table] = export_table(
+                db, table_load_info, os.path.join(staging, table),
+                output_format)
+        with open(os.path.join(staging, MANIFEST_FILE_NAME), "w") as file:
+            json.dump(manifest, file, indent=2)
+    if os.path.exists(output_folder):
+        os.rename(output_folder, output_folder + ".old")
+    os.rename(output_folder + ".new", output_folder)
+    if os.path.exists(output_folder + ".old"):
+        shutil.rmtree(output_folder + ".old")
+    db.conn.close()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Export covid-ds.db tables into partitioned files")
+    parser.add_argument("--format", dest="output_format", default="parquet",
+                        choices=sorted(FILE_EXTENSIONS))
+    parser.add_argument("--output", dest="output_folder",
+                        help="Export folder, defaults to data/export/<format>")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_args(sys.argv[1:])
+    export_cowin_data(SCRIPT_FOLDER, options.output_format,
+                      options.output_folder)
@@ -1,14 +1,31 @@
 import sys
+import functools
 import os
 import json
 import logging
-import requests
-from data_converter import convert_data
+from data_converter import convert_data, convert_data_stream, ConsolidatedWriter
+from checkpoint import CheckpointManifest, atomic_folder, location_key, \
+    PENDING, FETCHED, CONVERTED
+from instrumentation import metrics
+from data_catalog import DataCatalog, CATALOG_FOLDER_PATH
+from fetch_engine import build_job, run_jobs, DEFAULT_WORKERS, DEFAULT_LIMIT_PER_HOST
 
 URL_FORMAT = "https://api.cowin.gov.in/api/v1/reports/v2/getPublicReports?date={}&state_id={}&district_id={}"
 
 COWIN_DATA_FOLDER_PATH = os.path.join("data", "cowin")
 
+CONSOLIDATED_DATA_FOLDER_PATH = os.path.join("data", "cowin-consolidated")
+
+CHECKPOINT_FOLDER_PATH = os.path.join("data", "checkpoints")
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Index of the CSV folders, used by the loader to find the folders. The
+# folders written outside the data/cowin folder of the project, e.g.
+# when run from another folder, are not cataloged.
+catalog = DataCatalog(os.path.join(SCRIPT_FOLDER, COWIN_DATA_FOLDER_PATH),
+                      os.path.join(SCRIPT_FOLDER, CATALOG_FOLDER_PATH))
+
 TEST_MODE_STATE_IDS = set([31])
 TEST_MODE_DISTRICT_IDS = set([571])
 
@@ -21,24 +38,131 @@ def normalize_name(name):
     return name.replace(" and", " And").replace(" ", "")
 
 
-def fetch_data(date, location_type, url, result_path):
+def get_manifest(date, consolidated=False):
+    folder = CHECKPOINT_FOLDER_PATH
+    if consolidated:
+        folder = os.path.join(folder, "consolidated")
+    return CheckpointManifest(os.path.join(folder, "{}.jsonl".format(date)))
+
+
+def get_consolidated_writer(date, manifest):
+    """
+        Creates the writer for consolidated output of a date.
+        Consolidated output has a single CSV file per DATA_MAPPING entry
+        for all the locations instead of a folder per location.
+
+        Parameters:
+            date: Date for which data is retrieved
+            manifest: Checkpoint manifest of the date
+        Returns:
+            ConsolidatedWriter of the date
+    """
+    return ConsolidatedWriter(
+        os.path.join(CONSOLIDATED_DATA_FOLDER_PATH, date), manifest)
+
+
+def save_data(date, location_type, result_path, manifest, key, data):
+    """
+        Converts data fetched from COWIN Dashboard into CSV files
+        and stores them in the result path. The files are written
+        into a staging folder which is renamed to the result path
+        only after all the files are written.
+
+        Parameters:
+            date: Date for which data is retrieved
+            location_type: E.g. national, state, district
+            result_path: Location where the csv data is stored
+            manifest: Checkpoint manifest of the date
+            key: Checkpoint key of the location
+            data: JSON data retreived from COWIN website
+    """
+    manifest.update(key, FETCHED)
+    data["date"] = date
+    with atomic_folder(result_path) as staging_path:
+        convert_data(location_type, staging_path, data)
+    catalog.add_folder(result_path)
+    manifest.update(key, CONVERTED)
+
+
+def save_data_stream(date, location_type, result_path, manifest, key, stream):
+    """
+        Converts data into CSV files while it is being downloaded from
+        COWIN Dashboard, so that large site level payloads are never
+        fully held in memory. Files are written into a staging folder
+        like save_data.
+
+        Parameters:
+            date: Date for which data is retrieved
+            location_type: E.g. national, state, district
+            result_path: Location where the csv data is stored
+            manifest: Checkpoint manifest of the date
+            key: Checkpoint key of the location
+            stream: Binary file like object of the response body
+    """
+    manifest.update(key, FETCHED)
+    with atomic_folder(result_path) as staging_path:
+        convert_data_stream(location_type, staging_path, date, stream)
+    catalog.add_folder(result_path)
+    manifest.update(key, CONVERTED)
+
+
+def save_consolidated_data(date, location_type, location_id, writer,
+                           manifest, key, data):
     """
-        Fetches data from COWIN Dashboard, converts into CSV files
-        and stores them in the result path.
+        Appends data fetched from COWIN Dashboard to the consolidated
+        CSV files of the date. The location is marked as converted
+        by the writer once the rows are checkpointed.
+
+        Parameters:
+            date: Date for which data is retrieved
+            location_type: E.g. national, state, district
+            location_id: ID of the location. ID for national will be 0.
+            writer: ConsolidatedWriter of the date
+            manifest: Checkpoint manifest of the date
+            key: Checkpoint key of the location
+            data: JSON data retreived from COWIN website
+    """
+    manifest.update(key, FETCHED)
+    data["date"] = date
+    writer.write(key, location_type, location_id, data)
+
+
+def fetch_data(date, location_type, location_id, url, result_path, manifest,
+               writer=None):
+    """
+        Builds a fetch job that fetches data from COWIN Dashboard,
+        converts into CSV files and stores them in the result path.
 
         Parameters:
             date: Date for which data needs to retrieved
             location_type: E.g. national, state, district
+            location_id: ID of the location. ID for national will be 0.
             url: COWIN API URL with query params
             result_path: Location where the csv data is stored
+            manifest: Checkpoint manifest of the date
+            writer: Optional ConsolidatedWriter. When given, the rows are
+                written to the consolidated files instead of result path.
+        Returns:
+            Fetch job, or None if the location is already converted
     """
-    if os.path.exists(result_path):
+    key = location_key(location_type, location_id)
+    if manifest.get_status(key) == CONVERTED:
+        return None
+    if writer is None and os.path.exists(result_path):
         logging.warning("Folder '%s' already has data." % (result_path,))
-        return
-    os.makedirs(result_path)
-    data = requests.get(url).json()
-    data["date"] = date
-    convert_data(location_type, result_path, data)
+        if not catalog.has_folder(result_path):
+            catalog.add_folder(result_path)
+        manifest.update(key, CONVERTED)
+        return None
+    manifest.update(key, PENDING)
+    on_error = functools.partial(manifest.record_failure, key)
+    if writer:
+        return build_job(url, functools.partial(
+            save_consolidated_data, date, location_type, location_id,
+            writer, manifest, key), on_error)
+    return build_job(url, functools.partial(
+        save_data_stream, date, location_type, result_path, manifest, key),
+        on_error, stream=True)
 
 
 def get_state_districts_data():
@@ -60,36 +184,49 @@ def get_state_districts_data():
     return data
 
 
-def extract_national_data(date):
+def extract_national_data(date, manifest, writer=None):
     """
-        Fetches data aggregated at national level
+        Builds fetch jobs for data aggregated at national level
 
         Parameters:
             date: Date for which the data needs to be retrieved
+            manifest: Checkpoint manifest of the date
+            writer: Optional ConsolidatedWriter of the date
+        Returns:
+            List of fetch jobs
     """
     logging.info("Fetching country level data")
     url = build_url(date)
     folder_path = os.path.join(COWIN_DATA_FOLDER_PATH, date)
-    fetch_data(date, "national", url, folder_path)
+    return [fetch_data(date, "national", 0, url, folder_path, manifest, writer)]
 
 
-def extract_state_data(state_district_data, date, test_mode):
+def extract_state_data(state_district_data, date, test_mode, manifest,
+                       state_ids=None, writer=None):
     """
-        Fetches data aggregated at state level for all states
+        Builds fetch jobs for data aggregated at state level for all states
 
         Parameters:
             state_district_data: State data as a dictionary
             date: Date for which the data needs to be retrieved
             test_mode: Test mode to test the data extraction.
                 Retreives only the whitlisted states in TEST_MODE_STATE_IDS
+            manifest: Checkpoint manifest of the date
+            state_ids: Optional set of state IDs to be retrieved
+            writer: Optional ConsolidatedWriter of the date
+        Returns:
+            List of fetch jobs
     """
     logging.info("Fetching state level data")
+    jobs = []
     for state_id, state_info in state_district_data.items():
         state_name = state_info["name"]
         if test_mode and state_id not in TEST_MODE_STATE_IDS:
             logging.warning(
                 "Skipping State {}-{}".format(state_id, state_name))
             continue
+        if state_ids and state_id not in state_ids:
+            continue
         logging.info("Processing State: {}".format(state_name))
         url = build_url(date, state_id)
         fmt_state_name = normalize_name(state_name)
@@ -98,21 +235,34 @@ def extract_state_data(state_district_data, date, test_mode):
         if not os.path.exists(folder):
             os.makedirs(folder)
         data_folder_path = os.path.join(folder, date)
-        fetch_data(date, "state", url, data_folder_path)
+        jobs.append(fetch_data(date, "state", state_id, url,
+                               data_folder_path, manifest, writer))
+    return jobs
 
 
-def extract_district_data(state_district_data, date, test_mode):
+def extract_district_data(state_district_data, date, test_mode, manifest,
+                          state_ids=None, district_ids=None, writer=None):
     """
-        Fetches data aggregated at district level for all districts
+        Builds fetch jobs for data aggregated at district level for all districts
 
         Parameters:
             state_district_data: District level data grouped by state
             date: Date for which the data needs to be retrieved
             test_mode: Test mode to test the data extraction.
                 Retreives only the whitlisted districts in TEST_MODE_DISTRICT_IDS
+            manifest: Checkpoint manifest of the date
+            state_ids: Optional set of state IDs whose districts
+                needs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            writer: Optional ConsolidatedWriter of the date
+        Returns:
+            List of fetch jobs
     """
     logging.info("Fetching district level data")
+    jobs = []
     for state_id, state_info in state_district_data.items():
+        if state_ids and state_id not in state_ids:
+            continue
         state_name = state_info["name"]
         fmt_state_name = normalize_name(state_name)
         state_folder = os.path.join(
@@ -126,6 +276,8 @@ def extract_district_data(state_district_data, date, test_mode):
                 logging.warning(
                     "Skipping District {}-{}".format(district_id, district_name))
                 continue
+            if district_ids and district_id not in district_ids:
+                continue
             logging.info("Processing District: {}, {}".format(
                 district_name, state_name))
             url = build_url(date, state_id, district_id)
@@ -135,22 +287,65 @@ def extract_district_data(state_district_data, date, test_mode):
             data_folder_path = os.path.join(folder, date)
             if not os.path.exists(folder):
                 os.makedirs(folder)
-            fetch_data(date, "district", url, data_folder_path)
+            jobs.append(fetch_data(date, "district", district_id, url,
+                                   data_folder_path, manifest, writer))
+    return jobs
+
+
+def extract_date_jobs(state_district_data, date, test_mode, manifest,
+                      state_ids=None, district_ids=None, writer=None):
+    """
+        Builds fetch jobs for national, state and district level data
+        of a date. National data is skipped when a state or district
+        filter is given, and state data is skipped when only a
+        district filter is given.
+
+        Parameters:
+            state_district_data: District level data grouped by state
+            date: Date for which the data needs to be retrieved
+            test_mode: Extract only whitelisted entries
+            manifest: Checkpoint manifest of the date
+            state_ids: Optional set of state IDs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            writer: Optional ConsolidatedWriter of the date
+        Returns:
+            List of fetch jobs
+    """
+    jobs = []
+    if not state_ids and not district_ids:
+        jobs += extract_national_data(date, manifest, writer)
+    if state_ids or not district_ids:
+        jobs += extract_state_data(state_district_data, date, test_mode,
+                                   manifest, state_ids, writer)
+    jobs += extract_district_data(state_district_data, date, test_mode,
+                                  manifest, state_ids, district_ids, writer)
+    return jobs
 
 
-def extract_data(date, test_mode):
+def extract_data(date, test_mode, workers=DEFAULT_WORKERS,
+                 limit_per_host=DEFAULT_LIMIT_PER_HOST, consolidated=False):
     """
         Extracts national, state and district level data for a date
 
         Parameters:
             date: Date for which the data needs to be retrieved
             test_mode: Extract only whitelisted entries
+            workers: Number of concurrent fetch workers
+            limit_per_host: Maximum open connections to COWIN API
+            consolidated: Write a single CSV file per DATA_MAPPING entry
+                for all locations instead of a folder per location
     """
     logging.info("Extracting data for '{}'".format(date))
     state_district_data = get_state_districts_data()
-    extract_national_data(date)
-    extract_state_data(state_district_data, date, test_mode)
-    extract_district_data(state_district_data, date, test_mode)
+    manifest = get_manifest(date, consolidated)
+    writer = get_consolidated_writer(date, manifest) if consolidated else None
+    jobs = extract_date_jobs(state_district_data, date, test_mode, manifest,
+                             writer=writer)
+    run_jobs(jobs, workers, limit_per_host)
+    if writer:
+        writer.close()
+    manifest.close()
+    metrics.write_reports("extract")
 
 
 if __name__ == "__main__":
@@ -159,6 +354,9 @@ if __name__ == "__main__":
     if(len(args) >= 2):
         date = args[1]
         prod_mode = args[2] if len(args) >= 3 else ""
-        extract_data(date, prod_mode != "True")
+        workers = int(args[3]) if len(args) >= 4 else DEFAULT_WORKERS
+        output_mode = args[4] if len(args) >= 5 else ""
+        extract_data(date, prod_mode != "True", workers,
+                     consolidated=output_mode == "consolidated")
     else:
         logging.error("Date argument is missing")
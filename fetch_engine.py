@@ -0,0 +1,192 @@
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from request_scheduler import RequestScheduler
+from instrumentation import metrics
+
+DEFAULT_WORKERS = 16
+DEFAULT_LIMIT_PER_HOST = 8
+PROGRESS_INTERVAL = 10
+
+
+STREAM_READ_TIMEOUT = 60
+
+
+def build_job(url, on_data, on_error=None, stream=False, raw=False):
+    """
+        Builds a fetch job for the fetch engine.
+
+        Parameters:
+            url: COWIN API URL with query params
+            on_data: Callable invoked with the JSON response. It runs in
+                a worker thread so that file writes do not block the
+                event loop.
+            on_error: Optional callable invoked with the exception when
+                fetching or on_data fails
+            stream: If True, on_data is invoked with a binary file like
+                object of the response body instead of the parsed JSON,
+                so that the response can be processed while it arrives.
+                on_data is invoked again if the request is retried.
+            raw: If True, on_data is invoked with the response body
+                bytes instead of the parsed JSON. Ignored for stream jobs.
+        Returns:
+            Job dictionary accepted by run_jobs
+    """
+    return {"url": url, "on_data": on_data, "on_error": on_error,
+            "stream": stream, "raw": raw}
+
+
+class ResponseStream:
+    """
+        Blocking file like reader over an aiohttp response body, used
+        by on_data of stream jobs running in a worker thread.
+    """
+
+    def __init__(self, content, loop):
+        self.content = content
+        self.loop = loop
+        self.size = 0
+        self.wait_seconds = 0.0
+
+    def read(self, size=-1):
+        started_at = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(
+            self.content.read(size), self.loop)
+        data = future.result(STREAM_READ_TIMEOUT)
+        self.wait_seconds += time.perf_counter() - started_at
+        self.size += len(data)
+        return data
+
+
+async def process_job(session, scheduler, job):
+    """
+        Fetches a job and runs its on_data. Records the latency and
+        response size of the URL, and the time spent waiting for the
+        response as the network stage.
+    """
+    loop = asyncio.get_running_loop()
+    started_at = time.perf_counter()
+    response_info = {"size": 0}
+    error = None
+    try:
+        if job["stream"]:
+            async def read_body(response):
+                stream = ResponseStream(response.content, loop)
+                try:
+                    return await loop.run_in_executor(
+                        None, job["on_data"], stream)
+                finally:
+                    response_info["size"] = stream.size
+                    metrics.observe("stage_seconds", stream.wait_seconds,
+                                    stage="network")
+            await scheduler.get(session, job["url"], read_body)
+            return
+
+        async def read_json_body(response):
+            body = await response.read()
+            response_info["size"] = len(body)
+            return body if job.get("raw") else json.loads(body)
+        network_started_at = time.perf_counter()
+        data = await scheduler.get(session, job["url"], read_json_body)
+        metrics.observe("stage_seconds",
+                        time.perf_counter() - network_started_at,
+                        stage="network")
+        await loop.run_in_executor(None, job["on_data"], data)
+    except Exception as exception:
+        error = repr(exception)
+        raise
+    finally:
+        metrics.record_url(job["url"], time.perf_counter() - started_at,
+                           response_info["size"], error)
+
+
+async def worker(session, scheduler, queue, stats):
+    while True:
+        job = await queue.get()
+        try:
+            await process_job(session, scheduler, job)
+            stats["fetched"] += 1
+        except Exception as error:
+            logging.error("Failed to fetch '{}': {!r}".format(job["url"], error))
+            stats["failed"] += 1
+            if job["on_error"]:
+                job["on_error"](error)
+        finally:
+            queue.task_done()
+
+
+def log_progress(stats, started_at, now):
+    done = stats["fetched"] + stats["failed"]
+    elapsed = max(now - started_at, 1e-6)
+    rate = done / elapsed
+    remaining = (stats["total"] - done) / rate if rate else 0
+    logging.info(
+        "Progress: {}/{} locations ({:.1f}%), {:.1f} locations/s, "
+        "{} failed, ~{:.0f}s remaining".format(
+            done, stats["total"], 100.0 * done / stats["total"], rate,
+            stats["failed"], remaining))
+
+
+async def report_progress(stats, started_at, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        log_progress(stats, started_at, loop.time())
+
+
+async def run_jobs_async(jobs, workers, limit_per_host, scheduler):
+    stats = {"total": 0, "fetched": 0, "failed": 0}
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+        stats["total"] += 1
+    if stats["total"] == 0:
+        return stats
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    connector = aiohttp.TCPConnector(
+        limit=workers, limit_per_host=limit_per_host)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [asyncio.create_task(worker(session, scheduler, queue, stats))
+                 for _ in range(min(workers, stats["total"]))]
+        tasks.append(asyncio.create_task(
+            report_progress(stats, started_at, PROGRESS_INTERVAL)))
+        await queue.join()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    log_progress(stats, started_at, loop.time())
+    return stats
+
+
+def run_jobs(jobs, workers=DEFAULT_WORKERS, limit_per_host=DEFAULT_LIMIT_PER_HOST,
+             scheduler=None):
+    """
+        Fetches all the jobs concurrently with bounded concurrency.
+        A failed job is logged and does not stop the other jobs.
+
+        Parameters:
+            jobs: Iterable of jobs built using build_job.
+                None entries (already fetched locations) are ignored.
+            workers: Number of concurrent fetch workers
+            limit_per_host: Maximum open connections per host
+            scheduler: RequestScheduler used for rate limiting and retries.
+                A scheduler with default settings is used if not provided.
+        Returns:
+            Dictionary with total, fetched and failed job counts along
+            with the request counts of the scheduler
+    """
+    jobs = [job for job in jobs if job]
+    if scheduler is None:
+        scheduler = RequestScheduler()
+    stats = asyncio.run(run_jobs_async(
+        jobs, workers, limit_per_host, scheduler))
+    stats["requests"] = scheduler.stats
+    logging.info("Fetched {fetched} of {total} locations, {failed} failed".format(
+        **stats))
+    logging.info(
+        "Made {requests} requests, {retried} retried, {throttled} throttled, "
+        "{failed} failed".format(**scheduler.stats))
+    return stats
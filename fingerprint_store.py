@@ -0,0 +1,103 @@
+import re
+import hashlib
+import threading
+from datetime import datetime
+
+FINGERPRINTS_TABLE = "payload_fingerprints"
+
+# Result of FingerprintStore.check
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+STALE = "stale"
+
+# The timestamp field of the payloads, which COWIN refreshes even when
+# the data did not change
+TIMESTAMP_PATTERN = re.compile(rb'"timestamp"\s*:\s*"[^"]*"')
+
+
+def get_fingerprint(body):
+    """
+        Gets the content hash of a response body, without its timestamp
+        field, so that a payload whose data did not change since it was
+        loaded is unchanged. The body is not parsed.
+
+        Parameters:
+            body: Response body bytes
+        Returns:
+            SHA-256 hex digest of the body without the timestamp
+    """
+    return hashlib.sha256(TIMESTAMP_PATTERN.sub(b"", body)).hexdigest()
+
+
+class FingerprintStore:
+    """
+        Content hashes and COWIN timestamps of the payloads loaded into
+        the database, by date and location. A payload is loaded again
+        only if its hash differs from the loaded payload of the same
+        date and location.
+
+        Fingerprints are stored in the database and recorded in the
+        transaction which loads the payload rows, so that they are
+        never ahead of the rows and are dropped when the database is
+        rebuilt.
+    """
+
+    def __init__(self, db):
+        """
+            Parameters:
+                db: Sqlite database connection used to read the
+                    fingerprints of the previous loads
+        """
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        if FINGERPRINTS_TABLE in db.table_names():
+            for row in db[FINGERPRINTS_TABLE].rows:
+                self.fingerprints[(row["date"], row["location_type"],
+                                   row["location_id"])] = row
+
+    def check(self, date, location_type, location_id, fingerprint):
+        """
+            Compares the hash of a payload with the loaded payload.
+
+            Returns:
+                NEW, CHANGED or UNCHANGED
+        """
+        with self.lock:
+            row = self.fingerprints.get((date, location_type, location_id))
+        if not row:
+            return NEW
+        return UNCHANGED if row["sha256"] == fingerprint else CHANGED
+
+    def is_stale(self, date, location_type, location_id, timestamp):
+        """
+            Checks if a changed payload is older than the loaded payload,
+            e.g. a cached response served after a newer one.
+        """
+        with self.lock:
+            row = self.fingerprints.get((date, location_type, location_id))
+        return bool(row and row["timestamp"] and timestamp and
+                    timestamp < row["timestamp"])
+
+    def record(self, db, date, location_type, location_id, fingerprint,
+               timestamp):
+        """
+            Records the fingerprint of a loaded payload. Runs in the
+            transaction which loads the payload rows.
+
+            Parameters:
+                db: Sqlite database connection of the transaction
+                date: Date of the payload
+                location_type: E.g. national, state, district
+                location_id: ID of the location. ID for national will be 0.
+                fingerprint: Content hash returned by get_fingerprint
+                timestamp: timestamp field of the payload
+        """
+        row = {"date": date, "location_type": location_type,
+               "location_id": location_id, "sha256": fingerprint,
+               "timestamp": timestamp,
+               "loaded_at": datetime.now().isoformat(timespec="seconds")}
+        db[FINGERPRINTS_TABLE].insert(
+            row, pk=("date", "location_type", "location_id"), replace=True)
+        with self.lock:
+            self.fingerprints[(date, location_type, location_id)] = row
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import tracemalloc
+from datetime import datetime
+from urllib.parse import urlsplit
+from checkpoint import atomic_file
+
+METRICS_FOLDER_PATH = os.path.join("data", "metrics")
+
+# Set to 1 to record the peak traced memory of every stage
+TRACE_MEMORY_ENV = "COWIN_TRACE_MEMORY"
+
+METRIC_PREFIX = "cowin_"
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """
+        Latency histogram with fixed buckets, in the layout of
+        Prometheus histograms.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def get_quantile(self, quantile):
+        """
+            Estimates a quantile as the upper bound of its bucket.
+        """
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0,
+            "p50": self.get_quantile(0.5),
+            "p95": self.get_quantile(0.95),
+            "max": round(self.max, 6),
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"],
+                                self.counts))
+        }
+
+
+def get_label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def get_endpoint(url):
+    """
+        Gets the URL without its query, so that the requests of all the
+        locations of an API share a histogram.
+    """
+    parts = urlsplit(url)
+    return "{}://{}{}".format(parts.scheme, parts.netloc, parts.path)
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels)
+
+
+class Metrics:
+    """
+        Latency histograms, counters and memory peaks of the pipeline
+        stages, shared by the threads of a process.
+
+        Stages are network (waiting for responses), convert and
+        convert_stream (JSON parsing and CSV writing), csv_write,
+        load_folder, load_csv and insert. Stage times nest, e.g.
+        convert_stream includes the network wait of the streamed
+        response and insert includes parsing the CSV rows read lazily.
+        The fetch_seconds histogram has the latency of every fetch by
+        API endpoint, and the report has the latency of every URL.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.now()
+            self.histograms = {}
+            self.counters = {}
+            self.memory_peaks = {}
+            self.urls = {}
+        self.trace_memory = os.environ.get(TRACE_MEMORY_ENV) == "1"
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def observe(self, name, value, **labels):
+        key = (name, get_label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, get_label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_count(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, get_label_key(labels)), 0)
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """
+            Measures the time of a block as a stage. With memory tracing
+            enabled, the peak traced memory of the block is recorded as
+            well. Peaks of overlapping stages are approximate, since
+            the traced peak is shared by the process.
+        """
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started_at,
+                         stage=name, **labels)
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                with self.lock:
+                    self.memory_peaks[name] = max(
+                        self.memory_peaks.get(name, 0), peak)
+
+    def count_rows(self, rows, name, **labels):
+        """
+            Counts the rows of an iterable while it is consumed.
+
+            Returns:
+                Generator of the rows
+        """
+        count = 0
+        try:
+            for row in rows:
+                count += 1
+                yield row
+        finally:
+            self.increment(name, count, **labels)
+
+    def record_url(self, url, seconds, size, error=None):
+        """
+            Records the latency and response size of a fetched URL.
+        """
+        endpoint = get_endpoint(url)
+        self.observe("fetch_seconds", seconds, endpoint=endpoint)
+        self.increment("bytes_fetched", size, endpoint=endpoint)
+        self.increment("requests_failed" if error else "requests_fetched",
+                       endpoint=endpoint)
+        with self.lock:
+            self.urls[url] = {"seconds": round(seconds, 6), "bytes": size,
+                              "error": error}
+
+    def get_report(self):
+        with self.lock:
+            return {
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "reported_at": datetime.now().isoformat(timespec="seconds"),
+                "histograms": [dict(name=name, labels=dict(labels),
+                                    **histogram.to_dict())
+                               for (name, labels), histogram
+                               in sorted(self.histograms.items())],
+                "counters": [{"name": name, "labels": dict(labels),
+                              "value": value}
+                             for (name, labels), value
+                             in sorted(self.counters.items())],
+                "memory_peaks": dict(self.memory_peaks),
+                "urls": dict(self.urls)
+            }
+
+    def get_prometheus_text(self, run):
+        """
+            Formats the histograms, counters and memory peaks in the
+            Prometheus text exposition format, with a run label.
+        """
+        lines = []
+        run_label = (("run", run),)
+        with self.lock:
+            names = sorted(set(name for name, _ in self.histograms))
+            for name in names:
+                metric = METRIC_PREFIX + name
+                lines.append("# TYPE {} histogram".format(metric))
+                for (h_name, labels), histogram in sorted(self.histograms.items()):
+                    if h_name != name:
+                        continue
+                    labels = run_label + labels
+                    cumulative = 0
+                    for bound, count in zip(
+                            [str(bound) for bound in histogram.buckets] + ["+Inf"],
+                            histogram.counts):
+                        cumulative += count
+                        lines.append("{}_bucket{{{}}} {}".format(
+                            metric, format_labels(labels + (("le", bound),)),
+                            cumulative))
+                    lines.append("{}_sum{{{}}} {}".format(
+                        metric, format_labels(labels), histogram.sum))
+                    lines.append("{}_count{{{}}} {}".format(
+                        metric, format_labels(labels), histogram.count))
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                metric = METRIC_PREFIX + name + "_total"
+                lines.append("# TYPE {} counter".format(metric))
+                for (c_name, labels), value in sorted(self.counters.items()):
+                    if c_name == name:
+                        lines.append("{}{{{}}} {}".format(
+                            metric, format_labels(run_label + labels), value))
+            if self.memory_peaks:
+                metric = METRIC_PREFIX + "stage_memory_peak_bytes"
+                lines.append("# TYPE {} gauge".format(metric))
+                for stage, peak in sorted(self.memory_peaks.items()):
+                    lines.append("{}{{{}}} {}".format(
+                        metric, format_labels(run_label + (("stage", stage),)),
+                        peak))
+        return "\n".join(lines) + "\n"
+
+    def write_reports(self, run, folder=METRICS_FOLDER_PATH):
+        """
+            Writes the JSON run report and the Prometheus text file of
+            a run. The text file keeps the same name across runs, so a
+            textfile collector always reads the latest run.
+
+            Parameters:
+                run: Name of the run, e.g. extract or load
+                folder: Metrics folder
+            Returns:
+                Path of the JSON run report
+        """
+        os.makedirs(folder, exist_ok=True)
+        report = self.get_report()
+        report["run"] = run
+        report_path = os.path.join(folder, "{}-{}.json".format(
+            run, datetime.now().strftime("%Y%m%dT%H%M%S")))
+        with atomic_file(report_path) as file:
+            json.dump(report, file, indent=2)
+        prometheus_path = os.path.join(folder, "{}.prom".format(run))
+        with atomic_file(prometheus_path) as file:
+            file.write(self.get_prometheus_text(run))
+        logging.info("Wrote metrics report '{}'".format(report_path))
+        return report_path
+
+
+metrics = Metrics()
@@ -1,13 +1,85 @@
 import os
 import io
+import sys
+import glob
+import time
+import itertools
+import collections
 import logging
 import json
 import csv
+import codecs
+import tarfile
+import requests
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from sqlite_utils import Database
+from data_converter import convert_data, get_location_mappings, \
+    get_nested_object, get_rows
+from extract_data import normalize_name
+from raw_archive import RawArchiveReader
+from data_catalog import DataCatalog, CATALOG_FOLDER_PATH, \
+    DATE_FOLDER_PATTERN, LOCATION_FOLDER_PATTERN
+from checkpoint import atomic_file
+from rollup_cowin_data import update_rollups
+from rolling_window_facts import update_facts
+from derived_metrics import update_derived_metrics
+from site_dimension import update_sites
+from instrumentation import metrics, METRICS_FOLDER_PATH
+from table_schema import TableSchema, SchemaMismatch, infer_column_types, \
+    INTEGER, REAL, TEXT, DATE
 
 DB_FILE_NAME = "covid-ds.db"
 
-# CSV File and table mapping
+# Written when a load finishes, so that query_service.py clears its cache
+LOAD_MARKER_FILE_NAME = "covid-ds.db.loaded"
+
+# Rebuilds are written into this file and moved over covid-ds.db once
+# they finish, so that query_service.py never reads a partial rebuild
+REBUILD_FILE_NAME = "covid-ds.db.rebuild"
+
+# Table which records the files loaded by the incremental load
+LOADED_UNITS_TABLE = "loaded_units"
+
+# Pragmas used while the database is rebuilt by the bulk load. The
+# database is recreated from the CSV files if the load fails, so
+# durability is traded for speed.
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -262144,
+    "temp_store": "MEMORY"
+}
+
+# Rows converted and inserted at a time. The table is altered between
+# the chunks if their columns or values do not fit.
+INSERT_CHUNK_SIZE = 10000
+
+# Number of parsed folders waiting for the writer, per parser process
+PARSE_QUEUE_SIZE_PER_WORKER = 4
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL"
+}
+
+RELEASE_INDEX_FILE_NAME = "release.data.files.json"
+
+# Release archives are downloaded once into this folder
+RELEASE_CACHE_FOLDER_PATH = os.path.join("data", "releases")
+
+# Release formats which have the extract_data.py CSV folder layout
+SUPPORTED_RELEASE_FORMATS = set(["v10"])
+
+# Column types of the columns common to the tables
+COMMON_COLUMN_TYPES = {
+    "location_type": TEXT,
+    "location_id": INTEGER,
+    "date": DATE
+}
+
+# CSV File and table mapping. Types of the columns which are not
+# declared in columns are inferred from the first file loaded.
 TABLE_FILE_MAPPING = {
     "vaccination_site_count.csv": {
         "table": "raw_vaccination_site_count",
@@ -22,6 +94,7 @@ TABLE_FILE_MAPPING = {
     "meta.csv": {
         "table": "raw_meta",
         "load_location_columns": True,
+        "columns": {"timestamp": TEXT, "aefiPercentage": REAL},
         "pk": (
             "location_type",
             "location_id",
@@ -67,6 +140,7 @@ TABLE_FILE_MAPPING = {
     "session_vaccination_count.csv": {
         "table": "raw_session_vaccination_count",
         "load_location_columns": True,
+        "columns": {"ts": TEXT, "label": TEXT},
         "pk": (
             "location_type",
             "location_id",
@@ -77,6 +151,7 @@ TABLE_FILE_MAPPING = {
     "site_level_vaccination_count.csv": {
         "table": "raw_site_level_vaccination_count",
         "load_location_columns": True,
+        "columns": {"session_site_name": TEXT, "title": TEXT},
         "pk": (
             "location_type",
             "location_id",
@@ -87,6 +162,7 @@ TABLE_FILE_MAPPING = {
     "vaccination_by_time_age.csv": {
         "table": "raw_vaccination_by_time_age",
         "load_location_columns": True,
+        "columns": {"label": TEXT},
         "pk": (
             "location_type",
             "location_id",
@@ -97,6 +173,7 @@ TABLE_FILE_MAPPING = {
     "national_timewise_today_registration.csv": {
         "table": "raw_national_timewise_today_registration",
         "load_location_columns": False,
+        "columns": {"label": TEXT},
         "pk": (
             "date",
             "label"
@@ -105,6 +182,7 @@ TABLE_FILE_MAPPING = {
     "state_level_vaccination_count.csv": {
         "table": "raw_state_level_vaccination_count",
         "load_location_columns": False,
+        "columns": {"state_name": TEXT},
         "pk": (
             "date",
             "state_id"
@@ -113,6 +191,7 @@ TABLE_FILE_MAPPING = {
     "last_7days_vaccination_count.csv": {
         "table": "raw_daily_vaccination_count_last_7days",
         "load_location_columns": True,
+        "columns": {"vaccine_date": DATE},
         "pk": (
             "location_type",
             "location_id",
@@ -123,6 +202,7 @@ TABLE_FILE_MAPPING = {
     "last_7days_registration_count.csv": {
         "table": "raw_daily_registration_count_last_7days",
         "load_location_columns": True,
+        "columns": {"reg_date": DATE},
         "pk": (
             "location_type",
             "location_id",
@@ -133,6 +213,7 @@ TABLE_FILE_MAPPING = {
     "last_5days_session_status.csv": {
         "table": "raw_daily_session_status_last_5days",
         "load_location_columns": True,
+        "columns": {"session_date": DATE},
         "pk": (
             "location_type",
             "location_id",
@@ -143,6 +224,7 @@ TABLE_FILE_MAPPING = {
     "last_30days_aefi.csv": {
         "table": "raw_aefi_last_30days",
         "load_location_columns": True,
+        "columns": {"vaccine_date": DATE},
         "pk": (
             "location_type",
             "location_id",
@@ -153,6 +235,7 @@ TABLE_FILE_MAPPING = {
     "district_level_vaccination_count.csv": {
         "table": "raw_district_level_vaccination_count",
         "load_location_columns": False,
+        "columns": {"district_name": TEXT, "title": TEXT},
         "pk": (
             "date",
             "district_id"
@@ -175,7 +258,98 @@ def get_json_from_file(path):
         return json.load(file)
 
 
-def load_csv_file(db, table, csv_file, location_col_values, extra_kwargs):
+def set_pragmas(db, pragmas):
+    for name, value in pragmas.items():
+        db.execute("PRAGMA {} = {}".format(name, value))
+
+
+def get_table_schema(db, table, headers, rows, extra_kwargs):
+    """
+        Gets the schema of a table, creating the table with the declared
+        and inferred column types if it does not exist.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Table name
+            headers: Column names of the rows
+            rows: List of rows used to infer the undeclared column types
+            extra_kwargs: Insert arguments built by get_insert_kwargs
+        Returns:
+            TableSchema of the table
+    """
+    schema = TableSchema.from_table(db, table)
+    if schema is None:
+        schema = TableSchema(table, infer_column_types(
+            headers, rows, extra_kwargs.get("columns")))
+        schema.create(db, extra_kwargs.get("pk"))
+    return schema
+
+
+def convert_chunk(db, schema, headers, rows):
+    """
+        Converts rows into the column types of a table. The new columns
+        of the rows are added to the table and the types of the columns
+        whose values do not fit are widened, so that a payload of a
+        changed format does not stop the load.
+
+        Returns:
+            List of tuples
+    """
+    try:
+        return schema.convert_rows(headers, rows)
+    except SchemaMismatch as error:
+        logging.warning("Altering table {}: {}".format(schema.table, error))
+        schema.alter(db, error.column_types)
+        return schema.convert_rows(headers, rows)
+
+
+def insert_rows(db, table, headers, rows, extra_kwargs, upsert=False,
+                bulk=False):
+    """
+        Converts rows of CSV values into the column types of the table
+        and inserts them. The table is created from the rows if needed.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Table name into which the rows needs to be inserted
+            headers: Column names of the rows
+            rows: Iterable of rows
+            extra_kwargs: Insert arguments built by get_insert_kwargs
+            upsert: Update the rows which are already loaded, using the
+                primary key of the table
+            bulk: Insert the rows as tuples using executemany, without
+                committing. Rows already loaded are replaced when
+                upserting.
+    """
+    with metrics.stage("insert", table=table):
+        rows = iter(rows)
+        chunk = list(itertools.islice(rows, INSERT_CHUNK_SIZE))
+        if not chunk and not db[table].exists():
+            return
+        schema = get_table_schema(db, table, headers, chunk, extra_kwargs)
+        sql = "INSERT {}INTO [{}] ({}) VALUES ({})".format(
+            "OR REPLACE " if upsert else "", table,
+            ", ".join("[{}]".format(header) for header in headers),
+            ", ".join("?" * len(headers)))
+        while chunk:
+            converted = convert_chunk(db, schema, headers, chunk)
+            if bulk:
+                cursor = db.conn.executemany(sql, converted)
+                metrics.increment("rows_inserted", cursor.rowcount,
+                                  table=table)
+            else:
+                records = (dict(zip(headers, row)) for row in
+                           metrics.count_rows(converted, "rows_inserted",
+                                              table=table))
+                if upsert:
+                    db[table].upsert_all(records, **extra_kwargs)
+                else:
+                    db[table].insert_all(records, **extra_kwargs)
+            chunk = list(itertools.islice(rows, INSERT_CHUNK_SIZE))
+
+
+def load_csv_file(db, table, csv_file, location_col_values, extra_kwargs,
+                  upsert=False, bulk=False):
     """
         Loads CSV file into a table.
 
@@ -187,15 +361,31 @@ def load_csv_file(db, table, csv_file, location_col_values, extra_kwargs):
                 needs to be added to the table, then that values
             extra_kwargs: Additional arguments that needs to be passed
                 to insert statement
+            upsert: Update the rows which are already loaded, using the
+                primary key of the table
+            bulk: Insert the rows using a single executemany. The caller
+                commits the transaction.
     """
+    metrics.increment("csv_bytes_read", os.path.getsize(csv_file), table=table)
     with open(csv_file) as file:
+        load_csv_stream(db, table, file, location_col_values, extra_kwargs,
+                        upsert, bulk)
+
+
+def load_csv_stream(db, table, file, location_col_values, extra_kwargs,
+                    upsert=False, bulk=False):
+    """
+        Loads CSV data from an open text file into a table.
+        See load_csv_file for the parameters.
+    """
+    with metrics.stage("load_csv", table=table):
         reader = csv.reader(file)
         headers = next(reader)
         if len(location_col_values) > 0:
             headers = ["location_type", "location_id"] + headers
-        records = (dict(zip(headers, location_col_values + row))
-                   for row in reader)
-        db[table].insert_all(records, **extra_kwargs)
+        insert_rows(db, table, headers,
+                    (location_col_values + row for row in reader),
+                    extra_kwargs, upsert, bulk)
 
 
 def load_state_district_meta_data(db):
@@ -212,89 +402,830 @@ def load_state_district_meta_data(db):
         rename={"district_id": "id", "district_name": "name"})
 
 
-def load_location_data_files(db, folder, location_type, location_id, date):
+def get_insert_kwargs(table_load_info):
+    """
+        Builds the insert_all arguments of a table.
+
+        Parameters:
+            table_load_info: Table load information from TABLE_FILE_MAPPING
+        Returns:
+            Dictionary of insert_all arguments
+    """
+    extra_kwargs = {"batch_size": 100}
+    pk = table_load_info.get("pk")
+    if pk:
+        extra_kwargs["pk"] = pk
+    extra_kwargs["columns"] = {
+        **COMMON_COLUMN_TYPES, **table_load_info.get("columns", {})}
+    return extra_kwargs
+
+
+def get_file_signature(file_path):
+    """
+        Gets the size and modification time of a file, which are
+        used to find the files changed since they were loaded.
+    """
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "modified": stat.st_mtime_ns}
+
+
+def get_loaded_units(db):
+    """
+        Gets the files already loaded into the database.
+
+        Parameters:
+            db: Sqlite database connection
+        Returns:
+            Dictionary of file signatures by location type, location ID,
+            date and file name
+    """
+    if LOADED_UNITS_TABLE not in db.table_names():
+        return {}
+    return {(row["location_type"], str(row["location_id"]), row["date"],
+             row["file"]): {"size": row["size"], "modified": row["modified"]}
+            for row in db[LOADED_UNITS_TABLE].rows}
+
+
+def is_unit_changed(loaded_units, unit, signature):
+    return loaded_units is None or loaded_units.get(unit) != signature
+
+
+def record_loaded_unit(db, loaded_units, unit, signature):
+    """
+        Records a loaded file, so that it is skipped by the next
+        incremental load unless it changes.
+
+        Parameters:
+            db: Sqlite database connection
+            loaded_units: Dictionary returned by get_loaded_units
+            unit: Tuple of location type, location ID, date and file name
+            signature: File signature returned by get_file_signature
+    """
+    location_type, location_id, date, file = unit
+    db[LOADED_UNITS_TABLE].upsert(
+        {"location_type": location_type, "location_id": location_id,
+         "date": date, "file": file, **signature},
+        pk=("location_type", "location_id", "date", "file"))
+    loaded_units[unit] = signature
+
+
+def get_location_data_files(entry):
+    """
+        Gets the CSV files of a catalog entry which have a table mapping.
+
+        Parameters:
+            entry: Catalog entry of a location data folder
+        Returns:
+            Generator of file names, their table load information and
+            their file signatures
+    """
+    for file in entry["files"]:
+        table_load_info = TABLE_FILE_MAPPING.get(file["name"])
+        if not table_load_info:
+            logging.warning("No mapping available for file {}".format(
+                file["name"]))
+            continue
+
+        yield file["name"], table_load_info, \
+            {"size": file["size"], "modified": file["modified"]}
+
+
+def load_location_data_files(db, folder, entry, loaded_units=None,
+                             bulk=False):
     """
         Loads location data csv files in a folder into database.
 
         Parameters:
             db: Sqlite database connection
             folder: Folder that contains CSV files
-            location_type: Type of the location for which the data
-                is loaded. E.g. national, state, district
-            location_id: ID of the location. ID for national will be 0.
-            date: fdate for which the data is loaded.
+            entry: Catalog entry of the folder, with the location, date
+                and files of the folder
+            loaded_units: Files already loaded by previous incremental
+                loads. Files whose catalog signature is unchanged are
+                skipped and the rest are upserted. None loads all the
+                files.
+            bulk: Insert the rows using a single executemany
     """
-    for file in os.listdir(folder):
-        file_path = os.path.join(folder, file)
-        if not os.path.isfile(file_path):
-            logging.warning("Skipping invalid file {}".format(file))
+    location_type = entry["location_type"]
+    location_id = entry["location_id"]
+    for file, table_load_info, signature in get_location_data_files(entry):
+        unit = (location_type, str(location_id), entry["date"], file)
+        if not is_unit_changed(loaded_units, unit, signature):
             continue
 
+        logging.info("Processing file {}".format(file))
+        table = table_load_info.get("table")
+        extra_kwargs = get_insert_kwargs(table_load_info)
+
+        location_col_values = []
+        if table_load_info.get("load_location_columns"):
+            location_col_values = [location_type, location_id]
+
+        load_csv_file(db, table, os.path.join(folder, file),
+                      location_col_values, extra_kwargs,
+                      upsert=loaded_units is not None, bulk=bulk)
+        if loaded_units is not None:
+            record_loaded_unit(db, loaded_units, unit, signature)
+
+def load_consolidated_csv_file(db, table, csv_file, load_location_columns,
+                               extra_kwargs, upsert=False, bulk=False):
+    """
+        Loads consolidated CSV file, which has the location_type and
+        location_id columns for every row, into a table.
+
+        Parameters:
+            db: Sqlite database connection
+            table: Table name into which the table needs to be loaded.
+            csv_file: Path of the CSV file that needs to be loaded.
+            load_location_columns: If the location_type and location_id
+                columns needs to be loaded into the table
+            extra_kwargs: Additional arguments that needs to be passed
+                to insert statement
+            upsert: Update the rows which are already loaded, using the
+                primary key of the table
+            bulk: Insert the rows using a single executemany. The caller
+                commits the transaction.
+    """
+    metrics.increment("csv_bytes_read", os.path.getsize(csv_file), table=table)
+    with metrics.stage("load_csv", table=table), open(csv_file) as file:
+        reader = csv.reader(file)
+        headers = next(reader)
+        start = 0 if load_location_columns else 2
+        insert_rows(db, table, headers[start:],
+                    (row[start:] for row in reader), extra_kwargs,
+                    upsert, bulk)
+
+
+def load_consolidated_data(db, folder, loaded_units=None, bulk=False):
+    """
+        Loads consolidated CSV files of a date into database.
+
+        Parameters:
+            db: Sqlite database connection
+            folder: Folder that contains consolidated CSV files of a date
+            loaded_units: Files already loaded by previous incremental
+                loads. None loads all the files.
+            bulk: Insert the rows using a single executemany
+    """
+    date = os.path.basename(folder)
+    for file in os.listdir(folder):
         table_load_info = TABLE_FILE_MAPPING.get(file)
         if not table_load_info:
-            logging.warning("No mapping available for file {}".format(file))
             continue
-
+        file_path = os.path.join(folder, file)
+        # A consolidated file holds all the locations of a date
+        unit = ("consolidated", "0", date, file)
+        signature = get_file_signature(file_path)
+        if not is_unit_changed(loaded_units, unit, signature):
+            continue
         logging.info("Processing file {}".format(file))
-        table = table_load_info.get("table")
-        pk = table_load_info.get("pk")
-        extra_kwargs = {"batch_size": 100}
+        load_consolidated_csv_file(
+            db, table_load_info.get("table"), file_path,
+            table_load_info.get("load_location_columns"),
+            get_insert_kwargs(table_load_info),
+            upsert=loaded_units is not None, bulk=bulk)
+        if loaded_units is not None:
+            record_loaded_unit(db, loaded_units, unit, signature)
+
+
+def get_entry_folder(data_folder, entry):
+    return os.path.join(data_folder, *entry["folder"].split("/"))
+
+
+def load_folder_data(db, data_folder, entry, loaded_units=None, bulk=False):
+    with metrics.stage("load_folder", location_type=entry["location_type"]):
+        load_location_data_files(db, get_entry_folder(data_folder, entry),
+                                 entry, loaded_units, bulk)
+
+
+def read_csv_rows(csv_file, location_col_values, start=0):
+    """
+        Reads all the rows of a CSV file.
+
+        Parameters:
+            csv_file: Path of the CSV file
+            location_col_values: Location type and ID values added to
+                every row, or an empty list
+            start: Number of leading columns of the file to be skipped
+        Returns:
+            Tuple of headers and rows
+    """
+    with open(csv_file) as file:
+        reader = csv.reader(file)
+        headers = next(reader)[start:]
+        if len(location_col_values) > 0:
+            headers = ["location_type", "location_id"] + headers
+        return headers, [location_col_values + row[start:] for row in reader]
 
-        if pk:
-            extra_kwargs["pk"] = pk
 
+def read_folder_data(data_folder, entry):
+    """
+        Parses the CSV files of a location data folder into row batches.
+        Runs in the parser processes of the parallel load.
+
+        Parameters:
+            data_folder: data/cowin folder
+            entry: Catalog entry of the location data folder
+        Returns:
+            List of table, headers, rows and insert arguments of
+            every file
+    """
+    folder = get_entry_folder(data_folder, entry)
+    batches = []
+    for file, table_load_info, _ in get_location_data_files(entry):
         location_col_values = []
         if table_load_info.get("load_location_columns"):
-            location_col_values = [location_type, location_id]
+            location_col_values = [entry["location_type"],
+                                   entry["location_id"]]
+        headers, rows = read_csv_rows(
+            os.path.join(folder, file), location_col_values)
+        batches.append((table_load_info["table"], headers, rows,
+                        get_insert_kwargs(table_load_info)))
+    return batches
 
-        load_csv_file(db, table, os.path.join(folder, file),
-                      location_col_values, extra_kwargs)
-
-def load_folder_data(db, folder, data_path_len):
-    path_split = folder.split(os.path.sep)
-    data_sub_folders = path_split[data_path_len:]
-    data_sub_folder_count = len(data_sub_folders)
-    location_type = ""
-    location_id = 0
-    if data_sub_folder_count == 1:
-        location_type = "national"
-    elif data_sub_folder_count == 2:
-        state_detail = data_sub_folders[-2]
-        location_id = state_detail.split("-")[0]
-        location_type = "state"
-    elif data_sub_folder_count == 3:
-        district_detail = data_sub_folders[-2]
-        location_id = district_detail.split("-")[0]
-        location_type = "district"
-    else:
-        raise Exception("Invalid Data folder: {}".format(folder))
-    date = data_sub_folders[-1]
-    load_location_data_files(db, folder, location_type, location_id, date)
+
+def read_consolidated_data(folder):
+    """
+        Parses the consolidated CSV files of a date into row batches.
+        Runs in the parser processes of the parallel load.
+
+        Parameters:
+            folder: Folder that contains consolidated CSV files of a date
+        Returns:
+            List of table, headers, rows and insert arguments of
+            every file
+    """
+    batches = []
+    for file in os.listdir(folder):
+        table_load_info = TABLE_FILE_MAPPING.get(file)
+        if not table_load_info:
+            continue
+        start = 0 if table_load_info.get("load_location_columns") else 2
+        headers, rows = read_csv_rows(os.path.join(folder, file), [], start)
+        batches.append((table_load_info["table"], headers, rows,
+                        get_insert_kwargs(table_load_info)))
+    return batches
+
+
+def write_batches(db, batches):
+    with db.conn:
+        for table, headers, rows, extra_kwargs in batches:
+            insert_rows(db, table, headers, rows, extra_kwargs, bulk=True)
+
+
+def load_parallel(db, tasks, workers):
+    """
+        Parses folders in a pool of processes while the calling process
+        is the only writer of the database. Parsed folders are written
+        in the order of the tasks, one transaction per folder, and at
+        most PARSE_QUEUE_SIZE_PER_WORKER folders per process are kept
+        waiting for the writer.
+
+        Parameters:
+            db: Sqlite database connection
+            tasks: List of parse function and its arguments
+            workers: Number of parser processes
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for function, args in tasks:
+            pending.append(executor.submit(function, *args))
+            if len(pending) >= workers * PARSE_QUEUE_SIZE_PER_WORKER:
+                write_batches(db, pending.popleft().result())
+        while pending:
+            write_batches(db, pending.popleft().result())
+
+
+def create_secondary_indexes(db):
+    """
+        Creates a date index on the tables whose primary key starts
+        with the location, so that queries for a date do not scan
+        the whole table. The indexes are created after the data is
+        loaded, which is faster than maintaining them for every row.
+
+        Parameters:
+            db: Sqlite database connection
+    """
+    for table_load_info in TABLE_FILE_MAPPING.values():
+        table = db[table_load_info["table"]]
+        if table.exists() and table_load_info["pk"][0] != "date":
+            table.create_index(["date"], if_not_exists=True)
+
+
+def get_changed_dates(loaded_units, previous_units):
+    """
+        Gets the dates of the files loaded by an incremental load.
+
+        Parameters:
+            loaded_units: Dictionary returned by get_loaded_units, updated
+                by the load
+            previous_units: Copy of the dictionary before the load
+        Returns:
+            Set of dates
+    """
+    if loaded_units is None:
+        return set()
+    return set(unit[2] for unit, signature in loaded_units.items()
+               if previous_units.get(unit) != signature)
+
+
+def mark_load_finished(root_folder):
+    with atomic_file(os.path.join(root_folder, LOAD_MARKER_FILE_NAME)) as file:
+        file.write(datetime.now().isoformat())
+
+
+def get_load_path(root_folder, incremental=False):
+    """
+        Gets the path of the sqlite file written by a load. Incremental
+        loads write into the sqlite file, while rebuilds write a new
+        file which finish_load moves over it.
+    """
+    if incremental:
+        return os.path.join(root_folder, DB_FILE_NAME)
+    rebuild_path = os.path.join(root_folder, REBUILD_FILE_NAME)
+    # Left by a rebuild which did not finish
+    for path in (rebuild_path, rebuild_path + "-journal"):
+        if os.path.exists(path):
+            os.remove(path)
+    return rebuild_path
+
+
+def finish_load(root_folder, db_file_path):
+    """
+        Moves a rebuilt sqlite file over the previous one and marks the
+        load as finished. Runs once the database is closed.
+    """
+    final_path = os.path.join(root_folder, DB_FILE_NAME)
+    if db_file_path != final_path:
+        os.replace(db_file_path, final_path)
+    mark_load_finished(root_folder)
 
 
-def load_cowin_data(root_folder):
+def log_load_throughput(db, started_at):
     """
-        Main method to load data into sqlite file
+        Logs the number of rows in the data tables and the load rate.
+
+        Parameters:
+            db: Sqlite database connection
+            started_at: time.monotonic() value when the load started
+    """
+    elapsed = time.monotonic() - started_at
+    tables = set(info["table"] for info in TABLE_FILE_MAPPING.values())
+    rows = sum(db[table].count for table in tables if db[table].exists())
+    logging.info("Loaded {} rows in {:.1f}s ({:.0f} rows/s)".format(
+        rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+def load_cowin_data(root_folder, incremental=False, bulk=False, workers=None,
+                    start_date=None, end_date=None):
+    """
+        Main method to load data into sqlite file. The folders of
+        data/cowin are found through the data catalog, which is built
+        by scanning data/cowin if it does not exist yet. Folders written
+        into data/cowin without being cataloged are added to it first.
+        A rebuild is written into a new file which replaces the sqlite
+        file once it finishes.
 
         Parameter:
             root_folder: Root folder of the project
+            incremental: Load only the files which are new or changed
+                since the previous incremental load, into the existing
+                sqlite file, instead of rebuilding it. Changes are
+                detected from the file sizes and modification times,
+                which are signed again for the catalog entries loaded.
+            bulk: Rebuild the sqlite file with bulk load pragmas, a
+                single transaction per location and date, and tuple
+                based inserts. Ignored for incremental loads.
+            workers: Number of processes which parse the CSV files in
+                parallel for a bulk load. Defaults to the CPU count.
+            start_date: Optional first date to be loaded, inclusive
+            end_date: Optional last date to be loaded, inclusive
     """
-    db_file_path = os.path.join(root_folder, DB_FILE_NAME)
-    if os.path.exists(db_file_path):
-        os.remove(db_file_path)
+    started_at = time.monotonic()
+    bulk = bulk and not incremental
+    db_file_path = get_load_path(root_folder, incremental)
 
     db = Database(db_file_path)
-    load_state_district_meta_data(db)
+    if bulk:
+        set_pragmas(db, BULK_LOAD_PRAGMAS)
+    loaded_units = None
+    previous_units = {}
+    if incremental:
+        loaded_units = get_loaded_units(db)
+        previous_units = dict(loaded_units)
+        logging.info("{} files already loaded".format(len(loaded_units)))
+    if "states" not in db.table_names():
+        load_state_district_meta_data(db)
     
     data_folder = os.path.join(root_folder, "data", "cowin")
-    data_path_len = len(data_folder.split(os.path.sep))
-    for (root, dirs, files) in os.walk(data_folder):
-        if "2021-" in root:
-            load_folder_data(db, root, data_path_len)
-    
+    catalog = DataCatalog(data_folder,
+                          os.path.join(root_folder, CATALOG_FOLDER_PATH))
+    if not catalog.exists():
+        logging.info("Building the data catalog of {}".format(data_folder))
+        catalog.rebuild()
+    else:
+        catalog.update()
+    # Files rewritten in place are not found by update, which lists
+    # only the location folders
+    entries = catalog.refresh_entries(
+        catalog.get_entries(start_date, end_date))
+
+    consolidated_folder = os.path.join(
+        root_folder, "data", "cowin-consolidated")
+    consolidated_folders = []
+    if os.path.exists(consolidated_folder):
+        consolidated_folders = [
+            os.path.join(consolidated_folder, date)
+            for date in sorted(os.listdir(consolidated_folder))
+            if DATE_FOLDER_PATTERN.match(date) and
+            (not start_date or date >= start_date) and
+            (not end_date or date <= end_date)]
+
+    if bulk and workers != 1:
+        tasks = [(read_folder_data, (data_folder, entry))
+                 for entry in entries]
+        tasks += [(read_consolidated_data, (folder,))
+                  for folder in consolidated_folders]
+        load_parallel(db, tasks, workers or os.cpu_count())
+    else:
+        for entry in entries:
+            with db.conn:
+                load_folder_data(db, data_folder, entry, loaded_units, bulk)
+        for folder in consolidated_folders:
+            with db.conn:
+                load_consolidated_data(db, folder, loaded_units, bulk)
+
+    create_secondary_indexes(db)
+    changed_dates = get_changed_dates(loaded_units, previous_units)
+    update_rollups(db, changed_dates=changed_dates)
+    update_facts(db, changed_dates=changed_dates)
+    update_derived_metrics(db)
+    update_sites(db, changed_dates=changed_dates)
+    if bulk:
+        set_pragmas(db, DEFAULT_PRAGMAS)
+    log_load_throughput(db, started_at)
+    db.conn.close()
+    finish_load(root_folder, db_file_path)
+    metrics.write_reports("load", os.path.join(
+        root_folder, METRICS_FOLDER_PATH))
+
+
+def get_release_dates(root_folder, dates=None):
+    """
+        Selects the dates to be loaded from the release index and
+        groups them by their release archive.
+
+        Parameters:
+            root_folder: Root folder of the project
+            dates: Optional set of dates to be loaded. Defaults to all
+                the dates in the release index.
+        Returns:
+            Tuple of dictionary of dates by archive file ID and
+            dictionary of archive details by file ID
+    """
+    files = get_json_from_file(
+        os.path.join(root_folder, RELEASE_INDEX_FILE_NAME))["files"]
+    archive_dates = {}
+    for date, details in sorted(files["dates"].items()):
+        if dates is not None and date not in dates:
+            continue
+        if details["format"] not in SUPPORTED_RELEASE_FORMATS:
+            logging.warning("Skipping {}: unsupported format {}".format(
+                date, details["format"]))
+            continue
+        archive_dates.setdefault(details["fileId"], set()).add(date)
+    return archive_dates, files
+
+
+def get_release_archive(cache_folder, file_id, url):
+    """
+        Gets the local path of a release archive, downloading it into
+        the cache folder if it is not cached yet.
+
+        Parameters:
+            cache_folder: Folder where the archives are cached
+            file_id: File name of the archive
+            url: Download URL of the archive
+        Returns:
+            Path of the cached archive
+    """
+    path = os.path.join(cache_folder, file_id)
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache_folder, exist_ok=True)
+    logging.info("Downloading {}".format(url))
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with atomic_file(path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                file.write(chunk)
+    return path
+
+
+def get_member_location(member_name):
+    """
+        Gets the location and date of a release archive member from its
+        path, which follows the extract_data.py folder layout.
+
+        Parameters:
+            member_name: Path of the member in the archive
+        Returns:
+            Tuple of location type, location ID and date, or None if
+            the member is not in a location data folder. Location IDs
+            are ints, like the location IDs of the data catalog.
+    """
+    parts = member_name.strip("/").split("/")
+    if len(parts) < 2 or not DATE_FOLDER_PATTERN.match(parts[-2]):
+        return None
+    location_ids = [int(match.group(1)) for match in
+                    map(LOCATION_FOLDER_PATTERN.match, parts[:-2]) if match]
+    if len(location_ids) == 0:
+        return "national", 0, parts[-2]
+    if len(location_ids) == 1:
+        return "state", location_ids[0], parts[-2]
+    if len(location_ids) == 2:
+        return "district", location_ids[1], parts[-2]
+    return None
+
+
+def load_release_archive(db, archive_path, dates, loaded_units=None,
+                         bulk=False):
+    """
+        Streams the CSV files of the given dates out of a release
+        archive into the database. Members of other dates are skipped
+        without being extracted to disk.
+
+        Parameters:
+            db: Sqlite database connection
+            archive_path: Path of the .tar.gz release archive
+            dates: Set of dates to be loaded from the archive
+            loaded_units: Files already loaded by previous incremental
+                loads. None loads all the files.
+            bulk: Insert the rows using a single executemany per file,
+                committing once per location and date
+    """
+    logging.info("Loading {} dates from {}".format(len(dates), archive_path))
+    folder = None
+    with tarfile.open(archive_path, "r|gz") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            file = os.path.basename(member.name)
+            table_load_info = TABLE_FILE_MAPPING.get(file)
+            location = get_member_location(member.name)
+            if not table_load_info or not location or \
+                    location[2] not in dates:
+                continue
+
+            location_type, location_id, date = location
+            unit = (location_type, str(location_id), date, file)
+            # Signed like the catalog signature of the extracted file,
+            # whose modification time is set from the member
+            signature = {"size": member.size,
+                         "modified": int(member.mtime * 1000000000)}
+            if not is_unit_changed(loaded_units, unit, signature):
+                continue
+
+            if bulk and folder != os.path.dirname(member.name):
+                db.conn.commit()
+                folder = os.path.dirname(member.name)
+
+            location_col_values = []
+            if table_load_info.get("load_location_columns"):
+                location_col_values = [location_type, location_id]
+            metrics.increment("csv_bytes_read", member.size,
+                              table=table_load_info["table"])
+            # Members of a streamed archive are not seekable, which
+            # io.TextIOWrapper requires
+            with codecs.getreader("utf-8")(
+                    archive.extractfile(member)) as csv_file:
+                load_csv_stream(
+                    db, table_load_info["table"], csv_file,
+                    location_col_values, get_insert_kwargs(table_load_info),
+                    upsert=loaded_units is not None, bulk=bulk)
+            if loaded_units is not None:
+                record_loaded_unit(db, loaded_units, unit, signature)
+    db.conn.commit()
+
+
+def load_cowin_release_data(root_folder, dates=None, incremental=False):
+    """
+        Loads data into sqlite file directly from the release archives
+        listed in release.data.files.json. Archives are downloaded once
+        into data/releases and read from there afterwards.
+
+        Parameter:
+            root_folder: Root folder of the project
+            dates: Optional set of dates to be loaded. Defaults to all
+                the dates in the release index.
+            incremental: Load only the files which are new or changed
+                since the previous incremental load, into the existing
+                sqlite file, instead of rebuilding it
+    """
+    started_at = time.monotonic()
+    archive_dates, files = get_release_dates(root_folder, dates)
+    cache_folder = os.path.join(root_folder, RELEASE_CACHE_FOLDER_PATH)
+    archive_paths = {
+        file_id: get_release_archive(cache_folder, file_id,
+                                     files[file_id]["url"])
+        for file_id in sorted(archive_dates)}
+
+    db_file_path = get_load_path(root_folder, incremental)
+
+    db = Database(db_file_path)
+    loaded_units = None
+    previous_units = {}
+    if incremental:
+        loaded_units = get_loaded_units(db)
+        previous_units = dict(loaded_units)
+    else:
+        set_pragmas(db, BULK_LOAD_PRAGMAS)
+    if "states" not in db.table_names():
+        load_state_district_meta_data(db)
+
+    for file_id, archive_path in archive_paths.items():
+        load_release_archive(db, archive_path, archive_dates[file_id],
+                             loaded_units, bulk=not incremental)
+
+    create_secondary_indexes(db)
+    changed_dates = get_changed_dates(loaded_units, previous_units)
+    update_rollups(db, changed_dates=changed_dates)
+    update_facts(db, changed_dates=changed_dates)
+    update_derived_metrics(db)
+    update_sites(db, changed_dates=changed_dates)
+    if not incremental:
+        set_pragmas(db, DEFAULT_PRAGMAS)
+    log_load_throughput(db, started_at)
+    db.conn.close()
+    finish_load(root_folder, db_file_path)
+    metrics.write_reports("load", os.path.join(
+        root_folder, METRICS_FOLDER_PATH))
+
+
+def get_payload_records(data):
+    """
+        Maps a COWIN payload into rows of the TABLE_FILE_MAPPING tables
+        using the DATA_MAPPING paths, without converting it into CSV.
+        The rows have the JSON values, which insert_rows converts into
+        the column types like the CSV values.
+
+        Parameters:
+            data: COWIN payload with date, location_type and location_id
+        Returns:
+            Generator of table load information, headers and rows
+    """
+    location_type = data["location_type"]
+    location_id = data["location_id"]
+    for data_type, config in get_location_mappings(location_type):
+        table_load_info = TABLE_FILE_MAPPING.get("{}.csv".format(data_type))
+        if not table_load_info:
+            logging.warning("No mapping available for {}".format(data_type))
+            continue
+        obj = get_nested_object(data, config["path"])
+        if obj is None:
+            continue
+        columns, rows = get_rows(obj, config["type"], config)
+        headers = ["date", *columns]
+        prefix = [data["date"]]
+        if table_load_info.get("load_location_columns"):
+            headers = ["location_type", "location_id"] + headers
+            prefix = [location_type, location_id] + prefix
+        yield table_load_info, headers, [prefix + row for row in rows]
+
+
+def load_payload(db, data, csv_folder=None):
+    """
+        Loads a COWIN payload directly into the tables, without
+        committing.
+
+        Parameters:
+            db: Sqlite database connection
+            data: COWIN payload with date, location_type and location_id
+            csv_folder: Optional folder where the payload is also
+                exported as CSV files
+    """
+    for table_load_info, headers, rows in get_payload_records(data):
+        insert_rows(db, table_load_info["table"], headers, rows,
+                    get_insert_kwargs(table_load_info), upsert=True,
+                    bulk=True)
+    if csv_folder:
+        os.makedirs(csv_folder, exist_ok=True)
+        convert_data(data["location_type"], csv_folder, data)
+
+
+def get_location_folders():
+    """
+        Gets the CSV folder of every location, in the layout
+        used by extract_data.py.
+
+        Returns:
+            Dictionary of folder paths by location type and location ID
+    """
+    folders = {("national", 0): ""}
+    state_folders = {}
+    for state in get_json_from_file("states.json"):
+        folder = "{}-{}".format(state["id"], normalize_name(state["name"]))
+        state_folders[state["id"]] = folder
+        folders[("state", state["id"])] = folder
+    for district in get_json_from_file("districts.json"):
+        folders[("district", district["district_id"])] = os.path.join(
+            state_folders[district["state_id"]], "{}-{}".format(
+                district["district_id"],
+                normalize_name(district["district_name"])))
+    return folders
+
+
+def iter_json_payloads(data_folder):
+    """
+        Reads the payloads saved by src/cowin_data_extractor.py, both
+        JSON files and compressed raw archives.
+
+        Parameters:
+            data_folder: data folder of the project
+        Returns:
+            Generator of COWIN payloads
+    """
+    cowin_folder = os.path.join(data_folder, "cowin")
+    if os.path.exists(cowin_folder):
+        for date in sorted(os.listdir(cowin_folder)):
+            if not DATE_FOLDER_PATTERN.match(date):
+                continue
+            date_folder = os.path.join(cowin_folder, date)
+            files = glob.glob(os.path.join(date_folder, "national.json"))
+            files += sorted(glob.glob(
+                os.path.join(date_folder, "states", "*.json")))
+            files += sorted(glob.glob(
+                os.path.join(date_folder, "districts", "*.json")))
+            for file in files:
+                yield get_json_from_file(file)
+    archive_folder = os.path.join(data_folder, "cowin-raw")
+    if os.path.exists(archive_folder):
+        for index_file in sorted(glob.glob(
+                os.path.join(archive_folder, "*.index.json"))):
+            date = os.path.basename(index_file)[:-len(".index.json")]
+            for data in RawArchiveReader(archive_folder, date):
+                yield data
+
+
+def load_cowin_json_data(root_folder, csv_export=False):
+    """
+        Loads raw JSON payloads directly into sqlite file, skipping
+        the CSV conversion.
+
+        Parameter:
+            root_folder: Root folder of the project
+            csv_export: Also export the payloads as CSV files into
+                data/cowin in the layout of extract_data.py
+    """
+    db_file_path = get_load_path(root_folder)
+
+    db = Database(db_file_path)
+    load_state_district_meta_data(db)
+
+    data_folder = os.path.join(root_folder, "data")
+    location_folders = get_location_folders() if csv_export else None
+    catalog = DataCatalog(os.path.join(data_folder, "cowin"),
+                          os.path.join(root_folder, CATALOG_FOLDER_PATH))
+    # The payloads of a date are loaded in a single transaction
+    for date, payloads in itertools.groupby(
+            iter_json_payloads(data_folder), key=lambda data: data["date"]):
+        csv_folders = []
+        with db.conn:
+            for data in payloads:
+                logging.info(
+                    "Processing {location_type} {location_id} for {date}".format(
+                        **data))
+                csv_folder = None
+                if csv_export:
+                    csv_folder = os.path.join(
+                        data_folder, "cowin", location_folders[
+                            (data["location_type"], data["location_id"])],
+                        date)
+                    csv_folders.append(csv_folder)
+                load_payload(db, data, csv_folder)
+        for csv_folder in csv_folders:
+            catalog.add_folder(csv_folder)
+
+    create_secondary_indexes(db)
+    update_rollups(db)
+    update_facts(db)
+    update_derived_metrics(db)
+    update_sites(db)
     db.conn.close()
+    finish_load(root_folder, db_file_path)
+    metrics.write_reports("load", os.path.join(
+        root_folder, METRICS_FOLDER_PATH))
 
 
 if __name__ == "__main__":
     folder = os.path.dirname(os.path.abspath(__file__))
-    load_cowin_data(folder)
+    args = sys.argv
+    if len(args) >= 2 and args[1] == "json":
+        load_cowin_json_data(folder, len(args) >= 3 and args[2] == "csv")
+    elif len(args) >= 2 and args[1] == "release":
+        load_cowin_release_data(folder, set(args[2:]) or None)
+    else:
+        mode = args[1] if len(args) >= 2 else None
+        workers = int(args[2]) if len(args) >= 3 else None
+        load_cowin_data(folder, mode == "incremental", mode == "bulk",
+                        workers)
@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import argparse
+import functools
+import threading
+from sqlite_utils import Database
+import extract_data
+from backfill import date_range, parse_ids
+from checkpoint import CheckpointManifest, location_key, \
+    PENDING, FETCHED, CONVERTED
+from fetch_engine import build_job, run_jobs, DEFAULT_WORKERS, \
+    DEFAULT_LIMIT_PER_HOST
+from instrumentation import metrics, METRICS_FOLDER_PATH
+from fingerprint_store import FingerprintStore, get_fingerprint, \
+    NEW, CHANGED, UNCHANGED, STALE
+from load_cowin_data_sqlite import DB_FILE_NAME, get_payload_records, \
+    insert_rows, get_insert_kwargs, load_state_district_meta_data, \
+    create_secondary_indexes, mark_load_finished, log_load_throughput
+from rollup_cowin_data import update_rollups
+from rolling_window_facts import update_facts
+from derived_metrics import update_derived_metrics
+from site_dimension import update_sites
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+CHECKPOINT_FOLDER_PATH = os.path.join("data", "checkpoints", "pipeline")
+
+# Converted payloads waiting for the writer. Fetch workers block when
+# the queue is full, which stops the fetch engine from reading more
+# responses, so memory does not grow when the database is slower than
+# the network.
+DEFAULT_QUEUE_SIZE = 32
+
+# Maximum payloads loaded in a single transaction
+MAX_BATCH_SIZE = 64
+
+STOP = None
+
+
+def get_pipeline_locations(state_district_data, test_mode, state_ids=None,
+                           district_ids=None):
+    """
+        Gets the locations fetched by the pipeline, with the filters of
+        extract_data.extract_date_jobs.
+
+        Returns:
+            List of location type, location ID and URL arguments
+    """
+    locations = []
+    if not state_ids and not district_ids:
+        locations.append(("national", 0, ()))
+    for state_id, state_info in state_district_data.items():
+        if state_ids and state_id not in state_ids:
+            continue
+        if (state_ids or not district_ids) and (
+                not test_mode or state_id in extract_data.TEST_MODE_STATE_IDS):
+            locations.append(("state", state_id, (state_id,)))
+        for district in state_info["districts"]:
+            district_id = district["id"]
+            if test_mode and \
+                    district_id not in extract_data.TEST_MODE_DISTRICT_IDS:
+                continue
+            if district_ids and district_id not in district_ids:
+                continue
+            locations.append(
+                ("district", district_id, (state_id, district_id)))
+    return locations
+
+
+def convert_payload(date, location_type, location_id, manifest, key,
+                    store, payload_queue, body):
+    """
+        Converts a fetched payload into table rows and queues them for
+        the writer. Runs in the fetch worker threads and blocks while
+        the queue is full. Payloads with the same content hash as the
+        loaded payload of the location and date are neither parsed nor
+        loaded, and changed payloads with a COWIN timestamp older than
+        the loaded payload are discarded.
+    """
+    manifest.update(key, FETCHED)
+    fingerprint = get_fingerprint(body)
+    status = store.check(date, location_type, location_id, fingerprint)
+    if status == UNCHANGED:
+        metrics.increment("payloads", status=status)
+        manifest.update(key, CONVERTED)
+        return
+    data = json.loads(body)
+    timestamp = data.get("timestamp")
+    if status == CHANGED and \
+            store.is_stale(date, location_type, location_id, timestamp):
+        logging.warning("Discarding stale payload of {} for {}: {}".format(
+            key, date, timestamp))
+        metrics.increment("payloads", status=STALE)
+        manifest.update(key, CONVERTED)
+        return
+    data.update({"date": date, "location_type": location_type,
+                 "location_id": location_id})
+    with metrics.stage("convert", location_type=location_type):
+        records = [(table_load_info, headers, rows)
+                   for table_load_info, headers, rows
+                   in get_payload_records(data)]
+    started_at = time.perf_counter()
+    payload_queue.put((manifest, key, records, status,
+                       (date, location_type, location_id, fingerprint,
+                        timestamp)))
+    metrics.observe("stage_seconds", time.perf_counter() - started_at,
+                    stage="queue_wait")
+
+
+class PayloadWriter(threading.Thread):
+    """
+        Single writer of the database. Loads the converted payloads in
+        the order they arrive. The payloads queued while a transaction
+        is written are loaded together in the next one, so commits get
+        less frequent as the writer falls behind. The fingerprints of
+        the payloads are recorded in the same transaction, and locations
+        are marked as converted in their manifest, if any, once they are
+        committed.
+        After a failure the remaining payloads are discarded, so that
+        the fetch workers are not blocked, and the error is raised by
+        join_writer.
+    """
+
+    def __init__(self, db_path, payload_queue, store):
+        super().__init__(name="pipeline-writer", daemon=True)
+        self.db_path = db_path
+        self.payload_queue = payload_queue
+        self.store = store
+        self.error = None
+        self.loaded = 0
+        # Dates of the loaded payloads, which the derived tables update
+        self.loaded_dates = set()
+
+    def run(self):
+        db = None
+        try:
+            db = Database(self.db_path)
+        except Exception as error:
+            self.error = error
+        stopped = False
+        while not stopped:
+            batch = [self.payload_queue.get()]
+            while len(batch) < MAX_BATCH_SIZE and batch[-1] is not STOP:
+                try:
+                    batch.append(self.payload_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is STOP:
+                batch.pop()
+                stopped = True
+            if self.error or not batch:
+                continue
+            try:
+                self.load(db, batch)
+            except Exception as error:
+                logging.exception("Pipeline writer failed")
+                self.error = error
+        if db:
+            db.conn.close()
+
+    def load(self, db, batch):
+        with metrics.stage("load_batch"), db.conn:
+            for manifest, key, records, status, fingerprint in batch:
+                for table_load_info, headers, rows in records:
+                    insert_rows(db, table_load_info["table"], headers, rows,
+                                get_insert_kwargs(table_load_info),
+                                upsert=True, bulk=True)
+                self.store.record(db, *fingerprint)
+        for manifest, key, records, status, fingerprint in batch:
+            if manifest:
+                manifest.update(key, CONVERTED)
+            metrics.increment("payloads", status=status)
+            self.loaded_dates.add(fingerprint[0])
+        self.loaded += len(batch)
+
+    def join_writer(self):
+        self.payload_queue.put(STOP)
+        self.join()
+        if self.error:
+            raise self.error
+
+
+def update_derived_tables(db_path, loaded_dates):
+    """
+        Updates the indexes and derived tables once the writer loaded
+        the payloads of the dates.
+    """
+    db = Database(db_path)
+    create_secondary_indexes(db)
+    update_rollups(db, changed_dates=loaded_dates)
+    update_facts(db, changed_dates=loaded_dates)
+    update_derived_metrics(db)
+    update_sites(db, changed_dates=loaded_dates)
+    return db
+
+
+def build_pipeline_jobs(locations, date, manifest, store, payload_queue,
+                        refresh=False):
+    jobs = []
+    for location_type, location_id, url_args in locations:
+        key = location_key(location_type, location_id)
+        if not refresh and manifest.get_status(key) == CONVERTED:
+            continue
+        manifest.update(key, PENDING)
+        jobs.append(build_job(
+            extract_data.build_url(date, *url_args),
+            functools.partial(convert_payload, date, location_type,
+                              location_id, manifest, key, store,
+                              payload_queue),
+            functools.partial(manifest.record_failure, key), raw=True))
+    return jobs
+
+
+def run_pipeline(root_folder, dates, test_mode=False, state_ids=None,
+                 district_ids=None, workers=DEFAULT_WORKERS,
+                 limit_per_host=DEFAULT_LIMIT_PER_HOST,
+                 queue_size=DEFAULT_QUEUE_SIZE, refresh=False):
+    """
+        Fetches the locations of the dates and loads every payload into
+        the sqlite file as soon as it arrives, so that fetching and
+        loading overlap. Payloads are upserted into the existing sqlite
+        file and locations already loaded by a previous run of a date
+        are skipped. With refresh, the locations are fetched again and
+        only the payloads whose content changed are loaded.
+
+        Parameters:
+            root_folder: Root folder of the project
+            dates: Dates for which the data needs to be retrieved
+            test_mode: Extract only whitelisted entries
+            state_ids: Optional set of state IDs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            workers: Number of concurrent fetch workers
+            limit_per_host: Maximum open connections to COWIN API
+            queue_size: Number of converted payloads waiting for the
+                writer before the fetch workers are blocked
+            refresh: Fetch the locations already loaded again, e.g. for
+                intraday updates
+        Returns:
+            Fetch statistics returned by run_jobs, with the number of
+            payloads by fingerprint status
+    """
+    started_at = time.monotonic()
+    db_path = os.path.join(root_folder, DB_FILE_NAME)
+    db = Database(db_path)
+    if "states" not in db.table_names():
+        load_state_district_meta_data(db)
+    store = FingerprintStore(db)
+    db.conn.close()
+
+    state_district_data = extract_data.get_state_districts_data()
+    locations = get_pipeline_locations(
+        state_district_data, test_mode, state_ids, district_ids)
+    payload_queue = queue.Queue(queue_size)
+    writer = PayloadWriter(db_path, payload_queue, store)
+    writer.start()
+    manifests = []
+    jobs = []
+    try:
+        for date in dates:
+            manifest = CheckpointManifest(os.path.join(
+                root_folder, CHECKPOINT_FOLDER_PATH, "{}.jsonl".format(date)))
+            manifests.append(manifest)
+            jobs += build_pipeline_jobs(locations, date, manifest, store,
+                                        payload_queue, refresh)
+        stats = run_jobs(jobs, workers, limit_per_host)
+    finally:
+        writer.join_writer()
+        for manifest in manifests:
+            manifest.close()
+    stats["payloads"] = {status: metrics.get_count("payloads", status=status)
+                         for status in (NEW, CHANGED, UNCHANGED, STALE)}
+    logging.info("Loaded {} locations. Payloads: {new} new, {changed} "
+                 "changed, {unchanged} unchanged, {stale} stale".format(
+                     writer.loaded, **stats["payloads"]))
+
+    db = update_derived_tables(db_path, writer.loaded_dates)
+    log_load_throughput(db, started_at)
+    db.conn.close()
+    mark_load_finished(root_folder)
+    metrics.write_reports("pipeline", os.path.join(
+        root_folder, METRICS_FOLDER_PATH))
+    return stats
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Fetch COWIN data and load it into covid-ds.db as it arrives")
+    parser.add_argument("start_date", help="Start date (YYYY-MM-DD)")
+    parser.add_argument("end_date", nargs="?",
+                        help="End date (YYYY-MM-DD), inclusive. "
+                             "Defaults to the start date")
+    parser.add_argument("--states", type=parse_ids,
+                        help="Comma separated state IDs")
+    parser.add_argument("--districts", type=parse_ids,
+                        help="Comma separated district IDs")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--limit-per-host", type=int,
+                        default=DEFAULT_LIMIT_PER_HOST)
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="Converted payloads waiting to be loaded")
+    parser.add_argument("--test-mode", action="store_true",
+                        help="Extract only the whitelisted test locations")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Fetch the locations already loaded again and "
+                             "load the changed payloads")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_args(sys.argv[1:])
+    run_pipeline(SCRIPT_FOLDER,
+                 list(date_range(options.start_date,
+                                 options.end_date or options.start_date)),
+                 options.test_mode, options.states, options.districts,
+                 options.workers, options.limit_per_host, options.queue_size,
+                 options.refresh)
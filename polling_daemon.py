@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import logging
+import argparse
+import datetime
+import functools
+import threading
+from sqlite_utils import Database
+import extract_data
+from backfill import parse_ids
+from checkpoint import atomic_file, location_key
+from fetch_engine import build_job, run_jobs, DEFAULT_WORKERS, \
+    DEFAULT_LIMIT_PER_HOST
+from request_scheduler import RequestScheduler
+from instrumentation import metrics, METRICS_FOLDER_PATH
+from fingerprint_store import FingerprintStore, get_fingerprint, \
+    CHANGED, UNCHANGED, STALE
+from load_cowin_data_sqlite import TABLE_FILE_MAPPING, get_payload_records
+from table_schema import TEXT
+from pipeline import PayloadWriter, get_pipeline_locations, \
+    DEFAULT_QUEUE_SIZE
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Intraday snapshots are kept out of covid-ds.db, which is rebuilt by
+# the loader
+DB_FILE_NAME = "covid-ds-intraday.db"
+
+SCHEDULE_FILE_PATH = os.path.join("data", "polling", "schedule.json")
+
+# Intraday time series and the append only tables of their snapshots
+INTRADAY_TABLES = {
+    "raw_session_vaccination_count": "intraday_session_vaccination_count",
+    "raw_national_timewise_today_registration":
+        "intraday_national_timewise_today_registration"
+}
+
+# Poll intervals of a location in seconds
+MIN_POLL_INTERVAL = 300
+MAX_POLL_INTERVAL = 3600
+DEFAULT_POLL_INTERVAL = 900
+
+# Growth of the vaccinations of the day between two polls of a location.
+# Locations are polled about as often as their count grows by this much.
+TARGET_CHANGE = 1000
+
+# Requests per hour across all the locations
+DEFAULT_REQUEST_BUDGET = 3600
+
+# Seconds between checks for due locations
+TICK_INTERVAL = 10
+
+# Seconds between metrics reports
+REPORT_INTERVAL = 900
+
+
+def get_intraday_load_info(table_load_info):
+    """
+        Builds the load information of the intraday table of a raw
+        table. Rows are keyed by the poll time as well, so every
+        snapshot is appended.
+    """
+    return {
+        "table": INTRADAY_TABLES[table_load_info["table"]],
+        "columns": {**table_load_info.get("columns", {}),
+                    "polled_at": TEXT, "cowin_timestamp": TEXT},
+        "pk": (*table_load_info["pk"], "polled_at")
+    }
+
+
+INTRADAY_LOAD_INFO = {
+    table_load_info["table"]: get_intraday_load_info(table_load_info)
+    for table_load_info in TABLE_FILE_MAPPING.values()
+    if table_load_info["table"] in INTRADAY_TABLES
+}
+
+
+def get_intraday_records(data, polled_at):
+    """
+        Maps the intraday time series of a payload into rows of the
+        intraday tables.
+
+        Parameters:
+            data: COWIN payload with date, location_type and location_id
+            polled_at: Time of the poll in ISO format
+        Returns:
+            List of table load information, headers and rows
+    """
+    records = []
+    for table_load_info, headers, rows in get_payload_records(data):
+        intraday_load_info = INTRADAY_LOAD_INFO.get(table_load_info["table"])
+        if not intraday_load_info:
+            continue
+        suffix = [polled_at, data.get("timestamp")]
+        records.append((intraday_load_info,
+                        headers + ["polled_at", "cowin_timestamp"],
+                        [row + suffix for row in rows]))
+    return records
+
+
+def get_today_count(data):
+    vaccination = data.get("topBlock", {}).get("vaccination") or {}
+    return vaccination.get("today") or 0
+
+
+class PollSchedule:
+    """
+        Poll intervals of the locations. After every poll, the interval
+        of a location is set from the growth rate of its vaccinations of
+        the day, so that active locations are polled more often. The
+        interval of a location whose payload did not change is doubled,
+        and a location whose payload changed without a known growth rate,
+        e.g. on its first poll of the day, is back to the default interval.
+
+        When more locations are due than the request budget allows,
+        locations which are late by more of their own intervals go first.
+        Active locations get ahead quickly, while idle locations are
+        still polled once they are late enough.
+    """
+
+    def __init__(self, locations, path, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL):
+        """
+            Parameters:
+                locations: List of location type, location ID and URL
+                    arguments of get_pipeline_locations
+                path: JSON file where the schedule is kept across runs
+                min_interval: Minimum poll interval in seconds
+                max_interval: Maximum poll interval in seconds
+        """
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lock = threading.Lock()
+        saved = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                saved = json.load(file)
+        self.entries = {}
+        for location_type, location_id, url_args in locations:
+            key = location_key(location_type, location_id)
+            entry = {"interval": DEFAULT_POLL_INTERVAL, "next_poll_at": 0,
+                     "polled_at": None, "date": None, "today": None,
+                     "rate": 0.0}
+            entry.update(saved.get(key, {}))
+            entry.update({"location_type": location_type,
+                          "location_id": location_id,
+                          "url_args": list(url_args)})
+            entry["interval"] = self.clamp(entry["interval"])
+            self.entries[key] = entry
+
+    def clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def get_due(self, now, limit):
+        """
+            Gets the locations due for a poll, by priority.
+
+            Parameters:
+                now: Current time in seconds since the epoch
+                limit: Maximum number of locations
+            Returns:
+                List of location keys
+        """
+        with self.lock:
+            due = [(key, (now - entry["next_poll_at"] + entry["interval"]) /
+                    entry["interval"])
+                   for key, entry in self.entries.items()
+                   if entry["next_poll_at"] <= now]
+        due.sort(key=lambda item: item[1], reverse=True)
+        return [key for key, _ in due[:limit]]
+
+    def get_next_poll_at(self):
+        with self.lock:
+            return min(entry["next_poll_at"]
+                       for entry in self.entries.values())
+
+    def record_poll(self, key, date, polled_at, status, today=None):
+        """
+            Sets the interval and the next poll time of a location.
+
+            Parameters:
+                key: Location key
+                date: Date which was polled
+                polled_at: Time of the poll in seconds since the epoch
+                status: Fingerprint status of the payload
+                today: Vaccinations of the day in the payload, for
+                    payloads which were loaded
+        """
+        with self.lock:
+            entry = self.entries[key]
+            if status in (UNCHANGED, STALE):
+                entry["rate"] = 0.0
+                entry["interval"] = self.clamp(entry["interval"] * 2)
+            else:
+                rate = 0.0
+                if entry["date"] == date and entry["today"] is not None:
+                    elapsed = max(polled_at - entry["polled_at"], 1.0)
+                    rate = max(today - entry["today"], 0) / elapsed
+                entry["rate"] = rate
+                entry["interval"] = self.clamp(
+                    TARGET_CHANGE / rate if rate else DEFAULT_POLL_INTERVAL)
+                entry["today"] = today
+                entry["date"] = date
+            entry["polled_at"] = polled_at
+            entry["next_poll_at"] = polled_at + entry["interval"]
+
+    def record_failure(self, key, polled_at, error):
+        with self.lock:
+            entry = self.entries[key]
+            entry["next_poll_at"] = polled_at + entry["interval"]
+
+    def save(self):
+        with self.lock:
+            saved = {key: {name: entry[name] for name in
+                           ("interval", "next_poll_at", "polled_at", "date",
+                            "today", "rate")}
+                     for key, entry in self.entries.items()}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_file(self.path) as file:
+            json.dump(saved, file, indent=2)
+
+
+class RequestBudget:
+    """
+        Token bucket of the requests per hour of the daemon. At most a
+        minute of unused budget is saved up. Retries can overdraw it,
+        which holds back the next polls until it is paid back.
+    """
+
+    def __init__(self, requests_per_hour):
+        self.rate = requests_per_hour / 3600.0
+        self.capacity = max(1.0, requests_per_hour / 60.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def get_available(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return max(0, int(self.tokens))
+
+    def spend(self, count):
+        self.tokens -= count
+
+
+def poll_payload(date, location_type, location_id, schedule, store,
+                 payload_queue, polled_at, body):
+    """
+        Queues the intraday snapshot of a polled payload for the writer
+        and reschedules the location. Runs in the fetch worker threads.
+    """
+    key = location_key(location_type, location_id)
+    fingerprint = get_fingerprint(body)
+    status = store.check(date, location_type, location_id, fingerprint)
+    if status == UNCHANGED:
+        metrics.increment("payloads", status=status)
+        schedule.record_poll(key, date, polled_at, status)
+        return
+    data = json.loads(body)
+    timestamp = data.get("timestamp")
+    if status == CHANGED and \
+            store.is_stale(date, location_type, location_id, timestamp):
+        metrics.increment("payloads", status=STALE)
+        schedule.record_poll(key, date, polled_at, STALE)
+        return
+    data.update({"date": date, "location_type": location_type,
+                 "location_id": location_id})
+    polled_at_text = datetime.datetime.fromtimestamp(polled_at).isoformat(
+        timespec="seconds")
+    with metrics.stage("convert", location_type=location_type):
+        records = get_intraday_records(data, polled_at_text)
+    schedule.record_poll(key, date, polled_at, status, get_today_count(data))
+    payload_queue.put((None, key, records, status,
+                       (date, location_type, location_id, fingerprint,
+                        timestamp)))
+
+
+class PollingDaemon:
+    """
+        Polls the locations for the current date on the schedule and
+        appends the intraday snapshots of changed payloads to the
+        intraday tables, until it is stopped.
+    """
+
+    def __init__(self, root_folder, locations, requests_per_hour,
+                 workers=DEFAULT_WORKERS, limit_per_host=DEFAULT_LIMIT_PER_HOST,
+                 min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL):
+        self.root_folder = root_folder
+        self.db_path = os.path.join(root_folder, DB_FILE_NAME)
+        self.schedule = PollSchedule(
+            locations, os.path.join(root_folder, SCHEDULE_FILE_PATH),
+            min_interval, max_interval)
+        self.budget = RequestBudget(requests_per_hour)
+        self.workers = workers
+        self.limit_per_host = limit_per_host
+        self.rate = None
+        self.stopped = threading.Event()
+
+    def stop(self, *args):
+        logging.info("Stopping the polling daemon")
+        self.stopped.set()
+
+    def poll(self, keys, store, payload_queue):
+        """
+            Polls the locations once. Returns the number of requests
+            made, including the retries.
+        """
+        date = datetime.date.today().isoformat()
+        polled_at = time.time()
+        jobs = []
+        for key in keys:
+            entry = self.schedule.entries[key]
+            jobs.append(build_job(
+                extract_data.build_url(date, *entry["url_args"]),
+                functools.partial(poll_payload, date, entry["location_type"],
+                                  entry["location_id"], self.schedule, store,
+                                  payload_queue, polled_at),
+                functools.partial(self.schedule.record_failure, key,
+                                  polled_at), raw=True))
+        # The scheduler is bound to the event loop of run_jobs, so a new
+        # one is created for every poll, starting at the adapted rate
+        scheduler = RequestScheduler(self.rate) if self.rate \
+            else RequestScheduler()
+        stats = run_jobs(jobs, self.workers, self.limit_per_host, scheduler)
+        self.rate = scheduler.limiter.rate
+        return stats["requests"]["requests"]
+
+    def write_reports(self):
+        metrics.write_reports("poll", os.path.join(
+            self.root_folder, METRICS_FOLDER_PATH))
+        metrics.reset()
+
+    def run(self, once=False):
+        """
+            Polls the due locations every tick within the request budget.
+
+            Parameters:
+                once: Poll the due locations once and return
+        """
+        db = Database(self.db_path)
+        store = FingerprintStore(db)
+        db.conn.close()
+        payload_queue = queue.Queue(DEFAULT_QUEUE_SIZE)
+        writer = PayloadWriter(self.db_path, payload_queue, store)
+        writer.start()
+        reported_at = time.monotonic()
+        try:
+            while not self.stopped.is_set():
+                keys = self.schedule.get_due(
+                    time.time(), self.budget.get_available())
+                if keys:
+                    self.budget.spend(len(keys))
+                    requests = self.poll(keys, store, payload_queue)
+                    # Every attempt of the fetch engine counts, so the
+                    # retries are charged once they are known
+                    self.budget.spend(max(requests - len(keys), 0))
+                    self.schedule.save()
+                if once:
+                    break
+                if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                    self.write_reports()
+                    reported_at = time.monotonic()
+                wait = min(TICK_INTERVAL,
+                           max(self.schedule.get_next_poll_at() - time.time(),
+                               1))
+                self.stopped.wait(wait)
+        finally:
+            writer.join_writer()
+            self.schedule.save()
+            self.write_reports()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Poll COWIN intraday data into {}".format(DB_FILE_NAME))
+    parser.add_argument("--states", type=parse_ids,
+                        help="Comma separated state IDs")
+    parser.add_argument("--districts", type=parse_ids,
+                        help="Comma separated district IDs")
+    parser.add_argument("--budget", type=int, default=DEFAULT_REQUEST_BUDGET,
+                        help="Requests per hour across all the locations")
+    parser.add_argument("--min-interval", type=int, default=MIN_POLL_INTERVAL,
+                        help="Minimum poll interval of a location in seconds")
+    parser.add_argument("--max-interval", type=int, default=MAX_POLL_INTERVAL,
+                        help="Maximum poll interval of a location in seconds")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--limit-per-host", type=int,
+                        default=DEFAULT_LIMIT_PER_HOST)
+    parser.add_argument("--test-mode", action="store_true",
+                        help="Poll only the whitelisted test locations")
+    parser.add_argument("--once", action="store_true",
+                        help="Poll the due locations once and exit")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    options = parse_args(sys.argv[1:])
+    locations = get_pipeline_locations(
+        extract_data.get_state_districts_data(), options.test_mode,
+        options.states, options.districts)
+    daemon = PollingDaemon(SCRIPT_FOLDER, locations, options.budget,
+                           options.workers, options.limit_per_host,
+                           options.min_interval, options.max_interval)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run(options.once)
@@ -0,0 +1,369 @@
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import logging
+import asyncio
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from site_dimension import SEARCH_SITES_SQL, SITES_FTS_TABLE, SITES_TABLE, \
+    DEFAULT_SEARCH_LIMIT, get_search_query
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+DB_FILE_NAME = "covid-ds.db"
+
+# Written by load_cowin_data_sqlite.py when a load finishes
+LOAD_MARKER_FILE_NAME = "covid-ds.db.loaded"
+
+DEFAULT_PORT = 8080
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHE_SIZE = 1024
+
+DEFAULT_RANKING_LIMIT = 10
+MAX_RANKING_LIMIT = 1000
+
+MAX_SEARCH_LIMIT = 100
+
+RANKING_METRICS = set([
+    "total", "tot_dose_1", "tot_dose_2",
+    "daily_total", "daily_dose_1", "daily_dose_2"
+])
+
+SERIES_SQL = """SELECT date, total, tot_dose_1, tot_dose_2,
+    daily_total, daily_dose_1, daily_dose_2
+FROM rollup_daily_vaccination
+WHERE location_type = :location_type AND location_id = :location_id
+    AND date BETWEEN :start_date AND :end_date
+ORDER BY date"""
+
+STATE_RANKING_SQL = """SELECT r.location_id AS state_id, s.name,
+    r.total, r.tot_dose_1, r.tot_dose_2,
+    r.daily_total, r.daily_dose_1, r.daily_dose_2
+FROM rollup_daily_vaccination r
+JOIN states s ON s.id = r.location_id
+WHERE r.location_type = 'state' AND r.date = :date
+ORDER BY r.[{metric}] DESC
+LIMIT :limit"""
+
+DISTRICT_RANKING_SQL = """SELECT r.location_id AS district_id, d.name,
+    d.state_id, r.total, r.tot_dose_1, r.tot_dose_2,
+    r.daily_total, r.daily_dose_1, r.daily_dose_2
+FROM rollup_daily_vaccination r
+JOIN districts d ON d.id = r.location_id
+WHERE r.location_type = 'district' AND r.date = :date
+    AND (:state_id IS NULL OR d.state_id = :state_id)
+ORDER BY r.[{metric}] DESC
+LIMIT :limit"""
+
+SITES_SQL = """SELECT * FROM raw_site_level_vaccination_count
+WHERE location_type = 'district' AND location_id = :district_id
+    AND date = :date
+ORDER BY total DESC"""
+
+SITE_SQL = """SELECT * FROM sites WHERE session_site_id = :session_site_id"""
+
+
+class QueryError(ValueError):
+    """
+        Raised for invalid query parameters.
+    """
+
+
+class DatabaseUnavailable(Exception):
+    """
+        Raised when the database is missing or cannot be read, e.g.
+        while a rebuild replaces it.
+    """
+
+
+def get_param(params, name, convert=str, default=None, required=True):
+    value = params.get(name)
+    if value is None or value == "":
+        if required and default is None:
+            raise QueryError("Missing parameter {}".format(name))
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        raise QueryError("Invalid parameter {}: {}".format(name, value))
+
+
+def get_limit(params, default, maximum):
+    """
+        Gets the limit parameter, capped at the maximum. Limits below 1
+        are rejected, as SQLite reads a negative limit as no limit.
+    """
+    limit = get_param(params, "limit", int, default)
+    if limit < 1:
+        raise QueryError("Invalid parameter limit: {}".format(limit))
+    return min(maximum, limit)
+
+
+def fetch_rows(conn, sql, params):
+    cursor = conn.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def query_series(conn, params):
+    """
+        Daily vaccination time series of a location.
+        Parameters: location_type, location_id, optional start and end.
+    """
+    return fetch_rows(conn, SERIES_SQL, {
+        "location_type": get_param(params, "location_type"),
+        "location_id": get_param(params, "location_id", int),
+        "start_date": get_param(params, "start", default="0000-00-00"),
+        "end_date": get_param(params, "end", default="9999-99-99")
+    })
+
+
+def query_rankings(conn, params):
+    """
+        States or districts ranked by a vaccination metric for a date.
+        Parameters: location_type (state or district), date, optional
+        metric, limit and state_id (districts only).
+    """
+    location_type = get_param(params, "location_type")
+    metric = get_param(params, "metric", default="total")
+    if metric not in RANKING_METRICS:
+        raise QueryError("Invalid parameter metric: {}".format(metric))
+    values = {"date": get_param(params, "date"),
+              "limit": get_limit(params, DEFAULT_RANKING_LIMIT,
+                                 MAX_RANKING_LIMIT)}
+    if location_type == "state":
+        sql = STATE_RANKING_SQL
+    elif location_type == "district":
+        sql = DISTRICT_RANKING_SQL
+        values["state_id"] = get_param(params, "state_id", int,
+                                       required=False)
+    else:
+        raise QueryError("Invalid parameter location_type: {}".format(
+            location_type))
+    return fetch_rows(conn, sql.format(metric=metric), values)
+
+
+def query_sites(conn, params):
+    """
+        Vaccination sites of a district for a date.
+        Parameters: district_id, date.
+    """
+    return fetch_rows(conn, SITES_SQL, {
+        "district_id": get_param(params, "district_id", int),
+        "date": get_param(params, "date")
+    })
+
+
+def query_site(conn, params):
+    """
+        Vaccination site with its district, state and the first and
+        last dates it was listed.
+        Parameters: session_site_id.
+    """
+    return fetch_rows(conn, SITE_SQL, {
+        "session_site_id": get_param(params, "session_site_id", int)
+    })
+
+
+def query_site_search(conn, params):
+    """
+        Vaccination sites whose names have all the words of a search
+        text, the last word as a prefix.
+        Parameters: q, optional district_id, state_id and limit.
+    """
+    query = get_search_query(get_param(params, "q"))
+    if not query:
+        raise QueryError("Invalid parameter q: no words to search")
+    return fetch_rows(conn, SEARCH_SITES_SQL.format(
+        fts=SITES_FTS_TABLE, sites=SITES_TABLE), {
+        "query": query,
+        "district_id": get_param(params, "district_id", int, required=False),
+        "state_id": get_param(params, "state_id", int, required=False),
+        "limit": get_limit(params, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+    })
+
+
+QUERIES = {
+    "series": query_series,
+    "rankings": query_rankings,
+    "sites": query_sites,
+    "site": query_site,
+    "site_search": query_site_search
+}
+
+
+class QueryService:
+    """
+        Answers the queries from an LRU cache of encoded responses.
+        Cache misses are queried by a pool of threads, each with its
+        own read-only connection. The cache is cleared and the
+        connections are reopened once a load finishes, which is
+        detected from the load marker file.
+    """
+
+    def __init__(self, root_folder, cache_size=DEFAULT_CACHE_SIZE):
+        self.db_path = os.path.join(root_folder, DB_FILE_NAME)
+        self.marker_path = os.path.join(root_folder, LOAD_MARKER_FILE_NAME)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.version = None
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0}
+
+    def get_load_version(self):
+        path = self.marker_path
+        if not os.path.exists(path):
+            path = self.db_path
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise DatabaseUnavailable("Database {} not found".format(
+                self.db_path))
+
+    def refresh(self):
+        """
+            Drops the cached responses if a load finished since the
+            last request.
+        """
+        version = self.get_load_version()
+        if version == self.version:
+            return
+        with self.lock:
+            logging.info("Database reloaded, clearing query cache")
+            self.cache.clear()
+            self.version = version
+            self.stats["reloads"] += 1
+
+    def get_connection(self, version):
+        """
+            Gets the read-only connection of the current thread,
+            reopening it if the database was reloaded since it was
+            opened. Runs in the query threads.
+        """
+        local = self.local
+        if getattr(local, "version", None) != version:
+            if getattr(local, "conn", None):
+                local.conn.close()
+            local.conn = sqlite3.connect(
+                "file:{}?mode=ro".format(self.db_path), uri=True)
+            local.version = version
+        return local.conn
+
+    def close_connection(self):
+        local = self.local
+        if getattr(local, "conn", None):
+            local.conn.close()
+        local.conn = None
+        local.version = None
+
+    def get_cached(self, key):
+        with self.lock:
+            response = self.cache.get(key)
+            if response:
+                self.cache.move_to_end(key)
+            return response
+
+    def put_cached(self, key, response):
+        with self.lock:
+            if key[0] != self.version:
+                return
+            self.cache[key] = response
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def run_query(self, version, name, params):
+        """
+            Runs a query and encodes its response.
+
+            Parameters:
+                version: Load version of the database
+                name: Name of the query in QUERIES
+                params: Dictionary of query parameters
+            Returns:
+                Tuple of JSON response body and its ETag
+        """
+        try:
+            rows = QUERIES[name](self.get_connection(version), params)
+        except sqlite3.OperationalError as error:
+            # The connection is reopened by the next query, in case the
+            # database file was replaced
+            self.close_connection()
+            raise DatabaseUnavailable(str(error))
+        body = json.dumps(rows).encode("utf-8")
+        return body, '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+    async def query(self, name, params):
+        self.refresh()
+        version = self.version
+        key = (version, name, tuple(sorted(params.items())))
+        response = self.get_cached(key)
+        if response:
+            self.stats["hits"] += 1
+            return response
+        self.stats["misses"] += 1
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            None, self.run_query, version, name, params)
+        self.put_cached(key, response)
+        return response
+
+
+async def handle_query(request):
+    service = request.app["service"]
+    name = request.match_info["name"]
+    if name not in QUERIES:
+        raise web.HTTPNotFound()
+    try:
+        body, etag = await service.query(name, dict(request.query))
+    except QueryError as error:
+        return web.json_response({"error": str(error)}, status=400)
+    except DatabaseUnavailable as error:
+        logging.warning("Database unavailable: {}".format(error))
+        return web.json_response({"error": "Database unavailable"},
+                                 status=503)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json",
+                        headers=headers)
+
+
+async def handle_stats(request):
+    return web.json_response(request.app["service"].stats)
+
+
+def create_app(root_folder, pool_size=DEFAULT_POOL_SIZE,
+               cache_size=DEFAULT_CACHE_SIZE):
+    """
+        Creates the query service application.
+
+        Parameters:
+            root_folder: Root folder of the project
+            pool_size: Number of query threads, each with its own
+                read-only sqlite connection
+            cache_size: Number of responses kept in the LRU cache
+        Returns:
+            aiohttp application
+    """
+    app = web.Application()
+    app["service"] = QueryService(root_folder, cache_size)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/{name}", handle_query)
+
+    async def setup_executor(app):
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(pool_size))
+    app.on_startup.append(setup_executor)
+    return app
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    args = sys.argv
+    port = int(args[1]) if len(args) >= 2 else DEFAULT_PORT
+    web.run_app(create_app(SCRIPT_FOLDER), host="127.0.0.1", port=port)
@@ -0,0 +1,163 @@
+import os
+import gzip
+import json
+import logging
+import threading
+from checkpoint import atomic_file, CONVERTED
+
+COMPRESS_LEVEL = 6
+
+
+def get_archive_paths(folder, date):
+    """
+        Gets the archive and index file paths of a date.
+
+        Parameters:
+            folder: Folder that contains the archives
+            date: Date of the archive
+        Returns:
+            Tuple of archive path and index path
+    """
+    return (os.path.join(folder, "{}.jsonl.gz".format(date)),
+            os.path.join(folder, "{}.index.json".format(date)))
+
+
+class RawArchiveWriter:
+    """
+        Streams the raw API payloads of a date into a single compressed
+        JSON lines file. Every payload is written as a separate gzip
+        member, so the file can be read as a whole with gzip while the
+        index of member offsets allows reading a single location.
+
+        The index is written at every checkpoint. On resume the archive
+        is truncated back to the end of the last indexed payload so that
+        uncommitted payloads are not duplicated.
+    """
+
+    def __init__(self, folder, date, manifest=None, checkpoint_every=50):
+        """
+            Parameters:
+                folder: Folder where the archives are stored
+                date: Date of the archive
+                manifest: Optional checkpoint manifest which is updated
+                    with the locations committed by the writer
+                checkpoint_every: Number of payloads written between
+                    checkpoints
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.path, self.index_path = get_archive_paths(folder, date)
+        self.manifest = manifest
+        self.checkpoint_every = checkpoint_every
+        self.lock = threading.Lock()
+        self.pending = []
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.index = json.load(file)
+        end = max((offset + length for offset, length in self.index.values()),
+                  default=0)
+        if os.path.exists(self.path) and os.path.getsize(self.path) != end:
+            logging.warning("Truncating '{}' to last checkpoint".format(
+                self.path))
+            os.truncate(self.path, end)
+        self.file = open(self.path, "ab")
+        if self.manifest:
+            for key in self.index:
+                if self.manifest.get_status(key) != CONVERTED:
+                    self.manifest.update(key, CONVERTED)
+
+    def has_location(self, key):
+        return key in self.index
+
+    def write(self, key, data):
+        """
+            Appends the payload of a location to the archive.
+
+            Parameters:
+                key: Location key built using checkpoint.location_key
+                data: JSON data retreived from COWIN website
+        """
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        member = gzip.compress(line, compresslevel=COMPRESS_LEVEL)
+        with self.lock:
+            offset = self.file.tell()
+            self.file.write(member)
+            self.pending.append((key, offset, len(member)))
+            if len(self.pending) >= self.checkpoint_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        self.file.flush()
+        for key, offset, length in self.pending:
+            self.index[key] = [offset, length]
+        with atomic_file(self.index_path) as file:
+            json.dump(self.index, file)
+        if self.manifest:
+            for key, _, _ in self.pending:
+                self.manifest.update(key, CONVERTED)
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.checkpoint()
+            self.file.close()
+
+
+class RawArchiveReader:
+    """
+        Reads payloads from an archive written by RawArchiveWriter.
+    """
+
+    def __init__(self, folder, date):
+        self.path, self.index_path = get_archive_paths(folder, date)
+        with open(self.index_path) as file:
+            self.index = json.load(file)
+
+    def keys(self):
+        return self.index.keys()
+
+    def read(self, key):
+        """
+            Reads the payload of a single location.
+
+            Parameters:
+                key: Location key built using checkpoint.location_key
+            Returns:
+                Python JSON representation of the payload
+        """
+        offset, length = self.index[key]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            member = file.read(length)
+        return json.loads(gzip.decompress(member))
+
+    def __iter__(self):
+        """
+            Iterates through all the indexed payloads in the order
+            they were written.
+        """
+        end = max((offset + length for offset, length in self.index.values()),
+                  default=0)
+        with open(self.path, "rb") as raw_file:
+            with gzip.open(BoundedReader(raw_file, end)) as file:
+                for line in file:
+                    yield json.loads(line)
+
+
+class BoundedReader:
+    """
+        File wrapper which stops reading at the end of the last
+        indexed payload, ignoring data written after the last checkpoint.
+    """
+
+    def __init__(self, file, end):
+        self.file = file
+        self.end = end
+
+    def read(self, size=-1):
+        remaining = self.end - self.file.tell()
+        if remaining <= 0:
+            return b""
+        if size < 0 or size > remaining:
+            size = remaining
+        return self.file.read(size)
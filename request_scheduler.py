@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import random
+import aiohttp
+
+DEFAULT_RATE = 10.0
+MIN_RATE = 0.5
+MAX_RATE = 50.0
+RATE_INCREASE_FACTOR = 1.2
+RATE_DECREASE_FACTOR = 0.5
+RATE_WINDOW = 2.0
+RATE_WINDOW_MIN_REQUESTS = 20
+RATE_ERROR_THRESHOLD = 0.1
+
+DEFAULT_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+BREAKER_FAILURE_THRESHOLD = 10
+BREAKER_COOLDOWN = 60.0
+
+RETRY_STATUS_CODES = set([429, 500, 502, 503, 504])
+
+
+class RetryableError(Exception):
+    """
+        Raised for responses and errors which may succeed when retried.
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdaptiveRateLimiter:
+    """
+        Token bucket rate limiter shared by all fetch workers.
+        Outcomes are counted over a short window. The rate is reduced
+        when too many requests were throttled or failed in the window
+        and increased again after a clean window.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.updated_at = None
+        self.window = {"started_at": None, "ok": 0, "failed": 0, "throttled": 0}
+        self.lock = asyncio.Lock()
+
+    def refill(self, now):
+        if self.updated_at is None:
+            self.updated_at = now
+        elapsed = now - self.updated_at
+        self.tokens = min(max(self.rate, 1.0), self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                self.refill(loop.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def record(self, outcome):
+        """
+            Records the outcome of a request and adjusts the rate
+            at the end of each window.
+
+            Parameters:
+                outcome: ok, failed or throttled
+        """
+        now = asyncio.get_running_loop().time()
+        window = self.window
+        if window["started_at"] is None:
+            window["started_at"] = now
+        window[outcome] += 1
+        errors = window["failed"] + window["throttled"]
+        if now - window["started_at"] < RATE_WINDOW or \
+                window["ok"] + errors < RATE_WINDOW_MIN_REQUESTS:
+            return
+        if errors > (window["ok"] + errors) * RATE_ERROR_THRESHOLD:
+            rate = max(self.min_rate, self.rate * RATE_DECREASE_FACTOR)
+            if rate < self.rate:
+                logging.warning(
+                    "Reducing request rate to {:.2f}/s".format(rate))
+            self.rate = rate
+        elif not errors:
+            self.rate = min(self.max_rate, self.rate * RATE_INCREASE_FACTOR)
+        self.window = {"started_at": now, "ok": 0, "failed": 0, "throttled": 0}
+
+
+class CircuitBreaker:
+    """
+        Pauses all requests once the API has failed consecutively
+        for threshold times. After cooldown a single probe request is
+        allowed; the breaker closes again if the probe succeeds and opens
+        again if it fails. A probe which ends without telling whether the
+        API is up, e.g. when it is throttled or gets a 404, releases its
+        slot so that the next request probes again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.open_count = 0
+        self.probing = False
+
+    async def wait(self):
+        """
+            Waits until requests are allowed.
+
+            Returns:
+                True for the probe request of a half-open breaker, which
+                must call release once it ends
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.cooldown - loop.time()
+                if remaining <= 0:
+                    self.state = self.HALF_OPEN
+                    self.probing = True
+                    return True
+                await asyncio.sleep(remaining)
+            elif not self.probing:
+                self.probing = True
+                return True
+            else:
+                await asyncio.sleep(min(1.0, self.cooldown))
+
+    def release(self):
+        self.probing = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info("COWIN API recovered, resuming requests")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                logging.warning(
+                    "COWIN API appears to be down, pausing requests for {}s".format(
+                        self.cooldown))
+                self.open_count += 1
+            self.state = self.OPEN
+            self.opened_at = asyncio.get_running_loop().time()
+
+
+def get_backoff(attempt, retry_after=None):
+    """
+        Exponential backoff with full jitter.
+
+        Parameters:
+            attempt: Retry attempt number starting from 0
+            retry_after: Delay requested by the server, if any
+        Returns:
+            Delay in seconds before the next attempt
+    """
+    if retry_after is not None:
+        return min(BACKOFF_MAX, retry_after)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+async def read_json(response):
+    return await response.json(content_type=None)
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+        Schedules COWIN API requests with rate limiting, per request
+        timeouts, retries with backoff and a circuit breaker.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, timeout=DEFAULT_TIMEOUT,
+                 max_retries=MAX_RETRIES):
+        self.limiter = AdaptiveRateLimiter(rate)
+        self.breaker = CircuitBreaker()
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.stats = {"requests": 0, "retried": 0,
+                      "throttled": 0, "failed": 0}
+
+    async def request(self, session, url, read_body):
+        probe = await self.breaker.wait()
+        try:
+            await self.limiter.acquire()
+            self.stats["requests"] += 1
+            async with session.get(url, timeout=self.timeout) as response:
+                if response.status in RETRY_STATUS_CODES:
+                    raise RetryableError(
+                        "HTTP {}".format(response.status), response.status,
+                        parse_retry_after(response.headers.get("Retry-After")))
+                response.raise_for_status()
+                return await read_body(response)
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError,
+                aiohttp.ClientPayloadError) as error:
+            raise RetryableError(repr(error)) from error
+        finally:
+            # The outcome of the probe is recorded by get right after,
+            # so the half-open slot is released whatever it is. A probe
+            # which failed opens the breaker again, while any other
+            # outcome lets the next request, or its own retry, probe.
+            if probe:
+                self.breaker.release()
+
+    async def get_json(self, session, url):
+        """
+            Fetches a URL and decodes the response as JSON.
+            Retryable failures are retried with backoff.
+
+            Parameters:
+                session: aiohttp client session
+                url: URL that needs to be fetched
+            Returns:
+                Python JSON representation of the response
+        """
+        return await self.get(session, url, read_json)
+
+    async def get(self, session, url, read_body):
+        """
+            Fetches a URL and reads the response using read_body.
+            Retryable failures, including failures while the body is
+            read, are retried with backoff.
+
+            Parameters:
+                session: aiohttp client session
+                url: URL that needs to be fetched
+                read_body: Coroutine function which reads the response
+            Returns:
+                Value returned by read_body
+        """
+        attempt = 0
+        while True:
+            try:
+                data = await self.request(session, url, read_body)
+                self.limiter.record("ok")
+                self.breaker.record_success()
+                return data
+            except RetryableError as error:
+                if error.status == 429:
+                    self.stats["throttled"] += 1
+                    self.limiter.record("throttled")
+                else:
+                    self.breaker.record_failure()
+                    self.limiter.record("failed")
+                if attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                delay = get_backoff(attempt, error.retry_after)
+                logging.warning("Retrying '{}' in {:.1f}s: {}".format(
+                    url, delay, error))
+                self.stats["retried"] += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            except Exception:
+                self.stats["failed"] += 1
+                raise
@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import logging
+from sqlite_utils import Database
+from table_schema import TableSchema, INTEGER, DATE
+
+DB_FILE_NAME = "covid-ds.db"
+
+# Rolling window tables, which repeat the rows of an event date in every
+# snapshot of the window, and the fact tables keeping each event once
+ROLLING_WINDOW_TABLES = {
+    "raw_daily_registration_count_last_7days": {
+        "fact_table": "fact_daily_registration_count",
+        "event_date": "reg_date"
+    },
+    "raw_daily_vaccination_count_last_7days": {
+        "fact_table": "fact_daily_vaccination_count",
+        "event_date": "vaccine_date"
+    },
+    "raw_daily_session_status_last_5days": {
+        "fact_table": "fact_daily_session_status",
+        "event_date": "session_date"
+    },
+    "raw_aefi_last_30days": {
+        "fact_table": "fact_daily_aefi",
+        "event_date": "vaccine_date"
+    }
+}
+
+# Snapshot dates folded into the fact tables
+FACT_SNAPSHOTS_TABLE = "fact_snapshots"
+
+# Settings of the fact tables, like the storage mode of the rolling
+# window tables, kept in the database so that every later load of the
+# database, by the loaders or the pipeline, uses them
+FACT_SETTINGS_TABLE = "fact_settings"
+
+FULL = "full"
+COMPACT = "compact"
+
+KEY_COLUMNS = ["location_type", "location_id"]
+
+TRACKING_COLUMNS = {
+    "first_seen": DATE,
+    "last_seen": DATE,
+    "change_count": INTEGER
+}
+
+# Values of the latest snapshot win. A snapshot which changes the
+# values of an event date increments its change count. Folding gives
+# the same rows as a recompute only for snapshots newer than every
+# folded snapshot.
+FOLD_SNAPSHOT_SQL = """INSERT INTO [{fact}] ({columns}, first_seen, last_seen, change_count)
+SELECT {columns}, date, date, 0 FROM [{raw}] WHERE date = :date
+ON CONFLICT ({key}) DO UPDATE SET
+    {updates},
+    change_count = change_count + (
+        excluded.last_seen > last_seen AND ({changed})),
+    first_seen = MIN(first_seen, excluded.first_seen),
+    last_seen = MAX(last_seen, excluded.last_seen)"""
+
+# Events of the reloaded or out of order snapshots, and of the facts
+# whose snapshot range has them, with their folded snapshot range
+FACT_KEYS_TABLE = "fact_keys"
+
+INSERT_FACT_KEYS_SQL = """INSERT INTO temp.[{keys_table}]
+SELECT {f_key}, f.first_seen, f.last_seen FROM (
+    SELECT {key} FROM [{raw}]
+    WHERE date IN (SELECT value FROM json_each(:dates))
+    UNION
+    SELECT {key} FROM [{fact}]
+    WHERE EXISTS (SELECT 1 FROM json_each(:dates)
+                  WHERE value BETWEEN first_seen AND last_seen)
+) k
+LEFT JOIN [{fact}] f ON {f_join}"""
+
+# Recomputes the facts of the events from all their snapshots, like
+# folding the snapshots in date order. The values are taken from the
+# row of MAX(date), so there is no other MIN or MAX aggregate. The
+# snapshots of an event are within its folded snapshot range and the
+# recomputed dates, so the snapshots of a location are read only for
+# the range of its events.
+RECOMPUTE_FACTS_SQL = """INSERT INTO [{fact}] ({columns}, first_seen, last_seen, change_count)
+SELECT {columns}, first_seen, MAX(date), SUM(changed) FROM (
+    SELECT r.*, FIRST_VALUE(r.date) OVER snapshots AS first_seen,
+        (LAG(r.date) OVER snapshots IS NOT NULL AND ({changed})) AS changed
+    FROM (
+        SELECT location_type, location_id,
+            MIN(IFNULL(MIN(first_seen), :first_date), :first_date) AS lo,
+            MAX(IFNULL(MAX(last_seen), :last_date), :last_date) AS hi
+        FROM temp.[{keys_table}]
+        GROUP BY location_type, location_id
+    ) l
+    CROSS JOIN [{raw}] r ON r.location_type = l.location_type
+        AND r.location_id = l.location_id AND r.date BETWEEN l.lo AND l.hi
+    JOIN temp.[{keys_table}] k ON {k_join}
+    WINDOW snapshots AS (PARTITION BY {r_key} ORDER BY r.date)
+)
+GROUP BY {key}"""
+
+# Deletes the snapshot rows which repeat the values of the previous
+# snapshot of the event, except the last one. The facts recomputed
+# from the remaining rows are the same as from all the rows.
+COMPACT_SNAPSHOTS_SQL = """DELETE FROM [{raw}] WHERE rowid IN (
+    SELECT id FROM (
+        SELECT rowid AS id,
+            LAG(date) OVER snapshots IS NOT NULL
+                AND LEAD(date) OVER snapshots IS NOT NULL
+                AND NOT ({changed}) AS repeated
+        FROM [{raw}]
+        WINDOW snapshots AS (PARTITION BY {key} ORDER BY date)
+    )
+    WHERE repeated
+)"""
+
+
+def create_fact_table(db, raw_table, config):
+    """
+        Creates the fact table of a rolling window table, with the
+        columns of the rolling window table except the snapshot date
+        and the snapshot tracking columns.
+
+        Returns:
+            Tuple of the key columns and the value columns
+    """
+    raw_types = TableSchema.from_table(db, raw_table).column_types
+    key = KEY_COLUMNS + [config["event_date"]]
+    values = [column for column in raw_types
+              if column not in key and column != "date"]
+    schema = TableSchema(config["fact_table"], {
+        **{column: raw_types[column] for column in key + values},
+        **TRACKING_COLUMNS})
+    if not db[config["fact_table"]].exists():
+        schema.create(db, key)
+    return key, values
+
+
+def get_folded_snapshots(db, raw_table):
+    return set(date for (date,) in db.execute(
+        "SELECT date FROM [{}] WHERE [table] = ?".format(FACT_SNAPSHOTS_TABLE),
+        [raw_table]))
+
+
+def get_pending_snapshots(db, raw_table, changed_dates=()):
+    """
+        Gets the snapshot dates of a rolling window table which are not
+        folded into its fact table yet, or were reloaded.
+    """
+    dates = set(date for (date,) in db.execute(
+        """SELECT DISTINCT date FROM [{}] WHERE date NOT IN (
+            SELECT date FROM [{}] WHERE [table] = ?)""".format(
+            raw_table, FACT_SNAPSHOTS_TABLE), [raw_table]))
+    dates.update(date for (date,) in db.execute(
+        "SELECT DISTINCT date FROM [{}]".format(raw_table))
+        if date in changed_dates)
+    return sorted(dates)
+
+
+def get_changed_expression(values, alias=""):
+    """
+        Builds the expression which is true if the values of a snapshot
+        row differ from the previous snapshot of the event.
+    """
+    return " OR ".join(
+        "LAG({0}[{1}]) OVER snapshots IS NOT {0}[{1}]".format(alias, column)
+        for column in values) or "0"
+
+
+def fold_snapshots(db, raw_table, config, dates):
+    key, values = create_fact_table(db, raw_table, config)
+    sql = FOLD_SNAPSHOT_SQL.format(
+        fact=config["fact_table"], raw=raw_table,
+        columns=", ".join("[{}]".format(column) for column in key + values),
+        key=", ".join("[{}]".format(column) for column in key),
+        updates=",\n    ".join(
+            "[{0}] = CASE WHEN excluded.last_seen >= last_seen "
+            "THEN excluded.[{0}] ELSE [{0}] END".format(column)
+            for column in values),
+        changed=" OR ".join(
+            "excluded.[{0}] IS NOT [{0}]".format(column)
+            for column in values) or "0")
+    for date in dates:
+        with db.conn:
+            db.execute(sql, {"date": date})
+            db.execute(
+                "INSERT OR IGNORE INTO [{}] VALUES (?, ?)".format(
+                    FACT_SNAPSHOTS_TABLE), [raw_table, date])
+
+
+def recompute_facts(db, raw_table, config, dates):
+    """
+        Recomputes the facts of the events of reloaded or out of order
+        snapshots from all the snapshots of the events, so the fact
+        table is the same as if it was rebuilt from the rolling window
+        table. The facts of the events which are no longer in any
+        snapshot are deleted.
+
+        Parameters:
+            db: Sqlite database connection
+            raw_table: Name of the rolling window table
+            config: Fact table configuration of the rolling window table
+            dates: Snapshot dates
+    """
+    key, values = create_fact_table(db, raw_table, config)
+    fact = config["fact_table"]
+    quoted_key = ", ".join("[{}]".format(column) for column in key)
+    # The key columns have the types of the fact table, so the keys
+    # are compared using its indexes. The event date column differs
+    # between the fact tables, so the table is created for each one.
+    column_types = TableSchema.from_table(db, fact).column_types
+    db.execute("DROP TABLE IF EXISTS temp.[{}]".format(FACT_KEYS_TABLE))
+    db.execute("""CREATE TEMP TABLE [{}] (
+   {},
+   [first_seen] DATE,
+   [last_seen] DATE,
+   PRIMARY KEY ({})
+)""".format(FACT_KEYS_TABLE, ",\n   ".join(
+        "[{}] {}".format(column, column_types[column]) for column in key),
+        quoted_key))
+    with db.conn:
+        db.execute(INSERT_FACT_KEYS_SQL.format(
+            keys_table=FACT_KEYS_TABLE, raw=raw_table, fact=fact,
+            key=quoted_key,
+            f_key=", ".join("k.[{}]".format(column) for column in key),
+            f_join=" AND ".join("f.[{0}] = k.[{0}]".format(column)
+                                for column in key)),
+            {"dates": json.dumps(dates)})
+        db.execute("DELETE FROM [{}] WHERE ({}) IN (SELECT {} FROM temp.[{}])".format(
+            fact, quoted_key, quoted_key, FACT_KEYS_TABLE))
+        db.execute(RECOMPUTE_FACTS_SQL.format(
+            fact=fact, raw=raw_table, keys_table=FACT_KEYS_TABLE,
+            columns=", ".join("[{}]".format(column) for column in key + values),
+            key=quoted_key,
+            r_key=", ".join("r.[{}]".format(column) for column in key),
+            k_join=" AND ".join("k.[{0}] = r.[{0}]".format(column)
+                                for column in key),
+            changed=get_changed_expression(values, "r.")),
+            {"first_date": min(dates), "last_date": max(dates)})
+        db.conn.executemany(
+            "INSERT OR IGNORE INTO [{}] VALUES (?, ?)".format(
+                FACT_SNAPSHOTS_TABLE), [[raw_table, date] for date in dates])
+    db.execute("DROP TABLE temp.[{}]".format(FACT_KEYS_TABLE))
+
+
+def compact_snapshots(db, raw_table, config):
+    """
+        Deletes the rows of a rolling window table which repeat the
+        values of the previous snapshot of their event. The first and
+        last snapshots of every event and the snapshots which changed
+        its values are kept, so the facts of reloaded snapshots can
+        still be recomputed. An event seen in n snapshots keeps at
+        least 2 of its n rows, e.g. the 7 rows of the last 7 days
+        tables shrink to between 2 and 7 rows by how many snapshots
+        revised the event.
+
+        Returns:
+            Number of rows deleted
+    """
+    key, values = create_fact_table(db, raw_table, config)
+    with db.conn:
+        return db.execute(COMPACT_SNAPSHOTS_SQL.format(
+            raw=raw_table,
+            key=", ".join("[{}]".format(column) for column in key),
+            changed=get_changed_expression(values))).rowcount
+
+
+def get_storage_mode(db):
+    if not db[FACT_SETTINGS_TABLE].exists():
+        return FULL
+    row = db.execute("SELECT value FROM [{}] WHERE name = 'storage'".format(
+        FACT_SETTINGS_TABLE)).fetchone()
+    return row[0] if row else FULL
+
+
+def set_storage_mode(db, mode):
+    with db.conn:
+        db.execute("""CREATE TABLE IF NOT EXISTS [{}] (
+   [name] TEXT PRIMARY KEY,
+   [value] TEXT
+)""".format(FACT_SETTINGS_TABLE))
+        db.execute("INSERT OR REPLACE INTO [{}] VALUES ('storage', ?)".format(
+            FACT_SETTINGS_TABLE), [mode])
+
+
+def update_facts(db, changed_dates=(), compact=None):
+    """
+        Folds the snapshots of the rolling window tables into fact
+        tables which keep every event date of a location once, with
+        the values of the latest snapshot, the first and last snapshot
+        dates the event was seen and the number of snapshots which
+        changed its values.
+
+        Snapshots newer than the folded snapshots are folded into the
+        facts. The facts of the events of reloaded or older snapshots
+        are recomputed from their snapshots.
+
+        Parameters:
+            db: Sqlite database connection
+            changed_dates: Snapshot dates which were reloaded since they
+                were folded
+            compact: Sets the storage mode of the rolling window tables
+                of the database. With True, the snapshot rows which did
+                not change the values of their event are deleted after
+                every update, see compact_snapshots. False keeps every
+                snapshot row. None keeps the mode of the database, which
+                is False until it is set.
+    """
+    if not db[FACT_SNAPSHOTS_TABLE].exists():
+        db.execute("""CREATE TABLE [{}] (
+   [table] TEXT NOT NULL,
+   [date] DATE NOT NULL,
+   PRIMARY KEY ([table], [date])
+)""".format(FACT_SNAPSHOTS_TABLE))
+    # Switching to the compact mode compacts the tables even if there
+    # are no new snapshots
+    compacted = get_storage_mode(db) == COMPACT
+    if compact is not None:
+        set_storage_mode(db, COMPACT if compact else FULL)
+    compact = get_storage_mode(db) == COMPACT
+    for raw_table, config in ROLLING_WINDOW_TABLES.items():
+        if not db[raw_table].exists():
+            continue
+        dates = get_pending_snapshots(db, raw_table, changed_dates)
+        folded = get_folded_snapshots(db, raw_table)
+        latest = max(folded) if folded else None
+        new_dates = []
+        for date in dates:
+            if date not in folded and (latest is None or date > latest):
+                new_dates.append(date)
+                latest = date
+        old_dates = [date for date in dates if date not in new_dates]
+        if new_dates:
+            logging.info("Folding {} snapshots of {}".format(
+                len(new_dates), raw_table))
+            fold_snapshots(db, raw_table, config, new_dates)
+        if old_dates:
+            logging.info("Recomputing the facts of {} snapshots of {}".format(
+                len(old_dates), raw_table))
+            recompute_facts(db, raw_table, config, old_dates)
+        if compact and (dates or not compacted):
+            deleted = compact_snapshots(db, raw_table, config)
+            logging.info("Removed {} repeated rows of {}".format(
+                deleted, raw_table))
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    mode = sys.argv[1] if len(sys.argv) >= 2 else None
+    if mode not in (None, FULL, COMPACT):
+        sys.exit("Usage: rolling_window_facts.py [full|compact]")
+    db = Database(os.path.join(folder, DB_FILE_NAME))
+    compacted = get_storage_mode(db) == COMPACT
+    update_facts(db, compact=None if mode is None else mode == COMPACT)
+    if mode == COMPACT and not compacted:
+        db.vacuum()
+    db.conn.close()
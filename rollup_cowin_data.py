@@ -0,0 +1,174 @@
+import os
+import logging
+from sqlite_utils import Database
+
+DB_FILE_NAME = "covid-ds.db"
+
+ROLLUP_TABLE = "rollup_daily_vaccination"
+AGGREGATE_TABLE = "rollup_daily_vaccination_aggregate"
+SOURCE_TABLE = "raw_vaccination_count"
+
+# Cumulative columns of the source table used by the rollups
+SERIES_COLUMNS = ["total", "tot_dose_1", "tot_dose_2"]
+
+# Covering indexes of the time series queries on the raw tables
+COVERING_INDEXES = {
+    "raw_vaccination_count": [
+        "location_type", "location_id", "date",
+        "total", "tot_dose_1", "tot_dose_2"
+    ],
+    "raw_district_level_vaccination_count": [
+        "district_id", "date",
+        "total", "partial_vaccinated", "totally_vaccinated"
+    ]
+}
+
+CREATE_ROLLUP_SQL = """CREATE TABLE IF NOT EXISTS [{table}] (
+   [location_type] TEXT NOT NULL,
+   [location_id] INTEGER NOT NULL,
+   [date] DATE NOT NULL,
+   [total] INTEGER,
+   [tot_dose_1] INTEGER,
+   [tot_dose_2] INTEGER,
+   [daily_total] INTEGER,
+   [daily_dose_1] INTEGER,
+   [daily_dose_2] INTEGER,{extra_columns}
+   PRIMARY KEY ([location_type], [location_id], [date])
+) WITHOUT ROWID"""
+
+# Daily deltas are the change since the previous date loaded for the
+# location, found through the covering index of the source table.
+LOCATION_ROLLUP_SQL = """INSERT INTO [{rollup}]
+SELECT r.location_type, r.location_id, r.date,
+    r.total, r.tot_dose_1, r.tot_dose_2,
+    r.total - p.total, r.tot_dose_1 - p.tot_dose_1, r.tot_dose_2 - p.tot_dose_2
+FROM [{source}] r
+LEFT JOIN [{source}] p
+    ON p.location_type = r.location_type
+    AND p.location_id = r.location_id
+    AND p.date = (
+        SELECT MAX(q.date) FROM [{source}] q
+        WHERE q.location_type = r.location_type
+        AND q.location_id = r.location_id
+        AND q.date < r.date)
+WHERE r.date >= :start_date"""
+
+# State and national aggregates of the district time series
+AGGREGATE_ROLLUP_SQL = """INSERT INTO [{aggregate}]
+SELECT 'state', d.state_id, r.date,
+    SUM(r.total), SUM(r.tot_dose_1), SUM(r.tot_dose_2),
+    SUM(r.daily_total), SUM(r.daily_dose_1), SUM(r.daily_dose_2),
+    COUNT(*)
+FROM [{rollup}] r
+JOIN districts d ON d.id = r.location_id
+WHERE r.location_type = 'district' AND r.date >= :start_date
+GROUP BY d.state_id, r.date
+UNION ALL
+SELECT 'national', 0, r.date,
+    SUM(r.total), SUM(r.tot_dose_1), SUM(r.tot_dose_2),
+    SUM(r.daily_total), SUM(r.daily_dose_1), SUM(r.daily_dose_2),
+    COUNT(*)
+FROM [{rollup}] r
+WHERE r.location_type = 'district' AND r.date >= :start_date
+GROUP BY r.date"""
+
+
+def create_covering_indexes(db):
+    """
+        Creates the covering indexes of the time series queries on the
+        raw tables which have all the indexed columns.
+
+        Parameters:
+            db: Sqlite database connection
+    """
+    for table, columns in COVERING_INDEXES.items():
+        if not db[table].exists():
+            continue
+        if not set(columns).issubset(db[table].columns_dict):
+            logging.warning("Skipping covering index of {}".format(table))
+            continue
+        db[table].create_index(
+            columns, index_name="idx_{}_series".format(table),
+            if_not_exists=True)
+
+
+def create_rollup_tables(db):
+    db.execute(CREATE_ROLLUP_SQL.format(table=ROLLUP_TABLE, extra_columns=""))
+    db.execute(CREATE_ROLLUP_SQL.format(
+        table=AGGREGATE_TABLE,
+        extra_columns="\n   [location_count] INTEGER,"))
+
+
+def get_rollup_start_date(db, full=False, changed_dates=()):
+    """
+        Gets the first date whose rollups need to be computed, which is
+        the first loaded date that is not rolled up yet or was reloaded.
+        Rollups of the later dates are recomputed as well, since their
+        daily deltas depend on the previous date.
+
+        Parameters:
+            db: Sqlite database connection
+            full: Recompute the rollups of all the dates
+            changed_dates: Dates which were reloaded since they were
+                rolled up
+        Returns:
+            Date in YYYY-MM-DD format, or None if the rollups are
+            up to date
+    """
+    if full:
+        sql = "SELECT MIN(date) FROM [{source}]"
+    else:
+        sql = """SELECT MIN(date) FROM [{source}]
+            WHERE date NOT IN (SELECT DISTINCT date FROM [{rollup}])"""
+    start_date = db.execute(sql.format(
+        source=SOURCE_TABLE, rollup=ROLLUP_TABLE)).fetchone()[0]
+    return min(filter(None, [start_date, *changed_dates]), default=None)
+
+
+def update_rollups(db, full=False, changed_dates=()):
+    """
+        Updates the daily time series rollup tables with the dates
+        loaded since the previous update.
+
+        rollup_daily_vaccination has the cumulative counts and daily
+        deltas of every location in raw_vaccination_count.
+        rollup_daily_vaccination_aggregate has the sums of the district
+        time series by state and for the nation.
+
+        Parameters:
+            db: Sqlite database connection
+            full: Recompute the rollups of all the dates
+            changed_dates: Dates which were reloaded since the previous
+                update
+    """
+    if not db[SOURCE_TABLE].exists():
+        return
+    if not set(SERIES_COLUMNS).issubset(db[SOURCE_TABLE].columns_dict):
+        logging.warning("Skipping rollups: {} has no cumulative counts".format(
+            SOURCE_TABLE))
+        return
+    create_covering_indexes(db)
+    create_rollup_tables(db)
+    start_date = get_rollup_start_date(db, full, changed_dates)
+    if start_date is None:
+        logging.info("Rollups are up to date")
+        return
+
+    logging.info("Updating rollups from {}".format(start_date))
+    params = {"start_date": start_date}
+    with db.conn:
+        for table in [ROLLUP_TABLE, AGGREGATE_TABLE]:
+            db.execute("DELETE FROM [{}] WHERE date >= :start_date".format(
+                table), params)
+        db.execute(LOCATION_ROLLUP_SQL.format(
+            rollup=ROLLUP_TABLE, source=SOURCE_TABLE), params)
+        db.execute(AGGREGATE_ROLLUP_SQL.format(
+            aggregate=AGGREGATE_TABLE, rollup=ROLLUP_TABLE), params)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    db = Database(os.path.join(folder, DB_FILE_NAME))
+    update_rollups(db, full=True)
+    db.conn.close()
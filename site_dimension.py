@@ -0,0 +1,198 @@
+import os
+import re
+import sys
+import json
+import logging
+from sqlite_utils import Database
+
+DB_FILE_NAME = "covid-ds.db"
+
+SOURCE_TABLE = "raw_site_level_vaccination_count"
+SITES_TABLE = "sites"
+SITES_FTS_TABLE = "sites_fts"
+
+# Dates of the source table folded into the sites table
+SITE_DATES_TABLE = "site_dates"
+
+DEFAULT_SEARCH_LIMIT = 20
+
+# Sites are keyed by session_site_id, which is the rowid of the table
+# and of the external content FTS index
+CREATE_SITES_SQL = """CREATE TABLE IF NOT EXISTS [{sites}] (
+   [session_site_id] INTEGER PRIMARY KEY,
+   [session_site_name] TEXT,
+   [district_id] INTEGER REFERENCES [districts]([id]),
+   [state_id] INTEGER REFERENCES [states]([id]),
+   [first_seen] DATE,
+   [last_seen] DATE
+);
+CREATE INDEX IF NOT EXISTS [idx_{sites}_district_id]
+    ON [{sites}] ([district_id]);
+CREATE TABLE IF NOT EXISTS [{site_dates}] (
+   [date] DATE PRIMARY KEY
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS [{fts}] USING fts5(
+    session_site_name,
+    content=[{sites}],
+    content_rowid=[session_site_id],
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS [{sites}_ai] AFTER INSERT ON [{sites}] BEGIN
+    INSERT INTO [{fts}] (rowid, session_site_name)
+    VALUES (new.session_site_id, new.session_site_name);
+END;
+CREATE TRIGGER IF NOT EXISTS [{sites}_ad] AFTER DELETE ON [{sites}] BEGIN
+    INSERT INTO [{fts}] ([{fts}], rowid, session_site_name)
+    VALUES ('delete', old.session_site_id, old.session_site_name);
+END;
+CREATE TRIGGER IF NOT EXISTS [{sites}_au]
+AFTER UPDATE OF session_site_name ON [{sites}]
+WHEN old.session_site_name IS NOT new.session_site_name BEGIN
+    INSERT INTO [{fts}] ([{fts}], rowid, session_site_name)
+    VALUES ('delete', old.session_site_id, old.session_site_name);
+    INSERT INTO [{fts}] (rowid, session_site_name)
+    VALUES (new.session_site_id, new.session_site_name);
+END;"""
+
+# Folds the rows of the dates into one row per site. The name and
+# district of the latest date win, taken from the row of MAX(date).
+# A site listed in more than one district on a date is kept in one of
+# them. The location type is not matched through the primary key,
+# which would read the rows in key order instead of through the date
+# index.
+FOLD_SITES_SQL = """INSERT INTO [{sites}]
+SELECT l.session_site_id, l.session_site_name, l.location_id, d.state_id,
+    f.first_seen, l.last_seen
+FROM (
+    SELECT session_site_id, session_site_name, location_id,
+        MAX(date) AS last_seen
+    FROM [{source}]
+    WHERE date IN (SELECT value FROM json_each(:dates))
+        AND +location_type = 'district' AND session_site_id IS NOT NULL
+    GROUP BY session_site_id
+) l
+JOIN (
+    SELECT session_site_id, MIN(date) AS first_seen
+    FROM [{source}]
+    WHERE date IN (SELECT value FROM json_each(:dates))
+        AND +location_type = 'district' AND session_site_id IS NOT NULL
+    GROUP BY session_site_id
+) f ON f.session_site_id = l.session_site_id
+LEFT JOIN [districts] d ON d.id = l.location_id
+WHERE true
+ON CONFLICT ([session_site_id]) DO UPDATE SET
+    session_site_name = CASE WHEN excluded.last_seen >= last_seen
+        THEN excluded.session_site_name ELSE session_site_name END,
+    district_id = CASE WHEN excluded.last_seen >= last_seen
+        THEN excluded.district_id ELSE district_id END,
+    state_id = CASE WHEN excluded.last_seen >= last_seen
+        THEN excluded.state_id ELSE state_id END,
+    first_seen = MIN(first_seen, excluded.first_seen),
+    last_seen = MAX(last_seen, excluded.last_seen)"""
+
+# Matches are returned in site ID order. Ranking them would score every
+# match, which takes tens of milliseconds for short prefixes.
+SEARCH_SITES_SQL = """SELECT s.*
+FROM [{fts}] f
+JOIN [{sites}] s ON s.session_site_id = f.rowid
+WHERE f.session_site_name MATCH :query
+    AND (:district_id IS NULL OR s.district_id = :district_id)
+    AND (:state_id IS NULL OR s.state_id = :state_id)
+LIMIT :limit"""
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def create_site_tables(db):
+    db.conn.executescript(CREATE_SITES_SQL.format(
+        sites=SITES_TABLE, fts=SITES_FTS_TABLE, site_dates=SITE_DATES_TABLE))
+
+
+def get_pending_dates(db, changed_dates=()):
+    """
+        Gets the dates of the source table which are not folded into
+        the sites table yet, or were reloaded.
+    """
+    dates = set(date for (date,) in db.execute(
+        """SELECT DISTINCT date FROM [{}] WHERE date NOT IN (
+            SELECT date FROM [{}])""".format(SOURCE_TABLE, SITE_DATES_TABLE)))
+    dates.update(date for (date,) in db.execute(
+        "SELECT DISTINCT date FROM [{}]".format(SOURCE_TABLE))
+        if date in changed_dates)
+    return sorted(dates)
+
+
+def update_sites(db, changed_dates=()):
+    """
+        Updates the sites table, which has every vaccination site of
+        raw_site_level_vaccination_count once, with its name, district
+        and state on the latest date it was listed and the first and
+        last dates it was listed. Site names are indexed by the
+        sites_fts full text index.
+
+        Parameters:
+            db: Sqlite database connection
+            changed_dates: Dates which were reloaded since they were
+                folded
+    """
+    if not db[SOURCE_TABLE].exists():
+        return
+    create_site_tables(db)
+    dates = get_pending_dates(db, changed_dates)
+    if not dates:
+        return
+    logging.info("Updating sites from {} dates".format(len(dates)))
+    with db.conn:
+        db.execute(FOLD_SITES_SQL.format(sites=SITES_TABLE, source=SOURCE_TABLE),
+                   {"dates": json.dumps(dates)})
+        db.conn.executemany("INSERT OR IGNORE INTO [{}] VALUES (?)".format(
+            SITE_DATES_TABLE), [[date] for date in dates])
+
+
+def get_search_query(text):
+    """
+        Builds an FTS5 prefix query which matches the site names having
+        every word of a text, the last word as a prefix.
+
+        Returns:
+            FTS5 query, or None if the text has no words
+    """
+    tokens = TOKEN_PATTERN.findall(text)
+    if not tokens:
+        return None
+    terms = ['"{}"'.format(token) for token in tokens]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_sites(conn, text, district_id=None, state_id=None,
+                 limit=DEFAULT_SEARCH_LIMIT):
+    """
+        Finds the sites whose names match a search text.
+
+        Parameters:
+            conn: sqlite3 connection
+            text: Words of the site name. The last word may be partial.
+            district_id: Optional district of the sites
+            state_id: Optional state of the sites
+            limit: Maximum number of sites
+        Returns:
+            sqlite3 cursor of the rows of the sites table
+    """
+    return conn.execute(SEARCH_SITES_SQL.format(
+        fts=SITES_FTS_TABLE, sites=SITES_TABLE), {
+        "query": get_search_query(text) or '""', "district_id": district_id,
+        "state_id": state_id, "limit": limit})
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    db = Database(os.path.join(folder, DB_FILE_NAME))
+    if len(sys.argv) >= 3 and sys.argv[1] == "search":
+        for row in search_sites(db.conn, " ".join(sys.argv[2:])):
+            print(*row)
+    else:
+        update_sites(db)
+    db.conn.close()
@@ -2,7 +2,7 @@ import sys
 import os
 import json
 import logging
-import requests
+import functools
 
 URL_FORMAT = "https://api.cowin.gov.in/api/v1/reports/v2/getPublicReports?date={}&state_id={}&district_id={}"
 
@@ -10,6 +10,20 @@ SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
 COWIN_DATA_FOLDER_PATH = os.path.join(SCRIPT_FOLDER, "..", "data", "cowin")
 
+RAW_ARCHIVE_FOLDER_PATH = os.path.join(SCRIPT_FOLDER, "..", "data", "cowin-raw")
+
+CHECKPOINT_FOLDER_PATH = os.path.join(
+    SCRIPT_FOLDER, "..", "data", "checkpoints", "json")
+
+METRICS_FOLDER_PATH = os.path.join(SCRIPT_FOLDER, "..", "data", "metrics")
+
+sys.path.append(os.path.join(SCRIPT_FOLDER, ".."))
+from fetch_engine import build_job, run_jobs, DEFAULT_WORKERS, DEFAULT_LIMIT_PER_HOST
+from checkpoint import CheckpointManifest, atomic_file, location_key, \
+    PENDING, FETCHED, CONVERTED
+from raw_archive import RawArchiveWriter
+from instrumentation import metrics
+
 TEST_MODE_STATE_IDS = set([31])
 TEST_MODE_DISTRICT_IDS = set([571])
 
@@ -17,30 +31,64 @@ TEST_MODE_DISTRICT_IDS = set([571])
 def build_url(date, state_id="", district_id=""):
     return URL_FORMAT.format(date, state_id, district_id)
 
-def fetch_data(date, location_type, location_id, url, output_folder):
-    file_name = "national" if location_id == 0 else location_id
-    file_path = os.path.join(output_folder, "{}.json".format(file_name))
-    if os.path.exists(file_path):
-        logging.warning("Data file '%s' already has data." % (file_path,))
-        return
-    data = requests.get(url).json()
+def save_data(date, location_type, location_id, file_path, manifest, data):
+    key = location_key(location_type, location_id)
+    manifest.update(key, FETCHED)
     data["date"] = date
     data["location_type"] = location_type
     data["location_id"] = location_id
-    with open(file_path, 'w') as file:
+    with atomic_file(file_path) as file:
         file.write(json.dumps(data))
+    manifest.update(key, CONVERTED)
+
+def save_archived_data(date, location_type, location_id, archive, manifest, data):
+    """
+        Appends the data to the raw archive of the date. The location
+        is marked as converted by the archive writer once the payload
+        is checkpointed.
+    """
+    key = location_key(location_type, location_id)
+    manifest.update(key, FETCHED)
+    data["date"] = date
+    data["location_type"] = location_type
+    data["location_id"] = location_id
+    archive.write(key, data)
+
+def fetch_data(date, location_type, location_id, url, output_folder, manifest,
+               archive=None):
+    key = location_key(location_type, location_id)
+    if manifest.get_status(key) == CONVERTED:
+        return None
+    file_name = "national" if location_id == 0 else location_id
+    file_path = os.path.join(output_folder, "{}.json".format(file_name))
+    if archive is None and os.path.exists(file_path):
+        logging.warning("Data file '%s' already has data." % (file_path,))
+        manifest.update(key, CONVERTED)
+        return None
+    manifest.update(key, PENDING)
+    if archive:
+        on_data = functools.partial(
+            save_archived_data, date, location_type, location_id, archive, manifest)
+    else:
+        on_data = functools.partial(
+            save_data, date, location_type, location_id, file_path, manifest)
+    return build_job(url, on_data, functools.partial(manifest.record_failure, key))
 
-def extract_national_data(date, output_folder):
+def extract_national_data(date, output_folder, manifest, archive=None):
     """
         Fetches data aggregated at national level
 
         Parameters:
             date: Date for which the data needs to be retrieved
+            manifest: Checkpoint manifest of the date
+            archive: Optional RawArchiveWriter of the date
     """
     logging.info("Fetching country level data")
-    fetch_data(date, "national", 0, build_url(date), output_folder)
+    return [fetch_data(date, "national", 0, build_url(date), output_folder,
+                       manifest, archive)]
 
-def extract_state_data(date, folder_path, test_mode):
+def extract_state_data(date, folder_path, test_mode, manifest, state_ids=None,
+                       archive=None):
     """
         Fetches data aggregated at state level for all states
 
@@ -49,6 +97,9 @@ def extract_state_data(date, folder_path, test_mode):
             folder_path: Output folder path of the state data
             test_mode: Test mode to test the data extraction.
                 Retreives only the whitlisted states in TEST_MODE_STATE_IDS
+            manifest: Checkpoint manifest of the date
+            state_ids: Optional set of state IDs to be retrieved
+            archive: Optional RawArchiveWriter of the date
     """
     logging.info("Fetching state level data")
     with open(os.path.join(SCRIPT_FOLDER, "..", "states.json")) as state_file:
@@ -56,6 +107,7 @@ def extract_state_data(date, folder_path, test_mode):
     states_path = os.path.join(folder_path, "states")
     if not os.path.exists(states_path):
         os.makedirs(states_path)
+    jobs = []
     for state in states:
         state_id = state["id"]
         state_name = state["name"]
@@ -63,11 +115,16 @@ def extract_state_data(date, folder_path, test_mode):
             logging.warning(
                 "Skipping State {}-{}".format(state_id, state_name))
             continue
+        if state_ids and state_id not in state_ids:
+            continue
         logging.info("Processing State: {}".format(state_name))
         url = build_url(date, state_id)
-        fetch_data(date, "state", state_id, url, states_path)
+        jobs.append(fetch_data(date, "state", state_id, url, states_path,
+                               manifest, archive))
+    return jobs
 
-def extract_district_data(date, folder_path, test_mode):
+def extract_district_data(date, folder_path, test_mode, manifest,
+                          state_ids=None, district_ids=None, archive=None):
     """
         Fetches data aggregated at district level for all districts
 
@@ -76,6 +133,11 @@ def extract_district_data(date, folder_path, test_mode):
             folder_path: Output folder path of the district data
             test_mode: Test mode to test the data extraction.
                 Retreives only the whitlisted states in TEST_MODE_STATE_IDS
+            manifest: Checkpoint manifest of the date
+            state_ids: Optional set of state IDs whose districts
+                needs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            archive: Optional RawArchiveWriter of the date
     """
     logging.info("Fetching state level data")
     with open(os.path.join(SCRIPT_FOLDER, "..", "districts.json")) as district_file:
@@ -83,6 +145,7 @@ def extract_district_data(date, folder_path, test_mode):
     districts_path = os.path.join(folder_path, "districts")
     if not os.path.exists(districts_path):
         os.makedirs(districts_path)
+    jobs = []
     for district in districts:
         state_id = district["state_id"]
         district_id = district["district_id"]
@@ -91,19 +154,73 @@ def extract_district_data(date, folder_path, test_mode):
             logging.warning(
                 "Skipping State {}-{}".format(district_id, district_name))
             continue
+        if state_ids and state_id not in state_ids:
+            continue
+        if district_ids and district_id not in district_ids:
+            continue
         logging.info("Processing State: {}".format(district_name))
         url = build_url(date, state_id, district_id)
-        fetch_data(date, "district", district_id, url,districts_path)
-    
+        jobs.append(fetch_data(date, "district", district_id, url,
+                               districts_path, manifest, archive))
+    return jobs
+
+
+def get_manifest(date, archived=False):
+    folder = CHECKPOINT_FOLDER_PATH
+    if archived:
+        folder = os.path.join(folder, "archive")
+    return CheckpointManifest(os.path.join(folder, "{}.jsonl".format(date)))
+
 
+def get_archive_writer(date, manifest):
+    """
+        Creates the raw archive writer of a date. The archive has all
+        the payloads of the date in a single compressed JSON lines file
+        instead of a JSON file per location.
+    """
+    return RawArchiveWriter(RAW_ARCHIVE_FOLDER_PATH, date, manifest)
+
+
+def extract_date_jobs(date, test_mode, manifest, state_ids=None, district_ids=None,
+                      archive=None):
+    """
+        Builds fetch jobs for national, state and district level data
+        of a date. National data is skipped when a state or district
+        filter is given, and state data is skipped when only a
+        district filter is given.
 
-def extract_data(date, test_mode):
+        Parameters:
+            date: Date for which the data needs to be retrieved
+            test_mode: Extract only whitelisted entries
+            manifest: Checkpoint manifest of the date
+            state_ids: Optional set of state IDs to be retrieved
+            district_ids: Optional set of district IDs to be retrieved
+            archive: Optional RawArchiveWriter of the date
+    """
     folder_path = os.path.join(COWIN_DATA_FOLDER_PATH, date)
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
-    extract_national_data(date, folder_path)
-    extract_state_data(date, folder_path, test_mode)
-    extract_district_data(date, folder_path, test_mode)
+    jobs = []
+    if not state_ids and not district_ids:
+        jobs += extract_national_data(date, folder_path, manifest, archive)
+    if state_ids or not district_ids:
+        jobs += extract_state_data(date, folder_path, test_mode,
+                                   manifest, state_ids, archive)
+    jobs += extract_district_data(date, folder_path, test_mode, manifest,
+                                  state_ids, district_ids, archive)
+    return jobs
+
+
+def extract_data(date, test_mode, workers=DEFAULT_WORKERS,
+                 limit_per_host=DEFAULT_LIMIT_PER_HOST, archived=False):
+    manifest = get_manifest(date, archived)
+    archive = get_archive_writer(date, manifest) if archived else None
+    jobs = extract_date_jobs(date, test_mode, manifest, archive=archive)
+    run_jobs(jobs, workers, limit_per_host)
+    if archive:
+        archive.close()
+    manifest.close()
+    metrics.write_reports("extract_json", METRICS_FOLDER_PATH)
 
 
 if __name__ == "__main__":
@@ -112,6 +229,9 @@ if __name__ == "__main__":
     if(len(args) >= 2):
         date = args[1]
         prod_mode = args[2] if len(args) >= 3 else ""
-        extract_data(date, prod_mode != "True")
+        workers = int(args[3]) if len(args) >= 4 else DEFAULT_WORKERS
+        output_mode = args[4] if len(args) >= 5 else ""
+        extract_data(date, prod_mode != "True", workers,
+                     archived=output_mode == "archive")
     else:
         logging.error("Date argument is missing")
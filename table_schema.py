@@ -0,0 +1,279 @@
+import re
+
+INTEGER = "INTEGER"
+REAL = "REAL"
+TEXT = "TEXT"
+DATE = "DATE"
+
+INTEGER_PATTERN = re.compile(r"^-?\d+$")
+REAL_PATTERN = re.compile(r"^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Constraints which reject values of other storage classes, like the
+# STRICT tables of SQLite 3.37+. DATE columns are stored as
+# YYYY-MM-DD text.
+TYPE_CONSTRAINTS = {
+    INTEGER: "typeof([{0}]) IN ('integer', 'null')",
+    REAL: "typeof([{0}]) IN ('real', 'null')",
+    TEXT: "typeof([{0}]) IN ('text', 'null')",
+    DATE: "[{0}] IS date([{0}])"
+}
+
+
+class SchemaMismatch(ValueError):
+    """
+        Raised when rows have columns which are not in the table, or
+        values which do not fit the type of their column.
+
+        Attributes:
+            column_types: Dictionary of the types the columns need, by
+                column name
+    """
+
+    def __init__(self, table, column_types):
+        super().__init__("Columns {} of table {} need types {}".format(
+            ", ".join(column_types), table,
+            ", ".join(column_types.values())))
+        self.column_types = column_types
+
+
+def infer_type(value):
+    """
+        Infers the column type of a CSV or JSON value.
+
+        Parameters:
+            value: Value read from CSV file, or JSON value
+        Returns:
+            Column type, or None for empty values
+    """
+    if value is None or value == "":
+        return None
+    if type(value) is int:
+        return INTEGER
+    if type(value) is float:
+        return REAL
+    value = str(value)
+    if INTEGER_PATTERN.match(value):
+        return INTEGER
+    if REAL_PATTERN.match(value):
+        return REAL
+    if DATE_PATTERN.match(value):
+        return DATE
+    return TEXT
+
+
+def merge_types(first, second):
+    if first is None or first == second:
+        return second
+    if second is None:
+        return first
+    if set([first, second]) == set([INTEGER, REAL]):
+        return REAL
+    return TEXT
+
+
+def infer_column_types(headers, rows, declared=None):
+    """
+        Infers the column types of a table from its first rows.
+        Declared types take precedence and columns without any value
+        are TEXT.
+
+        Parameters:
+            headers: Column names
+            rows: Rows of CSV values
+            declared: Optional dictionary of column types by column name
+        Returns:
+            Dictionary of column types by column name, in column order
+    """
+    declared = declared or {}
+    inferred = [None] * len(headers)
+    for row in rows:
+        for index, value in enumerate(row):
+            inferred[index] = merge_types(
+                inferred[index], infer_type(value))
+    return {header: declared.get(header) or inferred[index] or TEXT
+            for index, header in enumerate(headers)}
+
+
+# The converters take the text values of the CSV files and the JSON
+# values of the payloads. JSON numbers are used as they are, and other
+# JSON values are converted like their text in the CSV files.
+def to_integer(value):
+    if value is None or value == "":
+        return None
+    if type(value) is int:
+        return value
+    if type(value) is float:
+        if not value.is_integer():
+            raise ValueError("Invalid integer")
+        return int(value)
+    value = str(value)
+    try:
+        return int(value)
+    except ValueError:
+        number = float(value)
+        if not number.is_integer():
+            raise
+        return int(number)
+
+
+def to_real(value):
+    if value is None or value == "":
+        return None
+    if type(value) is int or type(value) is float:
+        return float(value)
+    return float(str(value))
+
+
+def to_text(value):
+    # JSON nulls are stored like the empty values of the CSV files
+    return "" if value is None else str(value)
+
+
+def to_date(value):
+    if value is None or value == "":
+        return None
+    if not DATE_PATTERN.match(str(value)):
+        raise ValueError("Invalid date")
+    return value
+
+
+CONVERTERS = {
+    INTEGER: to_integer,
+    REAL: to_real,
+    TEXT: to_text,
+    DATE: to_date
+}
+
+
+class TableSchema:
+    """
+        Column types of a table, used to create the table and to
+        convert CSV values into their column types once at load time.
+    """
+
+    def __init__(self, table, column_types):
+        """
+            Parameters:
+                table: Name of the table
+                column_types: Dictionary of column types by column name
+        """
+        self.table = table
+        self.column_types = column_types
+
+    @classmethod
+    def from_table(cls, db, table):
+        """
+            Reads the schema of an existing table. Returns None if the
+            table does not exist. Columns of types other than the typed
+            schema, like the TEXT columns of untyped tables, are
+            converted into text.
+        """
+        columns = db.execute(
+            "PRAGMA table_info([{}])".format(table)).fetchall()
+        if not columns:
+            return None
+        return cls(table, {name: column_type.upper()
+                           if column_type.upper() in CONVERTERS else TEXT
+                           for _, name, column_type, *_ in columns})
+
+    @staticmethod
+    def get_column_sql(column, column_type, pk=None):
+        definition = "[{}] {}".format(column, column_type)
+        if pk and column in pk:
+            definition += " NOT NULL"
+        return definition + " CHECK ({})".format(
+            TYPE_CONSTRAINTS[column_type].format(column))
+
+    def get_create_sql(self, pk):
+        definitions = [self.get_column_sql(column, column_type, pk)
+                       for column, column_type in self.column_types.items()]
+        if pk:
+            definitions.append("PRIMARY KEY ({})".format(
+                ", ".join("[{}]".format(column) for column in pk)))
+        return "CREATE TABLE [{}] (\n   {}\n)".format(
+            self.table, ",\n   ".join(definitions))
+
+    def create(self, db, pk):
+        db.execute(self.get_create_sql(pk))
+
+    def alter(self, db, column_types):
+        """
+            Adds the new columns of a table and changes the types of its
+            existing columns. A table whose column types change is
+            rebuilt with the new types, as SQLite cannot alter the type
+            constraints of a column. Its indexes are dropped with it.
+
+            Parameters:
+                db: Sqlite database connection
+                column_types: Dictionary of column types by column name
+        """
+        for column, column_type in column_types.items():
+            if column not in self.column_types:
+                db.execute("ALTER TABLE [{}] ADD COLUMN {}".format(
+                    self.table, self.get_column_sql(column, column_type)))
+                self.column_types[column] = column_type
+        changed = {column: column_type
+                   for column, column_type in column_types.items()
+                   if self.column_types[column] != column_type}
+        if not changed:
+            return
+        pk = [name for _, name in sorted(
+            (pk_index, name) for _, name, _, _, _, pk_index in db.execute(
+                "PRAGMA table_info([{}])".format(self.table)) if pk_index)]
+        columns = ", ".join("[{}]".format(column)
+                            for column in self.column_types)
+        self.column_types.update(changed)
+        staging = TableSchema(self.table + "_staging", self.column_types)
+        db.execute("DROP TABLE IF EXISTS [{}]".format(staging.table))
+        staging.create(db, pk)
+        # The affinity of the new types converts the stored values
+        db.execute("INSERT INTO [{}] ({}) SELECT {} FROM [{}]".format(
+            staging.table, columns, columns, self.table))
+        db.execute("DROP TABLE [{}]".format(self.table))
+        db.execute("ALTER TABLE [{}] RENAME TO [{}]".format(
+            staging.table, self.table))
+
+    def convert_rows(self, headers, rows):
+        """
+            Converts rows of CSV or JSON values into tuples of typed
+            values.
+
+            Parameters:
+                headers: Column names of the rows
+                rows: List of rows
+            Returns:
+                List of tuples
+            Raises:
+                SchemaMismatch with the types of the columns which are
+                not in the table, inferred from the rows, and of the
+                columns whose values do not fit their type, widened to
+                fit the values
+        """
+        new_headers = [header for header in headers
+                       if header not in self.column_types]
+        if new_headers:
+            inferred = infer_column_types(headers, rows)
+            raise SchemaMismatch(self.table, {
+                header: inferred[header] for header in new_headers})
+        column_types = [self.column_types[header] for header in headers]
+        converters = [CONVERTERS[column_type] for column_type in column_types]
+        converted = []
+        widened = {}
+        for row in rows:
+            try:
+                converted.append(tuple(
+                    convert(value) for convert, value in zip(converters, row)))
+            except ValueError:
+                for header, column_type, value in zip(
+                        headers, column_types, row):
+                    try:
+                        CONVERTERS[column_type](value)
+                    except ValueError:
+                        column_type = widened.get(header, column_type)
+                        merged = merge_types(column_type, infer_type(value))
+                        widened[header] = TEXT if merged == column_type \
+                            else merged
+        if widened:
+            raise SchemaMismatch(self.table, widened)
+        return converted